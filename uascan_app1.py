@@ -15,8 +15,8 @@
 #   limitations under the License.
 
 import os
+import re
 import sys
-import time
 import logging
 import uascan_lib
 
@@ -40,19 +40,42 @@ def get_cmdline():
         return None
 
 
-def get_stdin():
-    # Let's get input from Pipe, if no input for 1 second, we exit.
-    timeout_seconds = 1
-    end_time = int(round(time.time() + timeout_seconds))
+# A run of line ends, '\r' or '\n'
+line_ends_regex = re.compile(r'([\r\n]+)')
+
+
+def get_stdin(buffer_size=65536):
+    # Generator yielding the list of User Agents completed by each read from STDIN, as the data arrives. Reads
+    # block while the pipe is idle, and only the current line is kept between them.
+    # Lines end at '\r' or '\n', each pair of consecutive line ends counting as one so that '\r\n' ends a single
+    # line. The text after the last line end is the last line, an empty one if the input ends with a line end.
+    stdin_fd = sys.stdin.fileno()
+    line = None
+    line_ends = 0
     while True:
-        line = sys.stdin.read()
-        if line != '':
-            lines = line.replace('\r', '\n').replace('\n\n', '\n').split('\n')
-            return lines
-        else:
-            if int(round(time.time())) >= end_time:
-                return None
-    return None
+        data = os.read(stdin_fd, buffer_size)
+        if data == '':
+            break
+        if line is None:
+            line = ''
+        ua_lines = []
+        for piece in line_ends_regex.split(data):
+            if piece == '':
+                continue
+            elif piece[0] in '\r\n':
+                if line_ends == 0:
+                    ua_lines.append(line)
+                    line = ''
+                line_ends += len(piece)
+            else:
+                if line_ends:
+                    # Blank lines between the previous line and this one
+                    ua_lines.extend([''] * ((line_ends + 1) // 2 - 1))
+                    line_ends = 0
+                line += piece
+        yield ua_lines
+    if line is not None:
+        yield [''] * ((line_ends + 1) // 2 - 1 if line_ends else 0) + [line]
 
 
 if __name__ == '__main__':
@@ -114,15 +137,11 @@ if __name__ == '__main__':
                                      sys.argv[0], "'Mozilla/5.0 (Windows NT 6.3) Firefox/36.0'"))
                 exit(0)
             else:
-                # We have a pipe, read the input and process each individually.
-                # If the pipe has no data input for 1 second, we exit.
-                while True:
-                    ua_lines = get_stdin()
-                    if ua_lines is None:
-                        exit(0)
-                    else:
-                        for ua in ua_lines:
-                            sys.stdout.write('{0}\n'.format(ua_scanner.uacheck_string(ua)))
+                # We have a pipe, each User Agent's result is written as soon as its line has been read.
+                # Writing blocks while the reader of our output is busy, and we stop reading until it is done.
+                for ua_lines in get_stdin():
+                    sys.stdout.write(''.join('{0}\n'.format(output) for output in ua_scanner.uacheck_many(ua_lines)))
+                    sys.stdout.flush()
     except IOError:
         # This is needed to avoid a stacktrace should someone cut out stdout while we're working, like...
         # cat ua_agents.txt | uascan_lib.py | head -n 2
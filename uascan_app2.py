@@ -14,23 +14,69 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import os
 import sys
+import getopt
 import logging
 import uascan_lib
+import uascan_logs
+import uascan_records
+
+
+def read_useragents(lines, app_logger):
+    # Each line of the file is a UserAgent entry, yield them one at a time.
+    for line_in in lines:
+        line_in = line_in.split(' ')
+        line_string = ' '.join(line_in[1:])
+        app_logger.debug('DEBUG UA String: {0}'.format(line_string))
+        yield line_string
+
 
 if __name__ == '__main__':
     debug = False
     try:
-        if len(sys.argv) <= 1:
+        # -j N / --jobs N : Classify on N worker processes, the output order is unchanged.
+        # -f / --follow    : Keep reading lines as they are appended to the file, like 'tail -F'.
+        # -c F / --checkpoint F : Store the (inode, offset) reached in F, and start from it on the next run.
+        # -u F / --ua-cache F   : Keep classification results in the SQLite file F, shared across runs.
+        # -r / --records   : Write binary records, see uascan_records.py, instead of text lines.
+        opts, args = getopt.getopt(sys.argv[1:], 'j:fc:u:r', ['jobs=', 'follow', 'checkpoint=', 'ua-cache=',
+                                                             'records'])
+        jobs = 0
+        follow = False
+        checkpoint_file = None
+        ua_cache_file = None
+        records_enabled = False
+        for opt, val in opts:
+            if opt in ('-j', '--jobs'):
+                jobs = int(val)
+            elif opt in ('-f', '--follow'):
+                follow = True
+            elif opt in ('-c', '--checkpoint'):
+                checkpoint_file = val
+            elif opt in ('-u', '--ua-cache'):
+                ua_cache_file = val
+            elif opt in ('-r', '--records'):
+                records_enabled = True
+
+        if len(args) < 1:
             sys.stderr.write('UserAgent SHA256 Compatibility Scanner - App 2\n'
                              '==============================================\n'
                              'This application is intended to provide an application example\n'
                              'that will read a list of single line User Agent strings from a\n'
                              'file and process them for compatibility.\n\n'
                              'This application requires input of a UserAgent from:\n'
-                             '    1) A file, which is specified on the command line.\n\n'
+                             '    1) A file, which is specified on the command line. Files compressed\n'
+                             '       with gzip, bzip2 or xz are decompressed as they are read.\n\n'
                              '    Example: {0} {1}\n\n'
+                             'Options:\n'
+                             '    -j N, --jobs N  Classify on N worker processes\n'
+                             '    -f, --follow    Keep reading lines appended to the file, like tail -F\n'
+                             '    -c F, --checkpoint F\n'
+                             '                    Store the position reached in F and resume from it\n'
+                             '    -u F, --ua-cache F\n'
+                             '                    Keep classification results in F across runs\n'
+                             '    -r, --records   Write binary records instead, read them with\n'
+                             '                    uascan_records.py\n\n'
                              'Note: Blank lines are considered to be valid user agents. If this is\n'
                              '      not desired please remove any blank lines prior to processing.\n\n'
                              'The output of this application is in the following format:\n'
@@ -43,14 +89,15 @@ if __name__ == '__main__':
                              '        2 = Not Supported\n\n'.format(sys.argv[0], 'uafile.txt'))
             exit(1)
 
-        ua_file = ' '.join(sys.argv[1:])
+        ua_file = ' '.join(args)
 
         # debug_enabled   : True = Output Debug Information           | False = No Debug Information
         # identify_unknown: True = Output If UA was identified or not | False = Don't output if UA was identified
         debug_enabled = False
         identify_unknown = False
         # Initialize UserAgent Scanner class
-        ua_scanner = uascan_lib.UAscanner(debug=debug_enabled, identify_unknown=identify_unknown)
+        scanner_args = dict(debug=debug_enabled, identify_unknown=identify_unknown, persistent_cache=ua_cache_file)
+        ua_scanner = uascan_lib.UAscanner(**scanner_args)
 
         # We'll setup this applications logging separate from the above class.
         app_logger = logging.getLogger('UAScannerApp2')
@@ -61,17 +108,52 @@ if __name__ == '__main__':
         if debug_enabled:
             app_logger_stream.setLevel(logging.DEBUG)
         else:
-            app_logger_stream.setLevel(logging.ERROR)
+            # Warnings are only those of log files read in part, see uascan_logs.read_log_chunks.
+            app_logger_stream.setLevel(logging.WARNING)
         app_logger.addHandler(app_logger_stream)
+        uascan_logs.logs_logger.addHandler(app_logger_stream)
+
+        # Binary records hold the full result of each UserAgent, in input order.
+        records = uascan_records.RecordWriter(sys.stdout) if records_enabled else None
 
-        log_filein = open(ua_file, "r")
-        while not log_filein.tell() == os.fstat(log_filein.fileno()).st_size:
-            line_in = log_filein.readline().strip('\n')
-            line_in = line_in.split(' ')
-            line_string = ' '.join(line_in[1:])
-            app_logger.debug('DEBUG UA String: {0}'.format(line_string))
-            sys.stdout.write('{0}\n'.format(ua_scanner.uacheck_string(line_string)))
-        log_filein.close()
+        if follow or checkpoint_file is not None:
+            # Only complete lines are read, and the checkpoint is saved once their output has been written, so a
+            # restarted run neither skips nor repeats an entry.
+            checkpoint = uascan_logs.LogCheckpoint(checkpoint_file) if checkpoint_file is not None else None
+            inode, offset = checkpoint.get(ua_file) if checkpoint is not None else (None, 0)
+            for inode, offset, ua_lines in uascan_logs.follow_log(ua_file, inode, offset, follow=follow):
+                if records is not None:
+                    for ua_result in ua_scanner.classify_many(read_useragents(ua_lines, app_logger)):
+                        records.write((ua_result,))
+                    records.flush()
+                else:
+                    for ua_status in ua_scanner.uacheck_many(read_useragents(ua_lines, app_logger)):
+                        sys.stdout.write('{0}\n'.format(ua_status))
+                sys.stdout.flush()
+                if checkpoint is not None:
+                    checkpoint.save(ua_file, inode, offset)
+        elif jobs > 1:
+            ua_lines = uascan_logs.log_lines(ua_file)
+            with uascan_lib.UAscannerPool(jobs=jobs, **scanner_args) as ua_pool:
+                if records is not None:
+                    for ua_string, ua_result in ua_pool.classify_many(read_useragents(ua_lines, app_logger)):
+                        records.write((ua_result,))
+                else:
+                    for ua_string, ua_status in ua_pool.uacheck_many(read_useragents(ua_lines, app_logger)):
+                        sys.stdout.write('{0}\n'.format(ua_status))
+        elif records is not None:
+            ua_lines = uascan_logs.log_lines(ua_file)
+            for ua_result in ua_scanner.classify_many(read_useragents(ua_lines, app_logger)):
+                records.write((ua_result,))
+        else:
+            ua_lines = uascan_logs.log_lines(ua_file)
+            for ua_status in ua_scanner.uacheck_many(read_useragents(ua_lines, app_logger)):
+                sys.stdout.write('{0}\n'.format(ua_status))
+        if records is not None:
+            records.close()
+    except (getopt.GetoptError, ValueError) as err:
+        sys.stderr.write('{0}\n'.format(err))
+        exit(1)
     except IOError:
         # This is needed to avoid a stacktrace should someone cut out stdout while we're working, like...
         # cat ua_agents.txt | uascan_lib.py | head -n 2
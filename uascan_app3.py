@@ -15,67 +15,143 @@
 #   limitations under the License.
 
 import os
-import re
 import sys
+import getopt
+import functools
 import logging
 import uascan_lib
+import uascan_logs
+import uascan_records
 
 if __name__ == '__main__':
     debug = False
-    # S3 Log Format Regex
-    s3log_regex = re.compile(r'^(.*?) (.*?) \[(.*?)\] (.*?) (.*?) (.*?) (.*?) (.*?) "(.*?)" (.*?) (.*?) (.*?) (.*?) (.*?) (.*?) "(.*?)" "(.*?)" (.*)$')
-
-    # S3 Server Log Access Format: http://docs.aws.amazon.com/AmazonS3/latest/dev/LogFormat.html
-    #     0: Canonical user ID of bucket owner
-    #     1: Bucket Processed (or object copied too)
-    #     2: Date/Time %d/%b/%Y:%H:%M:%S %z
-    #     3: Remote IP
-    #     4: Canonical user ID of requester, or "Anonymous"
-    #     5: Request ID
-    #     6: Operation
-    #     7: Object Key
-    #     8: Request-URI
-    #     9: HTTP status
-    #    10: Error Code
-    #    11: Bytes Sent
-    #    12: Object Size
-    #    13: Total Time
-    #    14: Turn-Around Time
-    #    15: Referrer
-    #    16: User-Agent
-    #    17: Version Id
     try:
-        if len(sys.argv) <= 1:
+        # -j N / --jobs N : Classify on N worker processes, the output order is unchanged.
+        # -s / --summary   : Print request counts by Bucket, Supported and UA_ShortName instead of each entry.
+        # -i / --by-ip     : With --summary, also count by SourceIP.
+        # -f / --follow    : Keep reading lines as they are appended to the file, like 'tail -F'.
+        # -c F / --checkpoint F : Store the (inode, offset) reached in F, and start from it on the next run.
+        # -u F / --ua-cache F   : Keep classification results in the SQLite file F, shared across runs.
+        # -r / --records   : Write binary records, see uascan_records.py, instead of text lines.
+        # -F L / --log-format L : Read logs of format L, one of uascan_logs.log_formats, instead of S3 access logs.
+        # -S N / --sample N : Estimate the share of each Supported code from N sampled entries instead of all of them.
+        # --sample-files    : With --sample, sample N whole log files instead of N entries.
+        # --seed N          : Seed of the sample, the same seed draws the same sample.
+        opts, args = getopt.getopt(sys.argv[1:], 'j:sifc:u:rF:S:', ['jobs=', 'summary', 'by-ip', 'follow',
+                                                                   'checkpoint=', 'ua-cache=', 'records',
+                                                                   'log-format=', 'sample=', 'sample-files', 'seed='])
+        jobs = 0
+        follow = False
+        checkpoint_file = None
+        ua_cache_file = None
+        summary_enabled = False
+        summary_by_ip = False
+        records_enabled = False
+        log_format = 's3'
+        sample_size = None
+        sample_files = False
+        sample_seed = 0
+        for opt, val in opts:
+            if opt in ('-j', '--jobs'):
+                jobs = int(val)
+            elif opt in ('-f', '--follow'):
+                follow = True
+            elif opt in ('-c', '--checkpoint'):
+                checkpoint_file = val
+            elif opt in ('-u', '--ua-cache'):
+                ua_cache_file = val
+            elif opt in ('-s', '--summary'):
+                summary_enabled = True
+            elif opt in ('-i', '--by-ip'):
+                summary_by_ip = True
+            elif opt in ('-r', '--records'):
+                records_enabled = True
+            elif opt in ('-F', '--log-format'):
+                log_format = val
+            elif opt in ('-S', '--sample'):
+                sample_size = int(val)
+            elif opt == '--sample-files':
+                sample_files = True
+            elif opt == '--seed':
+                sample_seed = int(val)
+
+        if len(args) < 1:
             sys.stderr.write('UserAgent SHA256 Compatibility Scanner - App 3\n'
                              '==============================================\n'
                              'This application is intended to provide an application example\n'
                              'that will read an S3 access log file. It will extract the\n'
                              'User Agent string from each line and process them for compatibility.\n\n'
                              'This application requires input of:\n'
-                             '    1) a S3 access log file, which is specified on the command line.\n\n'
+                             '    1) a S3 access log file, which is specified on the command line. Files\n'
+                             '       compressed with gzip, bzip2 or xz are decompressed as they are read.\n'
+                             '       A directory, a glob pattern or several files scan every log file,\n'
+                             '       spread over a worker process per core unless --jobs is given.\n\n'
                              '    Example: {0} {1}\n\n'
+                             'Options:\n'
+                             '    -j N, --jobs N  Classify on N worker processes\n'
+                             '    -f, --follow    Keep reading lines appended to the file, like tail -F\n'
+                             '    -c F, --checkpoint F\n'
+                             '                    Store the position reached in F and resume from it\n'
+                             '    -u F, --ua-cache F\n'
+                             '                    Keep classification results in F across runs\n'
+                             '    -s, --summary   Print a report of request counts instead of each entry\n'
+                             '    -i, --by-ip     With --summary, also count by SourceIP\n'
+                             '    -r, --records   Write binary records instead, read them with\n'
+                             '                    uascan_records.py\n'
+                             '    -F L, --log-format L\n'
+                             '                    Read logs of format L instead of S3 access logs:\n'
+                             '                    {2}\n'
+                             '    -S N, --sample N\n'
+                             '                    Estimate the share of each Supported code from N\n'
+                             '                    sampled entries, with 95% confidence intervals\n'
+                             '    --sample-files  With --sample, sample N whole files instead\n'
+                             '    --seed N        Seed of the sample, 0 by default\n\n'
                              'Note: Blank lines are considered to be valid user agents. If this is\n'
                              '      not desired please remove any blank lines prior to processing\n\n'
                              'The output of this application is in the following format:\n'
                              '    Bucket SourceIP Supported UA_ShortName\n'
                              '    mybucket 192.168.1.125 0 Chrome\n\n'
-                             '"Bucket" is the destination bucket.\n'
+                             'When scanning several files each line starts with the SourceFile:\n'
+                             '    SourceFile Bucket SourceIP Supported UA_ShortName\n\n'
+                             'With --summary it prints, most requests first:\n'
+                             '    Requests Bucket [SourceIP] Supported UA_ShortName\n'
+                             '    1843 mybucket 2 Java\n\n'
+                             'With --sample it prints the estimated percentage of entries and its\n'
+                             'confidence interval for each Supported code:\n'
+                             '    Supported Share Low High\n'
+                             '    2 12.40% 11.75% 13.05%\n\n'
+                             '"Bucket" is the destination bucket. In load balancer logs it is the load\n'
+                             'balancer, in CloudFront logs the distribution\'s domain, in Apache logs "-".\n'
                              '"SourceIP" is the IP address if the requester.\n'
                              '"UA_ShortName" is a short descriptor of the full user agent.\n'
                              '"Supported" indicates SHA256 Support:\n'
                              '        0 = Supported\n'
                              '        1 = Unknown Support (Maybe supported or not)\n'
-                             '        2 = Not Supported\n\n'.format(sys.argv[0], 's3_access.log'))
+                             '        2 = Not Supported\n\n'.format(sys.argv[0], 's3_access.log',
+                                                                        ', '.join(uascan_logs.log_formats)))
             exit(1)
 
-        ua_file = ' '.join(sys.argv[1:])
+        # Raises ValueError for an unknown format. The splitter is only used when reading a single log in this
+        # process, the worker functions are given the format name and make their own.
+        log_splitter = uascan_logs.get_log_splitter(log_format)
+        scan_file = functools.partial(uascan_logs.scan_s3log_file, log_format=log_format)
+        classify_file = functools.partial(uascan_logs.classify_s3log_file, log_format=log_format)
+        summarize_file = functools.partial(uascan_logs.summarize_s3log_file, log_format=log_format)
+
+        ua_file = ' '.join(args)
+        # A single existing file is scanned as before, otherwise each argument is a file, directory or glob.
+        if os.path.exists(ua_file) and not os.path.isdir(ua_file):
+            ua_files = None
+        else:
+            ua_files = uascan_logs.expand_log_paths(args)
 
         # debug_enabled   : True = Output Debug Information           | False = No Debug Information
         # identify_unknown: True = Output If UA was identified or not | False = Don't output if UA was identified
         debug_enabled = False
         identify_unknown = False
         # Initialize UserAgent Scanner class
-        ua_scanner = uascan_lib.UAscanner(debug=debug_enabled, identify_unknown=identify_unknown)
+        scanner_args = dict(debug=debug_enabled, identify_unknown=identify_unknown, persistent_cache=ua_cache_file)
+        ua_scanner = uascan_lib.UAscanner(**scanner_args)
 
         # We'll setup this applications logging separate from the above class.
         app_logger = logging.getLogger('UAScannerApp3')
@@ -86,24 +162,154 @@ if __name__ == '__main__':
         if debug_enabled:
             app_logger_stream.setLevel(logging.DEBUG)
         else:
-            app_logger_stream.setLevel(logging.ERROR)
+            # Warnings are only those of log files read in part, see uascan_logs.read_log_chunks.
+            app_logger_stream.setLevel(logging.WARNING)
         app_logger.addHandler(app_logger_stream)
+        uascan_logs.logs_logger.addHandler(app_logger_stream)
 
-        log_filein = open(ua_file, "r")
-        while not log_filein.tell() == os.fstat(log_filein.fileno()).st_size:
-            line_in = log_filein.readline().strip('\n')
-            line_regexed = s3log_regex.match(line_in)
-            # If line_regexed is None then our regex did not match.
-            if line_regexed is not None:
-                # Extract the groups captured by the regex
-                line_regex_group = s3log_regex.match(line_in).groups()
-                log_bucket = line_regex_group[1]
-                log_ip = line_regex_group[3]
-                log_ua = line_regex_group[16]
+        # Counts are merged in memory and reported at the end, the table size is bounded by S3logSummary.max_keys.
+        summary = uascan_logs.S3logSummary(by_ip=summary_by_ip) if summary_enabled else None
+
+        if (follow or checkpoint_file is not None) and (ua_files is not None or summary is not None):
+            raise ValueError('--follow and --checkpoint read a single log file, without --summary')
+        if records_enabled and summary is not None:
+            raise ValueError('--records writes each entry, it can not be used with --summary')
+        if sample_size is not None and (follow or checkpoint_file is not None or records_enabled or
+                                        summary is not None):
+            raise ValueError('--sample can not be used with --follow, --checkpoint, --records or --summary')
+        if sample_size is not None and sample_size < 1:
+            raise ValueError('--sample takes a number of entries or files above 0')
+        if sample_files and sample_size is None:
+            raise ValueError('--sample-files sets what --sample N samples, it needs --sample')
+
+        # Binary records hold the same columns as the text output, and the full result of each entry.
+        records = None
+        if records_enabled:
+            records = uascan_records.RecordWriter(sys.stdout, ('source_file', 'bucket', 'ip') if ua_files is not None
+                                                  else ('bucket', 'ip'))
+
+        if sample_size is not None and sample_files:
+            # Whole files are drawn, classified as in directory mode, and each is a unit of the estimate.
+            sampled_files, population = uascan_logs.sample_log_files(ua_files or [ua_file], sample_size, sample_seed)
+            estimate = uascan_logs.LogSampleEstimate(population=population)
+            count_file = functools.partial(uascan_logs.count_s3log_file, log_format=log_format)
+            if jobs == 1:
+                for file_name in sampled_files:
+                    supported_counts = count_file(ua_scanner, file_name)
+                    estimate.add(sum(supported_counts), supported_counts, entries=sum(supported_counts))
+            else:
+                with uascan_lib.UAscannerPool(jobs=jobs or None, **scanner_args) as ua_pool:
+                    for supported_counts in ua_pool.map_scanner(count_file, sampled_files):
+                        estimate.add(sum(supported_counts), supported_counts, entries=sum(supported_counts))
+            for output in estimate.report():
+                sys.stdout.write('{0}\n'.format(output))
+        elif sample_size is not None:
+            # Entries are drawn from all the files and only they are classified, see uascan_logs.sample_s3log.
+            sampled_entries, population = uascan_logs.sample_s3log(ua_files or [ua_file], sample_size, sample_seed,
+                                                                   log_format)
+            estimate = uascan_logs.LogSampleEstimate(population=population)
+            if jobs > 1:
+                with uascan_lib.UAscannerPool(jobs=jobs, **scanner_args) as ua_pool:
+                    for (weight, log_bucket, log_ip, log_ua), ua_result in ua_pool.classify_many(sampled_entries,
+                                                                                                 ua_index=3):
+                        estimate.add_entry(weight, ua_result.supported)
+            else:
+                ua_results = ua_scanner.classify_many([log_entry[3] for log_entry in sampled_entries])
+                for (weight, log_bucket, log_ip, log_ua), ua_result in zip(sampled_entries, ua_results):
+                    estimate.add_entry(weight, ua_result.supported)
+            for output in estimate.report():
+                sys.stdout.write('{0}\n'.format(output))
+        elif follow or checkpoint_file is not None:
+            # Only complete lines are read, and the checkpoint is saved once their output has been written, so a
+            # restarted run neither skips nor repeats an entry.
+            checkpoint = uascan_logs.LogCheckpoint(checkpoint_file) if checkpoint_file is not None else None
+            inode, offset = checkpoint.get(ua_file) if checkpoint is not None else (None, 0)
+            for inode, offset, ua_lines in uascan_logs.follow_log(ua_file, inode, offset, follow=follow):
+                if records is not None:
+                    records.write_many(uascan_logs.classify_s3log(ua_scanner, ua_lines, app_logger,
+                                                                  log_format=log_splitter))
+                    records.flush()
+                else:
+                    for output in uascan_logs.scan_s3log(ua_scanner, ua_lines, app_logger, log_format=log_splitter):
+                        sys.stdout.write('{0}\n'.format(output))
+                sys.stdout.flush()
+                if checkpoint is not None:
+                    checkpoint.save(ua_file, inode, offset)
+        elif ua_files is not None:
+            # Each file is scanned whole by one worker process, which keeps its UAscanner and cache warm across
+            # files. The output of each file is written in file order.
+            if jobs == 1 and summary is not None:
+                for file_name in ua_files:
+                    summary.update(summarize_file(ua_scanner, (summary.copy(), file_name)))
+            elif jobs == 1 and records is not None:
+                for file_name in ua_files:
+                    records.write_many(classify_file(ua_scanner, file_name))
+            elif jobs == 1:
+                for file_name in ua_files:
+                    sys.stdout.write(scan_file(ua_scanner, file_name))
+            else:
+                with uascan_lib.UAscannerPool(jobs=jobs or None, **scanner_args) as ua_pool:
+                    if summary is not None:
+                        summary_files = [(summary.copy(), file_name) for file_name in ua_files]
+                        for file_summary in ua_pool.map_scanner(summarize_file, summary_files):
+                            summary.update(file_summary)
+                    elif records is not None:
+                        for file_entries in ua_pool.map_scanner(classify_file, ua_files):
+                            records.write_many(file_entries)
+                    else:
+                        for file_output in ua_pool.map_scanner(scan_file, ua_files):
+                            sys.stdout.write(file_output)
+        elif jobs > 1 and (not os.path.isfile(ua_file) or uascan_logs.get_file_compression(ua_file) is not None):
+            # Compressed logs and pipes can not be split by byte range, the entries are classified on the workers
+            # a chunk at a time as they are read.
+            with uascan_lib.UAscannerPool(jobs=jobs, **scanner_args) as ua_pool:
+                log_entries = uascan_logs.read_s3log(uascan_logs.stream_lines(ua_file), app_logger, log_splitter)
+                if records is not None:
+                    for (log_bucket, log_ip, log_ua), ua_result in ua_pool.classify_many(log_entries, ua_index=2):
+                        records.write((log_bucket, log_ip, ua_result))
+                else:
+                    for (log_bucket, log_ip, log_ua), ua_status in ua_pool.uacheck_many(log_entries, ua_index=2):
+                        if summary is not None:
+                            summary.add(log_bucket, log_ip, ua_status)
+                        else:
+                            sys.stdout.write('{0} {1} {2}\n'.format(log_bucket, log_ip, ua_status))
+        elif jobs > 1:
+            # Split the log into byte ranges on line boundaries, each range is scanned by a worker process.
+            # The output of each range is written in file order.
+            file_ranges = [(ua_file, start, end) for start, end in uascan_logs.get_byte_ranges(ua_file, jobs * 4)]
+            with uascan_lib.UAscannerPool(jobs=jobs, **scanner_args) as ua_pool:
+                if summary is not None:
+                    summary_ranges = [(summary.copy(), file_range) for file_range in file_ranges]
+                    summarize_range = functools.partial(uascan_logs.summarize_s3log_range, log_format=log_format)
+                    for range_summary in ua_pool.map_scanner(summarize_range, summary_ranges):
+                        summary.update(range_summary)
+                elif records is not None:
+                    classify_range = functools.partial(uascan_logs.classify_s3log_range, log_format=log_format)
+                    for range_entries in ua_pool.map_scanner(classify_range, file_ranges):
+                        records.write_many(range_entries)
+                else:
+                    scan_range = functools.partial(uascan_logs.scan_s3log_range, log_format=log_format)
+                    for range_output in ua_pool.map_scanner(scan_range, file_ranges):
+                        sys.stdout.write(range_output)
+        elif summary is not None:
+            summary.add_entries(uascan_logs.check_s3log(ua_scanner, uascan_logs.log_lines(ua_file), app_logger,
+                                                        log_format=log_splitter))
+        elif records is not None:
+            records.write_many(uascan_logs.classify_s3log(ua_scanner, uascan_logs.log_lines(ua_file), app_logger,
+                                                          log_format=log_splitter))
+        else:
+            for output in uascan_logs.scan_s3log(ua_scanner, uascan_logs.log_lines(ua_file), app_logger,
+                                                 log_format=log_splitter):
+                sys.stdout.write('{0}\n'.format(output))
 
-                app_logger.debug('DEBUG UA String: {0}'.format(log_ua))
-                sys.stdout.write('{0} {1} {2}\n'.format(log_bucket, log_ip, ua_scanner.uacheck_string(log_ua)))
-        log_filein.close()
+        if summary is not None:
+            for output in summary.report():
+                sys.stdout.write('{0}\n'.format(output))
+        if records is not None:
+            records.close()
+    except (getopt.GetoptError, ValueError) as err:
+        sys.stderr.write('{0}\n'.format(err))
+        exit(1)
     except IOError:
         # This is needed to avoid a stacktrace should someone cut out stdout while we're working, like...
         # cat ua_agents.txt | uascan_lib.py | head -n 2
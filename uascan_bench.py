@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+#
+#   Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import getopt
+import platform
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+""" Benchmark the UAscanner library and applications on a generated corpus, see uascan_corpus.py.
+
+Each benchmark runs in a new process, so that its startup, caches and peak memory are its own. The results are
+written as JSON, and two result files, from two commits for instance, can be compared with --compare.
+"""
+
+results_format = 1
+
+# The directory holding the scanner, the applications are run from it.
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Latency percentiles reported by the in-process benchmarks
+latency_percentiles = (50, 90, 99, 99.9)
+
+
+def get_percentiles(values, percentiles=latency_percentiles):
+    # Return the nearest-rank percentiles of values, in microseconds.
+    values = sorted(values)
+    if not values:
+        return OrderedDict()
+    result = OrderedDict()
+    for percentile in percentiles:
+        rank = max(int(math.ceil(percentile / 100.0 * len(values))), 1)
+        result['p{0:g}'.format(percentile)] = round(values[rank - 1] * 1e6, 3)
+    result['max'] = round(values[-1] * 1e6, 3)
+    return result
+
+
+def get_rss_kb(ru_maxrss):
+    # ru_maxrss is in bytes on OS X, in kilobytes elsewhere.
+    return ru_maxrss // 1024 if sys.platform == 'darwin' else ru_maxrss
+
+
+def get_commit():
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=script_dir, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_command(command, stdin_file=None, stdout_file=None):
+    # Run command to completion, and return its wall time in seconds and its peak RSS in kilobytes.
+    with open(stdin_file or os.devnull, 'rb') as stdin, open(stdout_file or os.devnull, 'wb') as stdout:
+        start_time = time.time()
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout, cwd=script_dir)
+        pid, status, rusage = os.wait4(process.pid, 0)
+        wall_time = time.time() - start_time
+    # The process has been waited for, Popen must not wait for it again.
+    process.returncode = status
+    if status != 0:
+        raise RuntimeError('{0} failed with status {1}'.format(' '.join(command), status))
+    return wall_time, get_rss_kb(rusage.ru_maxrss)
+
+
+def read_lines(file_name):
+    with open(file_name, 'rb') as file_in:
+        return [line.rstrip('\n') for line in file_in]
+
+
+def bench_uacheck_string(ua_file, log_file, jobs):
+    # uacheck_string on each UserAgent without the cache: the latency of classifying each one, and of each stage.
+    import uascan_lib
+    useragents = read_lines(ua_file)
+    ua_scanner = uascan_lib.UAscanner(cache_size=0, stats=True)
+    # Import user_agents before timing, its import is measured by the startup benchmarks.
+    ua_scanner.uacheck_string('Mozilla/5.0 (Windows NT 6.3) Firefox/36.0')
+    ua_scanner.stats_clear()
+    stages = ua_scanner.stats_stages.items()
+    stage_latencies = OrderedDict((stage, []) for stage, stage_stats in stages)
+    latencies = []
+    timer = time.time
+    start_time = timer()
+    for ua in useragents:
+        stage_before = [tuple(stage_stats) for stage, stage_stats in stages]
+        ua_start = timer()
+        ua_scanner.uacheck_string(ua)
+        latencies.append(timer() - ua_start)
+        for (stage, stage_stats), (calls, seconds) in zip(stages, stage_before):
+            if stage_stats[0] != calls:
+                stage_latencies[stage].append(stage_stats[1] - seconds)
+    wall_time = timer() - start_time
+    return OrderedDict([('lines', len(useragents)), ('seconds', wall_time),
+                        ('lines_per_sec', len(useragents) / wall_time),
+                        ('latency_us', get_percentiles(latencies)),
+                        ('stages', OrderedDict((stage, OrderedDict([('calls', len(stage_latency)),
+                                                                    ('seconds', sum(stage_latency)),
+                                                                    ('latency_us', get_percentiles(stage_latency))]))
+                                               for stage, stage_latency in stage_latencies.iteritems())),
+                        ('verdicts', dict((str(supported), count)
+                                          for supported, count in ua_scanner.stats_verdicts.iteritems()))])
+
+
+def bench_uacheck_string_cached(ua_file, log_file, jobs):
+    # uacheck_string on each UserAgent with the default cache, as app 2 does.
+    import uascan_lib
+    useragents = read_lines(ua_file)
+    ua_scanner = uascan_lib.UAscanner()
+    start_time = time.time()
+    for ua in useragents:
+        ua_scanner.uacheck_string(ua)
+    wall_time = time.time() - start_time
+    return OrderedDict([('lines', len(useragents)), ('seconds', wall_time),
+                        ('lines_per_sec', len(useragents) / wall_time), ('cache', ua_scanner.cache_stats())])
+
+
+def bench_uacheck_many(ua_file, log_file, jobs):
+    # The batch interface, with the default cache.
+    import uascan_lib
+    useragents = read_lines(ua_file)
+    ua_scanner = uascan_lib.UAscanner()
+    start_time = time.time()
+    for output in ua_scanner.uacheck_many(useragents):
+        pass
+    wall_time = time.time() - start_time
+    return OrderedDict([('lines', len(useragents)), ('seconds', wall_time),
+                        ('lines_per_sec', len(useragents) / wall_time), ('cache', ua_scanner.cache_stats())])
+
+
+def bench_normalize_cache(ua_file, log_file, jobs):
+    # uacheck_many with the default cache, without and with normalized cache keys, and their cache hit rates.
+    import uascan_lib
+    useragents = read_lines(ua_file)
+    results = OrderedDict()
+    for normalize_cache in (False, True):
+        ua_scanner = uascan_lib.UAscanner(normalize_cache=normalize_cache)
+        start_time = time.time()
+        for output in ua_scanner.uacheck_many(useragents):
+            pass
+        wall_time = time.time() - start_time
+        cache = ua_scanner.cache_stats()
+        results['normalized' if normalize_cache else 'exact'] = OrderedDict([
+            ('seconds', wall_time), ('lines_per_sec', len(useragents) / wall_time),
+            ('hit_rate', float(cache['hits'] + cache['normalized_hits']) / (cache['hits'] + cache['misses'])),
+            ('classified', cache['misses'] - cache['normalized_hits']), ('cache', cache)])
+    results['lines'] = len(useragents)
+    return results
+
+
+def bench_pool(ua_file, log_file, jobs):
+    # UAscannerPool.uacheck_many, including the start of the worker processes.
+    import resource
+    import uascan_lib
+    useragents = read_lines(ua_file)
+    start_time = time.time()
+    with uascan_lib.UAscannerPool(jobs=jobs) as ua_pool:
+        for ua, output in ua_pool.uacheck_many(useragents):
+            pass
+    wall_time = time.time() - start_time
+    return OrderedDict([('lines', len(useragents)), ('jobs', ua_pool.jobs), ('seconds', wall_time),
+                        ('lines_per_sec', len(useragents) / wall_time),
+                        ('worker_rss_peak_kb', get_rss_kb(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))])
+
+
+def bench_s3log(ua_file, log_file, jobs):
+    # Reading, splitting and scanning the S3 access log in process, as app 3 does.
+    import uascan_lib
+    import uascan_logs
+    ua_scanner = uascan_lib.UAscanner()
+    lines = 0
+    start_time = time.time()
+    for output in uascan_logs.scan_s3log(ua_scanner, uascan_logs.log_lines(log_file)):
+        lines += 1
+    wall_time = time.time() - start_time
+    return OrderedDict([('lines', lines), ('seconds', wall_time), ('lines_per_sec', lines / wall_time),
+                        ('cache', ua_scanner.cache_stats())])
+
+
+def bench_result_store(ua_file, log_file, jobs):
+    # Adding the results of the S3 access log to a UAresultStore, and aggregating it.
+    import uascan_lib
+    import uascan_logs
+    ua_scanner = uascan_lib.UAscanner()
+    log_entries = list(uascan_logs.classify_s3log(ua_scanner, uascan_logs.log_lines(log_file)))
+    ua_store = uascan_lib.UAresultStore()
+    # Import numpy before timing, as the first query would.
+    uascan_lib.load_numpy()
+    start_time = time.time()
+    ua_store.add_many(log_entries)
+    add_time = time.time() - start_time
+    query_times = OrderedDict()
+    for query_name, keys, supported in (('unsupported_by_bucket', ('bucket',), (2,)),
+                                        ('by_name', ('supported', 'name'), None),
+                                        ('by_bucket_ip', ('bucket', 'ip'), None)):
+        start_time = time.time()
+        ua_store.count_by(keys, supported)
+        query_times[query_name] = time.time() - start_time
+    return OrderedDict([('rows', len(ua_store)), ('add_seconds', add_time),
+                        ('rows_per_sec', len(ua_store) / add_time), ('numpy', uascan_lib.load_numpy() is not None),
+                        ('query_seconds', query_times)])
+
+
+# Benchmarks run in a new python process, with the UserAgent and S3 log corpus files and the number of jobs.
+process_benchmarks = OrderedDict([('uacheck_string', bench_uacheck_string),
+                                  ('uacheck_string_cached', bench_uacheck_string_cached),
+                                  ('uacheck_many', bench_uacheck_many),
+                                  ('normalize_cache', bench_normalize_cache),
+                                  ('pool', bench_pool),
+                                  ('s3log', bench_s3log),
+                                  ('result_store', bench_result_store)])
+
+# Benchmarks that run an application: its arguments, with {ua_file}, {log_file} and {jobs} replaced, and the
+# corpus file to pipe to it.
+app_benchmarks = OrderedDict([('app1', (['uascan_app1.py'], 'ua_file')),
+                              ('app2', (['uascan_app2.py', '{ua_file}'], None)),
+                              ('app2_jobs', (['uascan_app2.py', '-j', '{jobs}', '{ua_file}'], None)),
+                              ('app3', (['uascan_app3.py', '{log_file}'], None)),
+                              ('app3_jobs', (['uascan_app3.py', '-j', '{jobs}', '{log_file}'], None)),
+                              ('app3_summary', (['uascan_app3.py', '--summary', '{log_file}'], None))])
+
+# Startup benchmarks, run repeat times each.
+startup_benchmarks = OrderedDict([('startup_lib', ['-c', 'import uascan_lib; uascan_lib.UAscanner()']),
+                                  ('startup_app1', ['uascan_app1.py', 'aws-cli/1.7.36 Python/2.7.9 Darwin/14.4.0']),
+                                  ('startup_app1_browser', ['uascan_app1.py',
+                                                            'Mozilla/5.0 (Windows NT 6.3) Firefox/36.0'])])
+
+benchmark_names = list(startup_benchmarks) + list(process_benchmarks) + list(app_benchmarks)
+
+
+def run_benchmark(name, ua_file, log_file, jobs, repeat, lines):
+    # Return the results of the benchmark name, each of them run in a new process.
+    if name in startup_benchmarks:
+        runs = [run_command([sys.executable] + startup_benchmarks[name]) for run in xrange(repeat)]
+        wall_times = sorted(wall_time for wall_time, rss_kb in runs)
+        return OrderedDict([('runs', repeat), ('seconds_min', wall_times[0]),
+                            ('seconds_median', wall_times[len(wall_times) // 2]),
+                            ('rss_peak_kb', max(rss_kb for wall_time, rss_kb in runs))])
+
+    if name in process_benchmarks:
+        result_file = tempfile.NamedTemporaryFile(prefix='uascan_bench', suffix='.json', delete=False)
+        result_file.close()
+        try:
+            wall_time, rss_kb = run_command([sys.executable, os.path.abspath(__file__), '--run', name, ua_file,
+                                             log_file, str(jobs)], stdout_file=result_file.name)
+            with open(result_file.name, 'rb') as result_in:
+                result = json.load(result_in, object_pairs_hook=OrderedDict)
+        finally:
+            os.unlink(result_file.name)
+        result['process_seconds'] = wall_time
+        result['rss_peak_kb'] = rss_kb
+        return result
+
+    app_args, stdin_name = app_benchmarks[name]
+    corpus_files = {'ua_file': ua_file, 'log_file': log_file}
+    command = [sys.executable] + [arg.format(jobs=jobs, **corpus_files) for arg in app_args]
+    wall_time, rss_kb = run_command(command, stdin_file=corpus_files.get(stdin_name))
+    return OrderedDict([('lines', lines), ('seconds', wall_time), ('lines_per_sec', lines / wall_time),
+                        ('rss_peak_kb', rss_kb)])
+
+
+def get_metrics(results, prefix=''):
+    # Flatten the numeric results into dotted names, as in app3.lines_per_sec.
+    metrics = OrderedDict()
+    for key, value in results.iteritems():
+        if isinstance(value, dict):
+            metrics.update(get_metrics(value, '{0}{1}.'.format(prefix, key)))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            metrics['{0}{1}'.format(prefix, key)] = value
+    return metrics
+
+
+def compare_results(old_file, new_file):
+    # Yield a line for each metric of the benchmarks in both result files, with its change in percent.
+    results = []
+    for results_file in (old_file, new_file):
+        with open(results_file, 'rb') as results_in:
+            file_results = json.load(results_in, object_pairs_hook=OrderedDict)
+        if file_results.get('format') != results_format:
+            raise ValueError('{0} is not a version {1} benchmark result file'.format(results_file, results_format))
+        results.append(file_results)
+    old_metrics = get_metrics(results[0]['benchmarks'])
+    new_metrics = get_metrics(results[1]['benchmarks'])
+    yield 'Metric Old New Change'
+    for metric, new_value in new_metrics.iteritems():
+        old_value = old_metrics.get(metric)
+        if old_value is None:
+            continue
+        change = '{0:+.1f}%'.format((new_value - old_value) * 100.0 / old_value) if old_value else '-'
+        yield '{0} {1:.6g} {2:.6g} {3}'.format(metric, old_value, new_value, change)
+
+
+if __name__ == '__main__':
+    try:
+        # -n N / --count N       : Number of lines in the corpus, 20000 by default.
+        # -s N / --seed N        : Corpus random seed.
+        # -m M / --mix M         : Corpus mix, see uascan_corpus.py.
+        # -d N / --distinct N    : Number of distinct User Agents in the corpus.
+        # -j N / --jobs N        : Worker processes of the pool and --jobs benchmarks, one per core by default.
+        # -r N / --repeat N      : Number of runs of each startup benchmark, 5 by default.
+        # -b B / --benchmarks B  : Comma separated benchmarks to run, all of them by default.
+        # -o F / --output F      : Write the results to F instead of STDOUT.
+        # -c / --compare         : Compare the two result files given as arguments.
+        # --run                  : Run one process benchmark and write its result to STDOUT, used internally.
+        opts, args = getopt.getopt(sys.argv[1:], 'n:s:m:d:j:r:b:o:c', ['count=', 'seed=', 'mix=', 'distinct=',
+                                                                       'jobs=', 'repeat=', 'benchmarks=', 'output=',
+                                                                       'compare', 'run='])
+        import uascan_corpus
+        count = 20000
+        corpus_args = dict()
+        jobs = None
+        repeat = 5
+        benchmarks = benchmark_names
+        output_file = None
+        compare = False
+        run_name = None
+        for opt, val in opts:
+            if opt in ('-n', '--count'):
+                count = int(val)
+            elif opt in ('-s', '--seed'):
+                corpus_args['seed'] = int(val)
+            elif opt in ('-m', '--mix'):
+                corpus_args['mix'] = uascan_corpus.get_mix(val)
+            elif opt in ('-d', '--distinct'):
+                corpus_args['distinct'] = int(val)
+            elif opt in ('-j', '--jobs'):
+                jobs = int(val)
+            elif opt in ('-r', '--repeat'):
+                repeat = int(val)
+            elif opt in ('-b', '--benchmarks'):
+                benchmarks = val.split(',')
+                for name in benchmarks:
+                    if name not in benchmark_names:
+                        raise ValueError('Unknown benchmark {0}, the benchmarks are: {1}'.format(
+                            name, ', '.join(benchmark_names)))
+            elif opt in ('-o', '--output'):
+                output_file = val
+            elif opt in ('-c', '--compare'):
+                compare = True
+            elif opt == '--run':
+                run_name = val
+
+        if run_name is not None:
+            ua_file, log_file, jobs = args
+            json.dump(process_benchmarks[run_name](ua_file, log_file, int(jobs)), sys.stdout)
+            exit(0)
+
+        if compare:
+            if len(args) != 2:
+                raise ValueError('--compare takes two result files')
+            for output in compare_results(*args):
+                sys.stdout.write('{0}\n'.format(output))
+            exit(0)
+
+        if args:
+            sys.stderr.write('UserAgent SHA256 Compatibility Scanner - Benchmark\n'
+                             '==================================================\n'
+                             'Generate a corpus with uascan_corpus.py and measure the lines per second,\n'
+                             'latency percentiles, peak memory and startup time of the scanner and its\n'
+                             'applications. The results are written as JSON.\n\n'
+                             '    Example: {0} -o before.json\n'
+                             '             {0} --compare before.json after.json\n\n'
+                             'Options:\n'
+                             '    -n N, --count N     Number of lines in the corpus, 20000 by default\n'
+                             '    -s N, --seed N      Corpus random seed\n'
+                             '    -m M, --mix M       Corpus mix, see uascan_corpus.py\n'
+                             '    -d N, --distinct N  Number of distinct User Agents in the corpus\n'
+                             '    -j N, --jobs N      Worker processes, one per core by default\n'
+                             '    -r N, --repeat N    Runs of each startup benchmark, 5 by default\n'
+                             '    -b B, --benchmarks B\n'
+                             '                        Comma separated benchmarks, all by default:\n'
+                             '                        {1}\n'
+                             '    -o F, --output F    Write the results to F\n'
+                             '    -c, --compare       Compare two result files\n\n'.format(
+                                 sys.argv[0], ', '.join(benchmark_names)))
+            exit(1)
+
+        import multiprocessing
+        cpus = multiprocessing.cpu_count()
+        jobs = jobs or cpus
+        ua_corpus = uascan_corpus.UAcorpus(**corpus_args)
+        corpus_dir = tempfile.mkdtemp(prefix='uascan_bench')
+        try:
+            ua_file = os.path.join(corpus_dir, 'useragents.txt')
+            log_file = os.path.join(corpus_dir, 's3_access.log')
+            with open(ua_file, 'wb') as ua_out:
+                for ua in ua_corpus.useragents(count):
+                    ua_out.write('{0}\n'.format(ua))
+            with open(log_file, 'wb') as log_out:
+                for line in ua_corpus.s3log_lines(count):
+                    log_out.write('{0}\n'.format(line))
+
+            results = OrderedDict([('format', results_format), ('time', int(time.time())), ('commit', get_commit()),
+                                   ('python', platform.python_version()), ('platform', platform.platform()),
+                                   ('cpus', cpus),
+                                   ('corpus', OrderedDict([('count', count), ('seed', ua_corpus.seed),
+                                                           ('mix', ua_corpus.mix),
+                                                           ('distinct', ua_corpus.distinct),
+                                                           ('pathological_length', ua_corpus.pathological_length)])),
+                                   ('jobs', jobs),
+                                   ('benchmarks', OrderedDict())])
+            for name in benchmarks:
+                result = results['benchmarks'][name] = run_benchmark(name, ua_file, log_file, jobs, repeat, count)
+                sys.stderr.write('{0}: {1}\n'.format(name, ', '.join(
+                    '{0}={1:.6g}'.format(metric, value) for metric, value in get_metrics(result).iteritems()
+                    if metric in ('lines_per_sec', 'seconds_median', 'latency_us.p50', 'latency_us.p99',
+                                  'rss_peak_kb'))))
+        finally:
+            shutil.rmtree(corpus_dir)
+
+        if output_file is not None:
+            with open(output_file, 'wb') as results_out:
+                json.dump(results, results_out, indent=2)
+                results_out.write('\n')
+        else:
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+    except (getopt.GetoptError, ValueError, RuntimeError, IOError) as err:
+        # Unlike the applications, a benchmark cut short is an error.
+        sys.stderr.write('{0}\n'.format(err))
+        exit(1)
+    except KeyboardInterrupt:
+        exit(0)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+#   Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import sys
+import time
+import bisect
+import getopt
+import random
+from collections import OrderedDict
+
+""" Generate reproducible User Agent and S3 access log corpora for benchmarking the UAscanner.
+
+A corpus mixes AWS SDK, CLI and tool, bot, browser, null and pathological User Agents in set proportions. Like
+real logs, a corpus repeats a limited number of distinct User Agents, the most common ones far more often than the
+rest. The same seed and options always produce the same corpus.
+"""
+
+# Share of each category in a corpus, see get_mix
+corpus_mix = OrderedDict([('sdk', 50), ('cli', 12), ('bot', 6), ('browser', 25), ('null', 4), ('pathological', 3)])
+
+# Each template is filled with one random choice from each of its sequences.
+python_versions = ('2.6.6', '2.7.3', '2.7.6', '2.7.9', '2.7.10', '3.4.0', '3.4.3', '3.5.0')
+os_versions = ('Linux/2.6.32-504.el6.x86_64', 'Linux/3.13.0-48-generic', 'Linux/3.14.48-33.39.amzn1.x86_64',
+               'Linux/4.1.7-15.23.amzn1.x86_64', 'Darwin/13.4.0', 'Darwin/14.5.0', 'Windows/2003Server',
+               'Windows/7', 'Windows/8')
+java_os_versions = ('Linux/3.14.48-33.39.amzn1.x86_64', 'Linux/2.6.32-504.el6.x86_64', 'Mac_OS_X/10.10.1',
+                    'Windows_7/6.1', 'Windows_Server_2008_R2/6.1')
+java_vms = ('OpenJDK_64-Bit_Server_VM/24.79-b02/1.7.0_85', 'Java_HotSpot(TM)_64-Bit_Server_VM/25.25-b02/1.8.0_25',
+            'Java_HotSpot(TM)_64-Bit_Server_VM/20.45-b01/1.6.0_45', 'Java_HotSpot(TM)_Client_VM/1.5.0_22-b03/1.5.0_22',
+            'OpenJDK_64-Bit_Server_VM/23.25-b01/1.7.0_25', 'IBM_J9_VM/2.6/1.6.0')
+
+corpus_templates = {
+    'sdk': (
+        ('Boto/2.{0}.{1} Python/{2} {3}', (xrange(20, 39), xrange(0, 4), python_versions, os_versions)),
+        ('Boto3/1.{0}.{1} Python/{2} {3} Botocore/1.{4}.{5}',
+         (xrange(0, 3), xrange(0, 10), python_versions, os_versions, xrange(0, 3), xrange(0, 12))),
+        ('aws-sdk-java/1.{0}.{1} {2} {3} {4}',
+         (xrange(3, 11), xrange(0, 30), java_os_versions, java_vms, ('en_US', 'de_DE', 'ja_JP', 'fr_FR'))),
+        ('aws-sdk-java/1.{0}.{1} {2} {3}', (xrange(3, 11), xrange(0, 30), java_os_versions, java_vms)),
+        ('aws-sdk-android/2.{0}.{1} Linux/3.4.0-perf-g{2:07x} Dalvik/{3}/0 en_US',
+         (xrange(0, 3), xrange(0, 10), xrange(0, 1 << 28), ('1.4.0', '1.6.0', '2.1.0'))),
+        ('aws-sdk-iOS/2.{0}.{1} iPhone-OS/{2}.{3} en_US', (xrange(0, 3), xrange(0, 10), xrange(6, 10), xrange(0, 5))),
+        ('aws-sdk-ruby2/2.{0}.{1} ruby/2.{2}.{3} x86_64-linux',
+         (xrange(0, 2), xrange(0, 30), xrange(0, 3), xrange(0, 6))),
+        ('aws-sdk-php2/2.8.{0} Guzzle/3.9.3 curl/7.{1}.0 PHP/5.{2}.9-1ubuntu4.{3}',
+         (xrange(0, 25), xrange(19, 44), xrange(3, 7), xrange(0, 14))),
+        ('aws-sdk-dotnet-45/2.3.{0}.{1} .NET Runtime/4.0 .NET Framework/4.0 OS/6.{2}.{3}.0 ',
+         (xrange(0, 60), xrange(0, 5), xrange(1, 4), (7601, 9200, 9600))),
+        ('aws-sdk-go/1.{0}.{1} (go1.{2}; linux; amd64)', (xrange(0, 2), xrange(0, 15), xrange(4, 6))),
+        ('aws-sdk-nodejs/2.{0}.{1} linux/v0.{2}.{3}', (xrange(1, 3), xrange(0, 60), (10, 12), xrange(0, 8))),
+        ('aws-sdk-js/2.{0}.{1}', (xrange(1, 3), xrange(0, 60))),
+        ('JetS3t/0.{0}.{1} (Linux/3.13.0-48-generic; amd64; en; JVM 1.{2}.0_{3})',
+         (xrange(7, 10), xrange(0, 5), xrange(6, 9), xrange(20, 80))),
+        ('{0:08x}-{1:04x}-{2:04x}-{3:04x}-{4:012x} aws-internal/3',
+         (xrange(0, 1 << 32), xrange(0, 1 << 16), xrange(0, 1 << 16), xrange(0, 1 << 16), xrange(0, 1 << 48))),
+    ),
+    'cli': (
+        ('aws-cli/1.{0}.{1} Python/{2} {3}', (xrange(2, 9), xrange(0, 40), python_versions, os_versions)),
+        ('aws-cli/1.{0}.{1} Python/{2} {3} botocore/1.{4}.{5}',
+         (xrange(7, 9), xrange(0, 40), python_versions, os_versions, xrange(0, 3), xrange(0, 12))),
+        ('S3 Browser {0}-{1}-{2} http://s3browser.com', (xrange(4, 6), xrange(0, 10), xrange(0, 10))),
+        ('CloudBerryLab.Base.HttpUtil.Client {0}.{1}.{2} (http://www.cloudberrylab.com/)',
+         (xrange(3, 5), xrange(0, 9), xrange(0, 9))),
+        ('S3Console/0.{0}', (xrange(1, 5),)),
+    ),
+    'bot': (
+        ('Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)', ()),
+        ('Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)', ()),
+        ('Googlebot-Image/1.0', ()),
+        ('AdsBot-Google (+http://www.google.com/adsbot.html)', ()),
+        ('LinkedInBot/1.0 (compatible; Mozilla/5.0; Jakarta Commons-HttpClient/3.1 +http://www.linkedin.com)', ()),
+        ('facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)', ()),
+        ('Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)', ()),
+        ('Slack-ImgProxy 0.{0} (+https://api.slack.com/robots)', (xrange(10, 60),)),
+        ('Amazon CloudFront', ()),
+    ),
+    'browser': (
+        ('Mozilla/5.0 (Windows NT {0}; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{1}.0.{2}.{3} '
+         'Safari/537.36', (('5.1', '6.1', '6.3', '10.0'), xrange(26, 47), xrange(1500, 2500), xrange(0, 160))),
+        ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{0}.0.{1}.{2} Safari/537.36',
+         (xrange(26, 47), xrange(1500, 2500), xrange(0, 160))),
+        ('Mozilla/5.0 (Windows NT {0}; rv:{1}.0) Gecko/20100101 Firefox/{1}.0', (('5.1', '6.1', '6.3'), xrange(3, 42))),
+        ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_{0}_{1}) AppleWebKit/600.8.9 (KHTML, like Gecko) Version/{2}.0 '
+         'Safari/600.8.9', (xrange(4, 12), xrange(0, 6), xrange(4, 10))),
+        ('Mozilla/5.0 (iPhone; CPU iPhone OS {0}_{1} like Mac OS X) AppleWebKit/600.1.4 (KHTML, like Gecko) '
+         'Version/{0}.0 Mobile/12H143 Safari/600.1.4', (xrange(3, 10), xrange(0, 4))),
+        ('Mozilla/5.0 (Linux; Android {0}.{1}; SM-G900F Build/KOT49H) AppleWebKit/537.36 (KHTML, like Gecko) '
+         'Chrome/{2}.0.2403.133 Mobile Safari/537.36', (xrange(2, 6), xrange(0, 5), xrange(30, 47))),
+        ('Mozilla/4.0 (compatible; MSIE {0}.0; Windows NT {1})', (xrange(5, 9), ('5.0', '5.1', '6.0', '6.1'))),
+        ('Mozilla/5.0 (compatible; MSIE {0}.0; Windows NT 6.{1}; Trident/{2}.0)', (xrange(9, 11), xrange(0, 3),
+                                                                                 xrange(5, 7))),
+    ),
+    'null': (
+        ('', ()), ('-', ()), ('null', ()), ('(null)', ()), ('[null]', ()), ('{{null}}', ()),
+    ),
+}
+
+
+def get_mix(mix_string):
+    # Parse a mix given as category=weight pairs separated by commas, as in 'sdk=80,browser=20'.
+    mix = OrderedDict()
+    for category_weight in mix_string.split(','):
+        category, separator, weight = category_weight.partition('=')
+        if category not in corpus_mix or not separator:
+            raise ValueError('Invalid corpus mix {0!r}, expected category=weight pairs of: {1}'.format(
+                mix_string, ', '.join(corpus_mix)))
+        try:
+            mix[category] = float(weight)
+        except ValueError:
+            raise ValueError('Invalid weight {0!r} for {1} in the corpus mix'.format(weight, category))
+    if sum(mix.itervalues()) <= 0:
+        raise ValueError('The corpus mix {0!r} has no weight'.format(mix_string))
+    return mix
+
+
+def weighted_choice(rng, cumulative_weights):
+    return bisect.bisect_right(cumulative_weights, rng.random() * cumulative_weights[-1])
+
+
+class UAcorpus(object):
+    # A reproducible corpus of count User Agents, drawn from distinct ones with a Zipf distribution: the n-th most
+    # common appears about 1/n as often as the most common. distinct=0 makes every User Agent a new one.
+    # Pathological User Agents are those of UAscanner.get_pathological_uas, up to pathological_length characters.
+    # Without hardened=True the scanner's time on them grows steeply with length, the default keeps it bounded.
+
+    def __init__(self, seed=0, mix=None, distinct=2000, pathological_length=48, zipf_exponent=1.1):
+        self.seed = seed
+        self.mix = mix or corpus_mix
+        self.distinct = distinct
+        self.pathological_length = pathological_length
+        self.zipf_exponent = zipf_exponent
+        self.categories = [category for category, weight in self.mix.iteritems() if weight > 0]
+        self.category_weights = self.get_cumulative(self.mix[category] for category in self.categories)
+        self.pathological_uas = None
+
+    @staticmethod
+    def get_cumulative(weights):
+        cumulative = []
+        total = 0
+        for weight in weights:
+            total += weight
+            cumulative.append(total)
+        return cumulative
+
+    def get_pathological_ua(self, rng):
+        if self.pathological_uas is None:
+            import uascan_lib
+            # Only the variants ending in a NUL, the others end in a newline and could not be written one per line.
+            self.pathological_uas = [ua for ua in uascan_lib.UAscanner.get_pathological_uas(self.pathological_length)
+                                     if ua.endswith('\x00')]
+        ua = rng.choice(self.pathological_uas)
+        return ua[:rng.randint(len(ua) // 2, len(ua) - 1)] + '\x00'
+
+    def get_ua(self, rng):
+        # Return a new random User Agent of a random category.
+        category = self.categories[weighted_choice(rng, self.category_weights)]
+        if category == 'pathological':
+            return self.get_pathological_ua(rng)
+        template, choices = rng.choice(corpus_templates[category])
+        return template.format(*[rng.choice(choice) for choice in choices])
+
+    def useragents(self, count):
+        # Generator yielding count User Agents.
+        rng = random.Random(self.seed)
+        if not self.distinct:
+            for line_number in xrange(count):
+                yield self.get_ua(rng)
+            return
+
+        ua_pool = [self.get_ua(rng) for ua_number in xrange(self.distinct)]
+        ua_weights = self.get_cumulative(1.0 / (rank ** self.zipf_exponent) for rank in xrange(1, self.distinct + 1))
+        for line_number in xrange(count):
+            yield ua_pool[weighted_choice(rng, ua_weights)]
+
+    def s3log_lines(self, count, buckets=5, ips=200, start_time=1444435200):
+        # Generator yielding count S3 access log lines, one per User Agent of useragents(count).
+        rng = random.Random(self.seed + (1 << 32))
+        owner = '79a59df900b949e55d96a1e698fbacedfd6e09d98eacf8f8d5218e7cd47ef2be'
+        bucket_names = ['bucket-{0:02d}'.format(bucket) for bucket in xrange(buckets)]
+        ip_addresses = ['10.{0}.{1}.{2}'.format(rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+                        for ip in xrange(ips)]
+        operations = (('REST.GET.OBJECT', 'GET', 200), ('REST.PUT.OBJECT', 'PUT', 200),
+                      ('REST.HEAD.OBJECT', 'HEAD', 200), ('REST.GET.BUCKET', 'GET', 200),
+                      ('REST.GET.OBJECT', 'GET', 404), ('REST.GET.OBJECT', 'GET', 304))
+        log_time = start_time
+        for ua in self.useragents(count):
+            log_time += rng.randint(0, 2)
+            bucket = rng.choice(bucket_names)
+            operation, method, status = rng.choice(operations)
+            key = 'data/{0:06d}.json'.format(rng.randint(0, 999999))
+            object_size = rng.randint(100, 1 << 20)
+            yield ('{0} {1} [{2} +0000] {3} {0} {4:016X} {5} {6} "{7} /{1}/{6} HTTP/1.1" {8} - {9} {10} {11} {12} '
+                   '"-" "{13}" -'.format(owner, bucket, time.strftime('%d/%b/%Y:%H:%M:%S', time.gmtime(log_time)),
+                                         rng.choice(ip_addresses), rng.randint(0, (1 << 64) - 1), operation, key,
+                                         method, status, object_size if status == 200 else '-', object_size,
+                                         rng.randint(5, 500), rng.randint(1, 50), ua))
+
+
+if __name__ == '__main__':
+    try:
+        # -n N / --count N       : Number of lines to generate, 10000 by default.
+        # -s N / --seed N        : Random seed, the same seed and options give the same corpus.
+        # -m M / --mix M         : Share of each category, as in sdk=50,cli=12,bot=6,browser=25,null=4,pathological=3
+        # -d N / --distinct N    : Number of distinct User Agents, 0 for a new one on every line.
+        # -p N / --pathological-length N : Maximum length of the pathological User Agents.
+        # -l / --s3log           : Output S3 access log lines instead of one User Agent per line.
+        opts, args = getopt.getopt(sys.argv[1:], 'n:s:m:d:p:l', ['count=', 'seed=', 'mix=', 'distinct=',
+                                                                 'pathological-length=', 's3log'])
+        count = 10000
+        corpus_args = dict()
+        s3log = False
+        for opt, val in opts:
+            if opt in ('-n', '--count'):
+                count = int(val)
+            elif opt in ('-s', '--seed'):
+                corpus_args['seed'] = int(val)
+            elif opt in ('-m', '--mix'):
+                corpus_args['mix'] = get_mix(val)
+            elif opt in ('-d', '--distinct'):
+                corpus_args['distinct'] = int(val)
+            elif opt in ('-p', '--pathological-length'):
+                corpus_args['pathological_length'] = int(val)
+            elif opt in ('-l', '--s3log'):
+                s3log = True
+
+        if args:
+            sys.stderr.write('UserAgent SHA256 Compatibility Scanner - Benchmark Corpus Generator\n'
+                             '===================================================================\n'
+                             'Write a reproducible mix of AWS SDK, CLI, bot, browser, null and pathological\n'
+                             'User Agents to STDOUT, one per line or wrapped in S3 access log lines.\n\n'
+                             '    Example: {0} -n 100000 --s3log > s3_access.log\n\n'
+                             'Options:\n'
+                             '    -n N, --count N     Number of lines, 10000 by default\n'
+                             '    -s N, --seed N      Random seed, 0 by default\n'
+                             '    -m M, --mix M       Share of each category, by default:\n'
+                             '                        {1}\n'
+                             '    -d N, --distinct N  Number of distinct User Agents, 2000 by default\n'
+                             '    -p N, --pathological-length N\n'
+                             '                        Maximum length of pathological User Agents, 48 by default\n'
+                             '    -l, --s3log         Output S3 access log lines\n\n'.format(
+                                 sys.argv[0], ','.join('{0}={1}'.format(*mix) for mix in corpus_mix.iteritems())))
+            exit(1)
+
+        ua_corpus = UAcorpus(**corpus_args)
+        corpus_lines = ua_corpus.s3log_lines(count) if s3log else ua_corpus.useragents(count)
+        for line in corpus_lines:
+            sys.stdout.write('{0}\n'.format(line))
+    except (getopt.GetoptError, ValueError) as err:
+        sys.stderr.write('{0}\n'.format(err))
+        exit(1)
+    except IOError:
+        # Output cut short, as in: uascan_corpus.py | head -n 2
+        exit(0)
+    except KeyboardInterrupt:
+        exit(0)
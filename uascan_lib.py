@@ -18,9 +18,16 @@ import re
 import os
 import sys
 import time
+import array
 import logging
-import urllib
-import user_agents
+import urlparse
+import Queue
+import cPickle
+import hashlib
+import operator
+import itertools
+import traceback
+from collections import OrderedDict, namedtuple
 
 """ Take a UserAgent string and test if it may support SHA256, and output the result as a integer between 0 and 2.
 
@@ -33,16 +40,85 @@ Valid Output: 0 - Supported, 1 - Support Unknown, 2 - Not Supported
 
 """
 
+# The result of classifying a single UserAgent.
+#     supported       : 0 - Supported, 1 - Support Unknown, 2 - Not Supported
+#     name            : Short descriptor of the UserAgent, as output by uacheck_string
+#     identified      : True if both the OS and the Browser were identified (always True for our own regexes)
+#     os_name/os_version/browser_name/browser_version : What we identified, None when unavailable
+#     ua_string       : The UserAgent string after URL decoding
+UAresult = namedtuple('UAresult', ['supported', 'name', 'identified', 'os_name', 'os_version', 'browser_name',
+                                   'browser_version', 'ua_string'])
 
-class UAscanner(object):
+# Importing user_agents compiles all of ua-parser's regexes, which takes longer than the rest of our startup.
+# It is imported by load_user_agents once the first UserAgent falls through our own regexes.
+user_agents = None
+
+
+def load_user_agents():
+    global user_agents
+    if user_agents is None:
+        import user_agents
+    return user_agents
+
+
+# NumPy is optional, UAresultStore aggregates with it when it is installed. It is imported by load_numpy on the
+# first query, as its import takes longer than the rest of our startup. False once it was found missing.
+numpy = None
+
+
+def load_numpy():
+    # Return the numpy module, or None when it is not installed.
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+
+def unquote_plus(ua):
+    # Same as urllib.unquote_plus, without importing urllib which pulls in socket and ssl.
+    return urlparse.unquote(ua.replace('+', ' '))
 
-    def __init__(self, debug=False, debug_version=False, debug_handle_stream=True, verbose=0, identify_unknown=False):
+
+class UAscanner(object):
+    # test_version_test only exercises our code, it is run by the first UAscanner created in each process.
+    version_test_passed = False
+    # Occurrences of its literal a hardened regex is matched at, see match_anchored.
+    anchor_attempts = 4
+    # UserAgents whose stats_rules key is remembered with stats, they are forgotten all at once past this many.
+    stats_ua_rules_size = 100000
+
+    def __init__(self, debug=False, debug_version=False, debug_handle_stream=True, verbose=0, identify_unknown=False,
+                 cache_size=10000, hardened=False, max_ua_length=None, truncate_ua=False, persistent_cache=None,
+                 ua_regex_bundle=None, stats=False, normalize_cache=True):
         self.debug = debug
         self.verbose = verbose
         self.debug_version = debug_version
         self.identify_unknown = identify_unknown
         self.nullagents = ('', 'null', '(null)', '[null]', '{null}')
 
+        # Results from uacheck_string are kept in an LRU cache keyed by the raw UserAgent string.
+        # Log files typically repeat a small number of distinct UserAgents, set cache_size to 0 or None to disable.
+        self.cache_size = cache_size
+        self.ua_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        # UserAgents that only differ by fields our verdicts never read share a cache entry, see normalize_ua.
+        self.normalize_cache = normalize_cache
+        self.normalized_hits = 0
+        self.normalized_misses = 0
+
+        # Hardened mode uses the backtracking safe regexes and limits the length of the UserAgents we will scan.
+        # UserAgents longer than max_ua_length are reported as unknown, or cut down to max_ua_length if truncate_ua.
+        self.hardened = hardened
+        if hardened and max_ua_length is None:
+            max_ua_length = 1024
+        self.max_ua_length = max_ua_length
+        self.truncate_ua = truncate_ua
+
         self.logger = logging.getLogger('UAScanner')
         self.logger.setLevel(logging.DEBUG)
         self.logger.addHandler(logging.NullHandler())
@@ -59,6 +135,9 @@ class UAscanner(object):
                 my_logger_stream.setLevel(logging.ERROR)
             my_logger_stream.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
             self.logger.addHandler(my_logger_stream)
+        # Debug messages are only formatted when they may be output: when debug is requested, or when the
+        # application manages the debug output stream.
+        self.debug_logging = debug is True or debug_handle_stream is not True
 
         self.useragents_support_unsupported = []
         # These are supported applications, CDNs, and bot's that we created regexs to identify.
@@ -123,161 +202,365 @@ class UAscanner(object):
         self.ua_support_true = 0
         self.ua_support_unknown = 1
         self.ua_support_false = 2
-        self.ua_regexs = self.get_regexs()
-        if not self.test_version_test():
-            self.logger.error("VERSION CHECK TEST FAILED....ABORTING...")
-            exit(1)
+
+        # Parsed version tuples, the minimum versions we compare against are parsed once here.
+        self.version_cache_size = 10000
+        self.version_cache = dict()
+        self.version_thresholds = dict()
+        for threshold in [self.vm_mvr_java, self.vm_mvr_hotspot, self.vm_mvr_dalvik, self.os_mvr_windowsphone,
+                          self.os_mvr_macosx, self.os_mvr_ios, self.os_mvr_android, self.os_mvr_blackberryos,
+                          self.os_mvr_blackberrytabletos, self.os_mvr_linux2, self.os_mvr_linux3, self.os_mvr_linux4]:
+            self.version_thresholds[threshold] = self.parse_version(threshold)
+
+        # The verdict rules of get_ua_supported_status, as (families, rule, threshold) entries: each family is
+        # decided by the method <kind>_rule_<rule> with the threshold. Where a family is listed more than once the
+        # first entry applies. set_rules compiles them into dispatch dicts, see compile_rules.
+        # Our regexs, by name
+        app_rules = [
+            (['aws-sdk-java'], 'java', None),
+            (['aws-sdk-android'], 'dalvik', self.vm_mvr_dalvik),
+            (['aws-sdk-iOS'], 'os_version', {'iPhone-OS': self.os_mvr_ios}),
+            (self.useragents_support_supported, 'support', self.ua_support_true),
+            (self.useragents_support_unsupported, 'support', self.ua_support_false)]
+        # Java VMs of aws-sdk-java and aws-sdk-android, by name
+        vm_rules = [
+            (self.vms_java, 'java_ver', self.vm_mvr_java),
+            (self.vms_hotspot, 'java_vm_ver', self.vm_mvr_hotspot),
+            (self.vms_dalvik, 'dalvik', self.vm_mvr_dalvik)]
+        # Operating systems, by ua-parser os family
+        os_rules = [
+            # XP is unknown without the SP info. 'NT' '2000' has always been one string.
+            (['Windows'], 'major_version', {'supported': ['7', '8', 'RT', 'Vista', '10'],
+                                            'unsupported': ['3', '95', '98', 'CE', 'ME', 'NT' '2000']}),
+            (['Windows Phone'], 'version', self.os_mvr_windowsphone),
+            (['Mac OS X'], 'version', self.os_mvr_macosx),
+            (['iOS'], 'version', self.os_mvr_ios),
+            (['Android'], 'version', self.os_mvr_android),
+            (['BlackBerry OS'], 'version', self.os_mvr_blackberryos),
+            (['BlackBerry Tablet OS'], 'version', self.os_mvr_blackberrytabletos),
+            (['Chrome OS'], 'support', self.ua_support_true),
+            (['webOS', 'Symbian'], 'support', self.ua_support_false),
+            # We can not identify if Linux is truly supported due to it's reliance on OpenSSL,
+            # and the ability to update the kernel independantly of the rest of the distribution.
+            (['Linux'], 'support', self.ua_support_unknown)]
+        # Browsers, by ua-parser browser family. Browsers we do not know about are unknown, and only their OS
+        # decides. This is only to maintain this list: browsers_unknown = ['Lunascape', 'Lynx']
+        browser_rules = [
+            # Applications that are independent of the OS for support, or where the version of the application
+            # depends on a specific version of the OS.
+            (self.browser_depends_on_os, 'os', None),
+            # We'll assume various major Web Bots will be supported.
+            (self.useragents_support_supported_bots, 'support', self.ua_support_true),
+            # Seamonkey uses Mozilla NSS for SSL. Seamonkey's first version was in 2006.
+            # NSS 3.8+ is SHA256 Certificate Compatible was released in 2003.
+            (['SeaMonkey'], 'support', self.ua_support_true),
+            # 7.1 or higher supports SHA256, relies on NSS
+            (['Netscape'], 'version', '7.1'),
+            # These are used by Apps running on and using Apple OS's built in Web calls
+            (['Edge', 'CFNetwork'], 'same_as_os', None),
+            # Firefox and Mozilla use Mozilla NSS for SSL, Firefox 1.0+ uses NSS 3.8+
+            # NSS 3.8+ is SHA256 Certificate Compatible
+            (self.firefox_browsers, 'version', '1.5'),
+            (['Thunderbird'], 'version', '5'),
+            (['BlackBerry'], 'blackberry', {
+                'supported': ['8520', '8530', '8900', '8910', '8980', '9000', '9700', '9650', '9630', '9520', '9550',
+                              '9500', '9530', '9780', '9788', '9100', '9105', '9670', '9300', '9330', '9800', '9320',
+                              '9220', '9350', '9360', '9370', '9380', '9850', '9860', '9810', '9981', '9720', '9900',
+                              '9930', '9790'],
+                'unsupported': ['7100', '7250', '8100', '8310', '8320', '8800', '8820', '8830', '8100', '8110', '8120',
+                                '8130', '8220', '8230', '8300', '8310', '8320', '8330', '8350', '7200', '7500', '7700',
+                                '5000', '6000', '850', '857', '950', '957']}),
+            # From here on the browser and its OS are supported as a package, see is_supported.
+            (['Android'], 'os_version_with_os', '2.3'),
+            (['Outlook'], 'os_version_with_os', '2003'),
+            (['Opera'], 'version_with_os', '6'),
+            # 3.5.6 or higher supports SHA256, relies on OpenSSL
+            (['Konqueror'], 'version_with_os', '3.5.6'),
+            (['Safari', 'Mobile Safari'], 'version_with_os', '3'),
+            (['IE', 'IE Mobile'], 'version_with_os', '6'),
+            # Chrome 0-37 depends on OS, 38+ is independent of OS
+            (self.chrome_browsers, 'chrome', '38')]
+        self.set_rules(app_rules, vm_rules, os_rules, browser_rules)
+
+        self.ua_regexs = self.get_regexs(hardened)
+        self.ua_prefilter, self.ua_prefilter_index, self.ua_prefilter_always = self.get_prefilter(self.ua_regexs)
+
+        # Fields some of our regexs capture that get_ua_supported_status never reads, and that make UserAgents
+        # otherwise the same distinct: the GUID of aws-internal, the locale of aws-sdk-java and aws-sdk-android (it
+        # ends up in java_ver, where parse_version drops it) and the detail of aws-sdk-php. Each entry is the name of
+        # our regexs, a regex matching the whole of such a UserAgent strictly enough that they capture the same
+        # fields with and without them, and the replacement that removes them. See normalize_ua.
+        self.ua_normalizers = [
+            ('aws-internal', re.compile(r'^[0-9A-Fa-f]{8}(?:-[0-9A-Fa-f]{4}){3}-[0-9A-Fa-f]{12}'
+                                        r'\s+(aws-internal/\S*)\Z'), r'\1'),
+            ('aws-sdk-java', re.compile(r'^(aws-sdk-java/[^\s/]+ [^\s/]+/[^\s/]+ [^\s/]+/[^\s/]+/[0-9][0-9._]*[0-9])'
+                                        r' [a-z]{2}_[A-Z]{2}\Z'), r'\1'),
+            ('aws-sdk-android', re.compile(r'^(aws-sdk-android/[^\s/]+ [^\s/]+/[^\s/]+ [^\s/]+/[^\s/]+/\w+)'
+                                           r' [a-z]{2}_[A-Z]{2}\Z'), r'\1'),
+            ('aws-sdk-php', re.compile(r'^(aws-sdk-php/\S*)\s[^\n]*\Z'), r'\1 '),
+            ('aws-sdk-php2', re.compile(r'^(aws-sdk-php2/\S*)\s[^\n]*\Z'), r'\1 ')]
+
+        # ua-parser's regexes can be pinned to a bundle built by uascan_regexes.py, which also loads much faster
+        # than the installed ua-parser's. ua-parser's tables are global, this affects every UAscanner in the process.
+        self.ua_regex_version = None
+        if ua_regex_bundle is not None:
+            import uascan_regexes
+            self.ua_regex_version = uascan_regexes.install_bundle_file(ua_regex_bundle)
+
+        # Results can also be kept across runs in an SQLite file, shared by every process given the same path.
+        # Its entries are keyed by get_fingerprint, so a change to the rules never returns a stale result.
+        self.persistent_cache = None
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+        if persistent_cache is not None:
+            self.persistent_cache_open(persistent_cache)
+        if not UAscanner.version_test_passed:
+            if not self.test_version_test():
+                self.logger.error("VERSION CHECK TEST FAILED....ABORTING...")
+                exit(1)
+            UAscanner.version_test_passed = True
+
+        # Per stage timings and call counts, hits of each of our regexs and counts of each verdict, see stats_dict.
+        # Stage times are collected by wrapping the stage methods of this instance, rules and verdicts are counted
+        # for each result classify returns, cached or not. Without stats nothing is wrapped or counted and scanning
+        # costs what it always did.
+        self.stats = stats
+        self.stats_stages = OrderedDict()
+        self.stats_rules = OrderedDict()
+        self.stats_verdicts = dict()
+        # The stats_rules key of each decoded UserAgent test_ua has seen, see stats_count.
+        self.stats_ua_rules = dict()
+        if stats:
+            self.stats_enable()
 
     @staticmethod
-    def get_regexs():
+    def get_regexs(hardened=False):
         # Here we will load up known regexes for apps not known by the browser ua lib.
+        # Entries with a 'regex_hardened' also carry an equivalent for well formed UserAgents that replaces the
+        # chained greedy (.*) groups with delimited token classes, and is used instead of 'regex' when hardened is
+        # requested. Instead of a leading .* it has an 'anchor': it is only matched at the 'first' or 'last'
+        # occurrence of its literal on the first line of the UA, where the lazy or greedy .* would place it. Neither
+        # can backtrack super-linearly on junk input.
         ua_regex_list = list()
 
         # AWS SDKs
         ua_regex_list.append({
             'name': 'Boto',
+            'literal': 'Boto/',
             'regex': re.compile(r'^.*(Boto)\/(.*)\s+(.*)\/(.*)\s+(.*)\/(.*)$'),
+            'regex_hardened': re.compile(r'(Boto)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^\s/]*)\/(.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'vm': 2, 'vm_ver': 3, 'os': 4, 'os_ver': 5}
         })
         ua_regex_list.append({
             'name': 'Boto3',
+            'literal': 'Boto3/',
             'regex': re.compile(r'^.*(Boto3)\/(.*)\s+(.*)\/(.*)\s+(.*)\/(.*)$'),
+            'regex_hardened': re.compile(r'(Boto3)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^\s/]*)\/(.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'vm': 2, 'vm_ver': 3, 'os': 4, 'os_ver': 5}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-android',
+            'literal': 'aws-sdk-android/',
             'regex': re.compile(r'^.*(aws-sdk-android)\/(.*)\s+(.*)\/(.*)\s+(.*)\/(.*)\/(\w*)(?=(?=\s((?:[a-zA-Z][a-zA-Z]*))(?=_((?:[a-zA-Z][a-zA-Z]*)))?)?).*$'),
+            'regex_hardened': re.compile(r'(aws-sdk-android)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^\s/]*)\/([^\s/]*)\/(?=.*$)(\w*)(?=(?=\s((?:[a-zA-Z][a-zA-Z]*))(?=_((?:[a-zA-Z][a-zA-Z]*)))?)?).*$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'os': 2, 'os_ver': 3, 'java_vm': 4, 'java_vm_ver': 5, 'java_ver': 6,
                        'lang': 7, 'region': 8}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-android',
+            'literal': 'aws-sdk-android/',
             'regex': re.compile(r'^.*(aws-sdk-android)\/(.*)\s+(.*)\/(.*)\s+(.*)\/(.*)\s+(.*).*$'),
+            'regex_hardened': re.compile(r'(aws-sdk-android)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^\s/]*)\/(\S*)\s+(.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'os': 2, 'os_ver': 3, 'java_vm': 4, 'java_vm_ver': 5, 'lang': 6}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-java',
+            'literal': 'aws-sdk-java/',
             'regex': re.compile(r'^.*(aws-sdk-java)\/(.*)\s+(.*)\/(.*)\s+(.*)\/(.*)\/(.*)\s+(.*)\/(.*).*$'),
+            'regex_hardened': re.compile(r'(aws-sdk-java)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^\s/]*)\/([^\s/]*)\/(\S*(?:\s+[^\s/]+)*?)\s+([^\s/]*)\/(.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'os': 2, 'os_ver': 3, 'java_vm': 4, 'java_vm_ver': 5, 'java_ver': 6,
                        'app': 7, 'app_ver': 8}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-java',
+            'literal': 'aws-sdk-java/',
             'regex': re.compile(r'^.*(aws-sdk-java)\/(.*)\s+(.*)\/(.*)\s+(.*)\/(.*)\/(.*)?(?=(?=\s((?:[a-zA-Z][a-zA-Z]*))(?=_((?:[a-zA-Z][a-zA-Z]*)))?)?).*$'),
+            'regex_hardened': re.compile(r'(aws-sdk-java)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^\s/]*)\/([^\s/]*)\/(.*)?(?=(?=\s((?:[a-zA-Z][a-zA-Z]*))(?=_((?:[a-zA-Z][a-zA-Z]*)))?)?)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'os': 2, 'os_ver': 3, 'java_vm': 4, 'java_vm_ver': 5, 'java_ver': 6,
                        'lang': 7, 'region': 8}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-java',
+            'literal': 'aws-sdk-java/',
             'regex': re.compile(r'^.*(aws-sdk-java)\/(.*)\s+(.*)\/(.*)\s+(.*)\/(.*).*$'),
+            'regex_hardened': re.compile(r'(aws-sdk-java)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^\s/]*)\/(.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'os': 2, 'os_ver': 3, 'java_vm': 4, 'java_vm_ver': 5}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-iOS',
+            'literal': 'aws-sdk-iOS/',
             'regex': re.compile(r'^.*(aws-sdk-iOS)\/(.*)\s+(.*)\/(.*)\s+(.*?)[_\s{0,1}].*?(.*?)$'),
+            'regex_hardened': re.compile(r'(aws-sdk-iOS)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^_\s{0,1}\n]*)[_\s{0,1}](.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'os': 2, 'os_ver': 3, 'lang': 4, 'region': 5}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-iOS',
+            'literal': 'aws-sdk-iOS/',
             'regex': re.compile(r'^.*(aws-sdk-iOS)\/(.*)\s+(.*)\/(.*)$'),
+            'regex_hardened': re.compile(r'(aws-sdk-iOS)\/(\S*)\s+([^\s/]*)\/(.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'os': 2, 'os_ver': 3}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-ruby2',
+            'literal': 'aws-sdk-ruby2/',
             'regex': re.compile(r'^.*?(aws-sdk-ruby2)\/(.*?)\s+(.*?)\/(.*?).*?$'),
+            'regex_hardened': re.compile(r'(aws-sdk-ruby2)\/(\S*)\s+([^/\n]*)\/().*$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-ruby',
+            'literal': 'aws-sdk-ruby/',
             'regex': re.compile(r'^.*?(aws-sdk-ruby)\/(.*?)\s+(.*)\/(.*?)\s+(.*).*?$'),
+            'regex_hardened': re.compile(r'(aws-sdk-ruby)\/(\S*)\s+([^\s/]*)\/(\S*)\s+(.*)$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-dotnet-ios',
+            'literal': 'aws-sdk-dotnet-ios/',
             'regex': re.compile(r'^.*?(aws-sdk-dotnet-ios)\/(.*?)\s+\.NET\s+(.*?)\/(.*?)\s+\.NET\s+(Framework)\/(.*?)\s+(OS)\/(.*?)\s+.*?$'),
+            'regex_hardened': re.compile(r'(aws-sdk-dotnet-ios)\/(\S*)\s+\.NET\s+([^/\n]*)\/(\S*)\s+\.NET\s+(Framework)\/(\S*)\s+(OS)\/(\S*)\s+.*$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-dotnet-35',
+            'literal': 'aws-sdk-dotnet-35/',
             'regex': re.compile(r'^.*?(aws-sdk-dotnet-35)\/(.*?)\s+\.NET\s+(.*?)\/(.*?)\s+\.NET\s+(Framework)\/(.*?)\s+(OS)\/(.*?)\s+.*?$'),
+            'regex_hardened': re.compile(r'(aws-sdk-dotnet-35)\/(\S*)\s+\.NET\s+([^/\n]*)\/(\S*)\s+\.NET\s+(Framework)\/(\S*)\s+(OS)\/(\S*)\s+.*$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-dotnet-45',
+            'literal': 'aws-sdk-dotnet-45/',
             'regex': re.compile(r'^.*?(aws-sdk-dotnet-45)\/(.*?)\s+\.NET\s+(.*?)\/(.*?)\s+\.NET\s+(Framework)\/(.*?)\s+(OS)\/(.*?)\s+.*?$'),
+            'regex_hardened': re.compile(r'(aws-sdk-dotnet-45)\/(\S*)\s+\.NET\s+([^/\n]*)\/(\S*)\s+\.NET\s+(Framework)\/(\S*)\s+(OS)\/(\S*)\s+.*$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-dotnet',
+            'literal': 'aws-sdk-dotnet/',
             'regex': re.compile(r'^.*?(aws-sdk-dotnet)\/(.*?)\s+\.NET\s+(.*?)\/(.*?)\s+\.NET\s+(Framework)\/(.*?)\s+(OS)\/(.*?)\s+.*?$'),
+            'regex_hardened': re.compile(r'(aws-sdk-dotnet)\/(\S*)\s+\.NET\s+([^/\n]*)\/(\S*)\s+\.NET\s+(Framework)\/(\S*)\s+(OS)\/(\S*)\s+.*$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-js',
+            'literal': 'aws-sdk-js/',
             'regex': re.compile(r'^.*(aws-sdk-js)\/(.*)$'),
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-go',
+            'literal': 'aws-sdk-go/',
             'regex': re.compile(r'^.*(aws-sdk-go)\/(.*)$'),
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-php',
+            'literal': 'aws-sdk-php/',
             'regex': re.compile(r'^.*?(aws-sdk-php)\/(.*?)\s+(.*).*?$'),
+            'regex_hardened': re.compile(r'(aws-sdk-php)\/(\S*)\s+(.*)$'),
+            'anchor': 'first',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'aws_sdk_detail': 2}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-php2',
+            'literal': 'aws-sdk-php2/',
             'regex': re.compile(r'^.*?(aws-sdk-php2)\/(.*?)\s+(.*).*?$'),
+            'regex_hardened': re.compile(r'(aws-sdk-php2)\/(\S*)\s+(.*)$'),
+            'anchor': 'first',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'aws_sdk_detail': 2}
         })
         ua_regex_list.append({
             'name': 'aws-sdk-nodejs',
+            'literal': 'aws-sdk-nodejs/',
             'regex': re.compile(r'^.*(aws-sdk-nodejs)\/(.*)\s+(.*)\/(.*)$'),
+            'regex_hardened': re.compile(r'(aws-sdk-nodejs)\/(\S*)\s+([^\s/]*)\/(.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'platform': 2, 'platform_ver': 3}
         })
 
         # AWS Applications/Services
         ua_regex_list.append({
             'name': 'aws-internal',
+            'literal': 'aws-internal/',
             'regex': re.compile(r'^(.*)(aws-internal)\/(.*).*?$'),
+            'regex_hardened': re.compile(r'^(?=.*$)(.*)(aws-internal)\/(.*)$'),
             'format': {'guid': 0, 'aws_sdk': 1, 'aws_sdk_ver': 2}
         })
         ua_regex_list.append({
             'name': 'AWS_CLI',
+            'literal': 'aws-cli/',
             'regex': re.compile(r'^.*(aws-cli)\/(.*)\s+(.*)\/(.*)\s+(.*)\/(.*)$'),
+            'regex_hardened': re.compile(r'(aws-cli)\/(\S*)\s+([^\s/]*)\/(\S*)\s+([^\s/]*)\/(.*)$'),
+            'anchor': 'last',
             'format': {'aws_sdk': 0, 'aws_sdk_ver': 1, 'vm': 2, 'vm_ver': 3, 'os': 4, 'os_ver': 5}
         })
         ua_regex_list.append({
             'name': 'S3_Console',
+            'literal': 'S3Console/',
             'regex': re.compile(r'^.*(S3Console)\/(.*).*$'),
+            'regex_hardened': re.compile(r'(S3Console)\/(.*)$'),
+            'anchor': 'last',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'ElasticBeanstalk',
+            'literal': 'ElasticBeanstalk-',
             'regex': re.compile(r'^(ElasticBeanstalk)-.*$'),
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'S3_Browser',
+            'literal': 'S3 Browser',
             'regex': re.compile(r'^.*(S3 Browser)\s+(.*)\s+.*$'),
+            'regex_hardened': re.compile(r'(S3 Browser)\s+(\S*)\s+.*$'),
+            'anchor': 'last',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'AWSToolkitPackage',
+            'literal': 'AWSToolkitPackage.',
             'regex': re.compile(r'^.*?(AWSToolkitPackage)\.(.*?)\/(.*?)\s+\.NET\s+(.*?)\/(.*?)\s+\.NET\s+(Framework)\/(.*?)\s+(OS)\/(.*?)\s+.*?$'),
+            'regex_hardened': re.compile(r'(AWSToolkitPackage)\.([^/\n]*)\/(\S*)\s+\.NET\s+([^/\n]*)\/(\S*)\s+\.NET\s+(Framework)\/(\S*)\s+(OS)\/(\S*)\s+.*$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
 
         # CDNs
         ua_regex_list.append({
             'name': 'Akamai_Edge',
+            'literal': 'Akamai Edge',
             'regex': re.compile(r'^(.*)(Akamai) (Edge).*$'),
             'format': {'type': 0, 'company': 1, 'group': 2}
         })
         ua_regex_list.append({
             'name': 'Amazon_CloudFront',
+            'literal': 'Amazon CloudFront',
             'regex': re.compile(r'^(.*)(Amazon) (CloudFront).*$'),
             'format': {'type': 0, 'company': 1, 'group': 2}
         })
@@ -285,36 +568,47 @@ class UAscanner(object):
         # Bots
         ua_regex_list.append({
             'name': 'image_coccoc',
+            'literal': 'coccoc/',
             'regex': re.compile(r'^.*?(image.coccoc)\/(.*?);.*?$'),
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'CloudFlare_AlwaysOnline',
+            'literal': 'CloudFlare-AlwaysOnline/',
             'regex': re.compile(r'^.*(CloudFlare-AlwaysOnline)\/(.*);.*$'),
+            'regex_hardened': re.compile(r'(CloudFlare-AlwaysOnline)\/(?=.*$)(.*);.*$'),
+            'anchor': 'last',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'Google_ImageBot',
+            'literal': 'Googlebot-Image/',
             'regex': re.compile(r'^.*(Googlebot-Image)\/(.*).*$'),
+            'regex_hardened': re.compile(r'(Googlebot-Image)\/(.*)$'),
+            'anchor': 'last',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'Google_ADsBot',
+            'literal': 'AdsBot-Google',
             'regex': re.compile(r'^.*(AdsBot-Google)\s+(\(.*\)).*$'),
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'MSNBot_Media',
+            'literal': 'msnbot-media/',
             'regex': re.compile(r'^.*?(msnbot-media)\/(.*?)\s+(.*?)$'),
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'Exabot',
+            'literal': 'Exabot/',
             'regex': re.compile(r'^.*?(Exabot)\/(.*?)\s+(.*?)$'),
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'Facebook_Platform',
+            'literal': 'facebookplatform/',
             'regex': re.compile(r'^.*(facebookplatform)\/(.*)\s+.*$'),
             'format': {'application': 0, 'version': 1}
         })
@@ -322,34 +616,81 @@ class UAscanner(object):
         # Slackbot Details: https://api.slack.com/robots
         ua_regex_list.append({
             'name': 'Slackbot_LinkExpanding',
+            'literal': 'Slackbot-LinkExpanding ',
             'regex': re.compile(r'^.*?(Slackbot-LinkExpanding) (.*?)\s+(.*?)$'),
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'Slack_ImgProxy',
+            'literal': 'Slack-ImgProxy ',
             'regex': re.compile(r'^.*?(Slack-ImgProxy) (.*?)\s+(.*?)$'),
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'Slackbot',
+            'literal': 'Slackbot ',
             'regex': re.compile(r'^.*?(Slackbot) (.*?)\((.*?)\)$'),
+            'regex_hardened': re.compile(r'(Slackbot) ([^(\n]*)\((.*)\)$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
 
         # Client applications
         ua_regex_list.append({
             'name': 'CloudBerry_Client',
+            'literal': 'CloudBerryLab.Base.HttpUtil.Client',
             'regex': re.compile(r'^.*?(CloudBerryLab\.Base\.HttpUtil\.Client)\s+(.*?)\s+(\(.*?\)).*?$'),
+            'regex_hardened': re.compile(r'(CloudBerryLab\.Base\.HttpUtil\.Client)\s+(\S*)\s+(\([^)\n]*\)).*$'),
+            'anchor': 'first',
             'format': {'application': 0, 'version': 1}
         })
         ua_regex_list.append({
             'name': 'JetS3t',
+            'literal': 'JetS3t/',
             'regex': re.compile(r'^.*(JetS3t)\/(.*)\s+\((.*)\/(.*);\s+(.*);\s+(.*);\s+(.*)\s+(.*)\).*$'),
+            'regex_hardened': re.compile(r'(JetS3t)\/(\S*)\s+\(([^/;()\n]*)\/([^;\n]*);\s+([^;\n]*);\s+([^;\n]*);\s+([^;\n]*)\s+([^\s;)]*)\).*$'),
+            'anchor': 'last',
             'format': {'application': 0, 'version': 1, 'os': 2, 'os_ver': 3, 'arch': 4, 'lang': 5,
                        'java_vm': 6, 'java_vm_ver': 7}
         })
+
+        for ua_regex in ua_regex_list:
+            if hardened and 'regex_hardened' in ua_regex:
+                ua_regex['regex'] = ua_regex['regex_hardened']
+            else:
+                ua_regex.pop('anchor', None)
         return ua_regex_list
 
+    @staticmethod
+    def get_prefilter(ua_regex_list):
+        # Every regex requires its 'literal' to appear in the UA before it can match. We combine all of the
+        # literals into one regex so a single scan of the UA finds which regexes are worth trying.
+        # The lookahead lets us find literals that overlap each other, and the index for a literal also
+        # includes any regex whose literal is contained within it.
+        literals = sorted(set(ua_regex['literal'] for ua_regex in ua_regex_list if ua_regex.get('literal')),
+                          key=len, reverse=True)
+        prefilter_regex = re.compile('(?=({0}))'.format('|'.join(re.escape(literal) for literal in literals)))
+
+        prefilter_always = [index for index, ua_regex in enumerate(ua_regex_list) if not ua_regex.get('literal')]
+        prefilter_index = dict()
+        for literal in literals:
+            prefilter_index[literal] = sorted(
+                [index for index, ua_regex in enumerate(ua_regex_list)
+                 if ua_regex.get('literal') and ua_regex['literal'] in literal] + prefilter_always)
+        return prefilter_regex, prefilter_index, prefilter_always
+
+    def prefilter_candidates(self, ua):
+        # Returns the indexes of the regexes that may match this UA, in their original order.
+        found = set(self.ua_prefilter.findall(ua))
+        if not found:
+            return self.ua_prefilter_always
+        elif len(found) == 1:
+            return self.ua_prefilter_index[found.pop()]
+        candidates = set()
+        for literal in found:
+            candidates.update(self.ua_prefilter_index[literal])
+        return sorted(candidates)
+
     @staticmethod
     def nullstring_cleanup(ua):
         return re.sub('[\s+]', '', ua.lower())
@@ -369,7 +710,7 @@ class UAscanner(object):
         # Much like Schrodinger's cat, this variable may or may not exist
         if 'format' in ua_reg:
             if ua_var in ua_reg['format']:
-                if len(ua_lis) >= ua_reg['format'][ua_var]:
+                if len(ua_lis) > ua_reg['format'][ua_var]:
                     return ua_lis[ua_reg['format'][ua_var]]
         return None
 
@@ -383,180 +724,159 @@ class UAscanner(object):
             return False
 
     def test_ua(self, ua):
-        ua = urllib.unquote_plus(ua)
+        return self.test_ua_decoded(unquote_plus(ua))
+
+    def normalize_ua(self, ua):
+        # Return the key the result of the URL decoded UserAgent ua is cached under when it has fields our verdicts
+        # never read, as a (regex name, UserAgent without them) tuple that no raw UserAgent can collide with, or None.
+        # The first of our regexs that may match ua must be one of those named, so no other regex can match instead.
+        if self.max_ua_length and len(ua) > self.max_ua_length:
+            return None
+        for ua_name, normalize_regex, replacement in self.ua_normalizers:
+            normalized = normalize_regex.match(ua)
+            if normalized is not None:
+                if self.ua_regexs[self.prefilter_candidates(ua)[0]]['name'] != ua_name:
+                    return None
+                return ua_name, normalized.expand(replacement)
+        return None
+
+    def test_normalize_test(self):
+        # Each UserAgent must get the same verdict as the UserAgent its normalized key was made from.
+        test_data = [
+            '3f2504e0-4f89-11d3-9a0c-0305e82c3301 aws-internal/3',
+            'aws-sdk-java/1.10.5 Linux/3.14.35-28.38.amzn1.x86_64 OpenJDK_64-Bit_Server_VM/24.79-b02/1.7.0_85 en_US',
+            'aws-sdk-java/1.9.0 Windows_7/6.1 Java_HotSpot(TM)_Client_VM/1.5.0_22-b03/1.5.0_22 ja_JP',
+            'aws-sdk-android/2.1.3 Linux/3.4.0-perf-g1234567 Dalvik/1.6.0/0 en_US',
+            'aws-sdk-php/3.1.0 Guzzle/6.1.0 curl/7.35.0 PHP/5.5.9-1ubuntu4.14',
+            'aws-sdk-php2/2.8.3 Guzzle/3.9.3 curl/7.35.0 PHP/5.5.9-1ubuntu4.5',
+        ]
+        for ua in test_data:
+            ua_key = self.normalize_ua(ua)
+            if ua_key is None:
+                return False
+            if self.get_ua_supported_status(self.test_ua_decoded(ua))[:-1] != \
+                    self.get_ua_supported_status(self.test_ua_decoded(ua_key[1]))[:-1]:
+                return False
+        return True
+
+    def test_ua_decoded(self, ua):
+        # Same as test_ua, for a UA that has already been URL decoded.
+        if self.max_ua_length and len(ua) > self.max_ua_length:
+            if self.truncate_ua:
+                ua = ua[:self.max_ua_length]
+            else:
+                # We won't scan oversized UAs at all, they are reported as unknown.
+                return 'Oversized_UserAgent', None, None, ua
         if self.unknown_null(ua):
             # We won't run our own regexes on null UAs
             return None, None, None, ua
         else:
-            for ua_regex in self.ua_regexs:
+            return self.match_ua(ua)
+
+    def match_ua(self, ua):
+        # Return the (name, regex entry, groups, ua) of the first of our regexes matching the UA, without the length
+        # checks of test_ua_decoded.
+        line_end = None
+        for index in self.prefilter_candidates(ua):
+            ua_regex = self.ua_regexs[index]
+            anchor = ua_regex.get('anchor')
+            if anchor is None:
                 res = ua_regex['regex'].match(ua)
-                if res:
-                    return ua_regex['name'], ua_regex, res.groups(), ua
-            return None, None, None, ua
-
-    def test_version(self, this_version, supported_version):
-        match = self.ua_support_unknown
+            else:
+                if line_end is None:
+                    # .* does not cross a newline, the literal must start on the first line.
+                    line_end = ua.find('\n')
+                    if line_end < 0:
+                        line_end = len(ua)
+                res = self.match_anchored(ua, ua_regex, line_end)
+            if res:
+                return ua_regex['name'], ua_regex, res.groups(), ua
+        return None, None, None, ua
+
+    def match_anchored(self, ua, ua_regex, line_end):
+        # Match a hardened regex at the occurrences of its literal before line_end, from the first or the last one as
+        # its 'anchor' says, like the .* it replaces. Some UAs repeat an SDK, as EMR does, so the regex may only match
+        # at an earlier occurrence. Only anchor_attempts occurrences are tried, each attempt is linear in the length
+        # of the UA and junk UAs can repeat a literal thousands of times.
+        literal = ua_regex['literal']
+        start, end = 0, line_end
+        for attempt in xrange(self.anchor_attempts):
+            if ua_regex['anchor'] == 'first':
+                position = ua.find(literal, start, line_end)
+                start = position + 1
+            else:
+                position = ua.rfind(literal, 0, end)
+                end = position + len(literal) - 1
+            if position < 0:
+                return None
+            res = ua_regex['regex'].match(ua, position)
+            if res:
+                return res
+        return None
 
-        if self.debug_version:
-            self.logger.debug("VDBG DEBUG TEST1A: {0}".format(this_version))
-            self.logger.debug("VDBG DEBUG TEST2A: {0}".format(supported_version))
+    def parse_version(self, version):
+        # Normalize a version string into a tuple of integers, or None if we can not compare it.
+        # Results are memoized, UA version strings repeat heavily and thresholds are parsed at construction.
+        try:
+            return self.version_cache[version]
+        except KeyError:
+            pass
 
         # Remove all non numberic/period/underscore characters
         # We have no definitive way to compare words or special characters like numbers.
-        this_version = re.sub('[^0-9|.|_]+', '', this_version)
-        supported_version = re.sub('[^0-9|.|_]+', '', supported_version)
+        parsed_version = re.sub('[^0-9|.|_]+', '', version)
 
         # Replace all non-numeric characters (except '.') with '.'
-        this_version = re.sub('[^0-9|.]+', '.', this_version)
-        supported_version = re.sub('[^0-9|.]+', '.', supported_version)
+        parsed_version = re.sub('[^0-9|.]+', '.', parsed_version)
 
         # Cleanup, remove any double '..' in the version strings from our previous work.
-        this_version = re.sub('\.\.', '\.', this_version)
-        supported_version = re.sub('\.\.', '\.', supported_version)
-
-        if this_version == '' or supported_version == '':
-            return match
+        parsed_version = re.sub('\.\.', '\.', parsed_version)
 
         # Remove any trailing (and repeated trailing - or .)
-        this_version = this_version.rstrip('-.')
+        parsed_version = parsed_version.rstrip('-.')
 
-        while len(supported_version) >= 1:
-            if supported_version[len(supported_version)-1] != '-':
-                break
-            else:
-                supported_version = supported_version.rstrip('-')
+        parsed = None
+        if parsed_version != '' and parsed_version == re.sub(r'[^\d.]+', '', parsed_version):
+            try:
+                parsed = tuple(int(v) for v in parsed_version.split('.'))
+            except ValueError:
+                parsed = None
 
-        while len(supported_version) >= 1:
-            if supported_version[len(supported_version)-1] != '.':
-                break
-            else:
-                supported_version = supported_version.rstrip('.')
+        if len(self.version_cache) >= self.version_cache_size:
+            self.version_cache.clear()
+            self.version_cache.update(self.version_thresholds)
+        self.version_cache[version] = parsed
+        return parsed
 
-        if this_version == '' or supported_version == '':
-            return match
+    def test_version(self, this_version, supported_version):
+        this_versions = self.parse_version(this_version)
+        supported_versions = self.parse_version(supported_version)
 
         if self.debug_version:
-            self.logger.debug("VDBG DEBUG TEST1B: {0}".format(this_version))
-            self.logger.debug("VDBG DEBUG TEST2B: {0}".format(supported_version))
-
-        non_decimal = re.compile(r'[^\d.]+')
-        this_version_digits = non_decimal.sub('', this_version)
-        supported_version_digits = non_decimal.sub('', supported_version)
-        if this_version == this_version_digits and supported_version_digits == supported_version:
-            this_versions = this_version_digits.split('.')
-            supported_versions = supported_version_digits.split('.')
-            for a in xrange(0, len(this_versions)):
-                try:
-                    this_versions[a] = int(this_versions[a])
-                except ValueError:
-                    return match
-            for a in xrange(0, len(supported_versions)):
-                try:
-                    supported_versions[a] = int(supported_versions[a])
-                except ValueError:
-                    return match
-
-            count = 0
-            this_len = len(this_versions)
-            supported_len = len(supported_versions)
-            last_ver = this_len if this_len <= supported_len else supported_len
-            for a in xrange(0, last_ver):
-                if self.debug_version:
-                    self.logger.debug('VDBG A')
-                if this_versions[a] > supported_versions[a]:
-                    if self.debug_version:
-                        self.logger.debug('VDBG B1')
-                    match = self.ua_support_true
-                    break
-                elif this_versions[a] < supported_versions[a]:
-                    if self.debug_version:
-                        self.logger.debug('VDBG B2')
-                    match = self.ua_support_false
-                    break
-                elif this_versions[a] == supported_versions[a]:
-                    if self.debug_version:
-                        self.logger.debug('VDBG B3')
-                    count += 1
-                else:
-                    if self.debug_version:
-                        self.logger.debug('VDBG C')
-                    if this_len == supported_len:
-                        if self.debug_version:
-                            self.logger.debug('VDBG D')
-                        if a < last_ver:
-                            if self.debug_version:
-                                self.logger.debug('VDBG E')
-                            if this_versions[a + 1] >= supported_versions[a + 1]:
-                                if self.debug_version:
-                                    self.logger.debug('VDBG F')
-                                count += 1
-                    else:
-                        if this_versions[a] >= supported_versions[a]:
-                            if this_len < supported_len:
-                                if supported_versions[a + 1] == 0:
-                                    if self.debug_version:
-                                        self.logger.debug('VDBG G')
-                                    match = self.ua_support_true
-                                    break
-                                else:
-                                    if self.debug_version:
-                                        self.logger.debug('VDBG H')
-                                    match = self.ua_support_false
-                                    break
-                            else:
-                                if this_versions[a + 1] >= 0:
-                                    if self.debug_version:
-                                        self.logger.debug('VDBG I')
-                                    match = self.ua_support_true
-                                    break
-                                else:
-                                    if self.debug_version:
-                                        self.logger.debug('VDBG J')
-                                    match = self.ua_support_false
-                                    break
-                        else:
-                            if self.debug_version:
-                                self.logger.debug('VDBG K')
-                                self.logger.debug("VDBG COUNT: {0}".format(count))
-                            match = self.ua_support_false
-                            break
-
-            if count == supported_len and count == this_len:
-                match = self.ua_support_true
-            else:
-                if match == self.ua_support_unknown:
-                    if self.debug_version:
-                        self.logger.debug('VDBG K {0} {1} {2}'.format(count + 1, this_len, supported_len))
-                        self.logger.debug('VDBG K {0} {1} {2}'.format(count + 1, len(this_versions),
-                                                                      len(supported_versions)))
-                    if supported_len <= this_len:
-                        if self.debug_version:
-                            self.logger.debug('VDBG L')
-                        if this_versions[count] >= 0:
-                            if self.debug_version:
-                                self.logger.debug('VDBG M TRUE')
-                            match = self.ua_support_true
-                        else:
-                            if self.debug_version:
-                                self.logger.debug('VDBG N FALSE')
-                            match = self.ua_support_false
-                    else:
-                        if self.debug_version:
-                            self.logger.debug('VDBG 0')
-                            print 'O'
-                        if supported_versions[count] > 0:
-                            if self.debug_version:
-                                self.logger.debug('VDBG P FALSE')
-                            match = self.ua_support_false
-                        else:
-                            if self.debug_version:
-                                self.logger.debug('VDBG Q TRUE')
-                                print "Q TRUE"
-                            match = self.ua_support_true
-            if self.debug_version:
-                self.logger.debug('VDBG DEBUG {0} {1} = {2}[{3}] ? {4}[{5}]'.format(
-                    match, count, this_version, this_len, supported_version, supported_len))
-        return match
+            self.log_debug("VDBG DEBUG TEST1: {0} {1}", this_version, this_versions)
+            self.log_debug("VDBG DEBUG TEST2: {0} {1}", supported_version, supported_versions)
+
+        if this_versions is None or supported_versions is None:
+            return self.ua_support_unknown
+
+        this_len = len(this_versions)
+        supported_len = len(supported_versions)
+        if this_len >= supported_len:
+            # The components we have in common decide, extra components on our side are always good enough.
+            if this_versions[:supported_len] >= supported_versions:
+                return self.ua_support_true
+            return self.ua_support_false
+
+        supported_prefix = supported_versions[:this_len]
+        if this_versions > supported_prefix:
+            return self.ua_support_true
+        elif this_versions < supported_prefix:
+            return self.ua_support_false
+        # A shorter version equal to the prefix is good enough only if the next required component is 0.
+        elif supported_versions[this_len] > 0:
+            return self.ua_support_false
+        else:
+            return self.ua_support_true
 
     def test_version_test(self):
         test_data = [
@@ -581,19 +901,71 @@ class UAscanner(object):
             this_test_result = self.test_version(this_test['ver_set'], this_test['ver_req'])
             tests += 1 if this_test_result is this_test['result'] else 0
             if self.debug_version:
-                self.logger.debug('TEST: {0} | {1} ? {2} = {3} == {4}'.format(tests,
-                                                                              this_test['ver_set'],
-                                                                              this_test['ver_req'],
-                                                                              this_test_result,
-                                                                              this_test['result']))
+                self.log_debug('TEST: {0} | {1} ? {2} = {3} == {4}', tests,
+                                                                     this_test['ver_set'],
+                                                                     this_test['ver_req'],
+                                                                     this_test_result,
+                                                                     this_test['result'])
         if self.debug_version:
-            self.logger.debug('TEST RESULTS: {0} {1}'.format(tests, len(test_data)))
+            self.log_debug('TEST RESULTS: {0} {1}', tests, len(test_data))
 
         if tests != len(test_data):
             return False
         else:
             return True
 
+    @staticmethod
+    def get_pathological_uas(length):
+        # UserAgents that make the chained (.*) groups of the original regexes backtrack super-linearly.
+        # Each one repeats a fragment up to length characters, then ends in a way that none of the regexes can match.
+        seeds = [('Boto/', ' a/'), ('aws-cli/', ' a/'), ('aws-sdk-java/', ' a/'), ('aws-sdk-java/', '/ '),
+                 ('aws-sdk-java/1 Linux/3 JVM/1/1', ' a'), ('aws-sdk-android/', ' a/b'), ('aws-sdk-iOS/', ' a/ '),
+                 ('aws-sdk-ruby/', ' a/'), ('aws-sdk-dotnet/', ' .NET a/'), ('AWSToolkitPackage.', ' .NET a/'),
+                 ('JetS3t/', ' (a/b; '), ('JetS3t/1 (', 'a/b; c; d; '), ('Slackbot ', '('),
+                 ('CloudFlare-AlwaysOnline/', ';'), ('aws-internal/', 'aws-internal/'), ('Boto/', 'Boto/')]
+        tails = ['\nx', '\x00']
+        return [(prefix + fragment * length)[:length - len(tail)] + tail for prefix, fragment in seeds for tail in tails]
+
+    def time_match_ua(self, ua, min_time=0.005, repeat=5):
+        # Seconds match_ua takes on the UA: the best of repeat averages, each over as many calls as fill min_time.
+        # Like timeit.repeat we keep the minimum, the others only add what other processes took, and the time is
+        # that of our process (time.clock is CPU time on Unix) so being preempted does not count either.
+        best = None
+        for _ in range(repeat):
+            calls = 0
+            start_time = time.clock()
+            elapsed = 0.0
+            while elapsed < min_time:
+                self.match_ua(ua)
+                calls += 1
+                elapsed = time.clock() - start_time
+            best = min(best, elapsed / calls) if best is not None else elapsed / calls
+        return best
+
+    def test_pathological_test(self, sizes=(1024, 8192, 65536), growth=2.0):
+        # Time our regexes on each pathological UA at each of sizes, ignoring max_ua_length. Linear matching grows
+        # the time in proportion to the length, the test fails if from one size to the next it grows more than
+        # growth times faster than the length, which quadratic matching does by the ratio of the sizes.
+        # Only run this with hardened=True, the original regexes can take hours on this corpus.
+        tests = 0
+        uas_by_size = [self.get_pathological_uas(size) for size in sizes]
+        for uas in zip(*uas_by_size):
+            times = [self.time_match_ua(ua) for ua in uas]
+            ratios = [(time_large / time_small) / (float(size_large) / size_small) for time_small, time_large,
+                      size_small, size_large in zip(times, times[1:], sizes, sizes[1:])]
+            tests += 1 if max(ratios) <= growth else 0
+            if self.debug_version:
+                self.log_debug('TEST: {0} | {1!r} {2} ? {3}', tests, uas[0][:40],
+                               ' '.join('{0:.6f}'.format(elapsed) for elapsed in times),
+                               ' '.join('{0:.2f}'.format(ratio) for ratio in ratios))
+        if self.debug_version:
+            self.log_debug('TEST RESULTS: {0} {1}', tests, len(uas_by_size[0]))
+
+        if tests != len(uas_by_size[0]):
+            return False
+        else:
+            return True
+
     def is_supported(self, supported_os, supported_browser):
         if supported_os == self.ua_support_true and supported_browser == self.ua_support_true:
             # If Browser and OS Support SHA256, this one is good to go.
@@ -609,6 +981,9 @@ class UAscanner(object):
             supported = self.ua_support_false
         return supported
 
+    def output_result(self, result):
+        return self.output_status_ua(result.supported, result.identified, result.name, result.ua_string)
+
     def output_status_ua(self, supported, unknown, ua_name, ua_string):
         if self.identify_unknown is True:
             if unknown:
@@ -630,111 +1005,201 @@ class UAscanner(object):
         # i.e.: java_vm = 'Dalvik/1.4' / java_ver = ''
         java_vm = ''
         java_ver = ''
-        dalvik_vm_namever = False
         if not 'java_vm' in ua_regex['format']:
             return java_vm, java_ver
 
-        # We matched something with a Java like VM
+        # We matched something with a Java like VM, its rule knows where its version is.
         java_vm = ua_dict[ua_regex['format']['java_vm']]
-
-        if java_vm in self.vms_java:
-            # If this exist for a java_vm then it is likely the vm version.
-            if 'java_ver' in ua_regex['format']:
-                # Most Java VMs keep their actual version here, Hotspot and Dalvik may not
-                java_ver = ua_dict[ua_regex['format']['java_ver']]
-            else:
-                # If java_ver didn't exist then we'll use java_vm_ver, which is sometimes the java_vm_ver
-                if 'java_vm_ver' in ua_regex['format']:
-                    java_ver = ua_dict[ua_regex['format']['java_vm_ver']]
-        elif java_vm in self.vms_hotspot or java_vm in self.vms_dalvik:
-            if java_vm in self.vms_dalvik:
-                if '/' in java_vm:
-                    # If this is a Dalvik VM, the version may be in the vm_name
-                    java_vm, java_ver = java_vm.split('/')
-                    dalvik_vm_namever = True
-            if not dalvik_vm_namever:
-                # If the version was not in the VM name.
-                # Most Dalvik and Hotspot VMs use java_vm_ver instead of java_ver
-                if 'java_vm_ver' in ua_regex['format']:
-                    java_ver = ua_dict[ua_regex['format']['java_vm_ver']]
-                else:
-                    if 'java_ver' in ua_regex['format']:
-                        java_ver = ua_dict[ua_regex['format']['java_ver']]
-
+        vm_rule = self.dispatch_vm.get(java_vm)
+        if vm_rule is not None:
+            java_vm, java_ver = vm_rule[0](java_vm, ua_dict, ua_regex)
         return java_vm, java_ver
 
+    def vm_rule_java_ver(self, java_vm, ua_dict, ua_regex):
+        # Most Java VMs keep their actual version in java_ver
+        if 'java_ver' in ua_regex['format']:
+            return java_vm, ua_dict[ua_regex['format']['java_ver']]
+        # If java_ver didn't exist then we'll use java_vm_ver, which is sometimes the java_vm_ver
+        if 'java_vm_ver' in ua_regex['format']:
+            return java_vm, ua_dict[ua_regex['format']['java_vm_ver']]
+        return java_vm, ''
+
+    def vm_rule_java_vm_ver(self, java_vm, ua_dict, ua_regex):
+        # Most Dalvik and Hotspot VMs use java_vm_ver instead of java_ver
+        if 'java_vm_ver' in ua_regex['format']:
+            return java_vm, ua_dict[ua_regex['format']['java_vm_ver']]
+        if 'java_ver' in ua_regex['format']:
+            return java_vm, ua_dict[ua_regex['format']['java_ver']]
+        return java_vm, ''
+
+    def vm_rule_dalvik(self, java_vm, ua_dict, ua_regex):
+        # If this is a Dalvik VM, the version may be in the vm_name
+        if '/' in java_vm:
+            return tuple(java_vm.split('/'))
+        return self.vm_rule_java_vm_ver(java_vm, ua_dict, ua_regex)
+
     def java_version_get(self, java_vm, java_ver, ua_dict, java_vm_min_ver):
         # This is a convenience function, rather than repeating the following in multiple locations
         supported = self.test_version(java_ver, self.vm_mvr_dalvik)
-        self.logger.debug('JAVAA: {0}'.format(ua_dict))
-        self.logger.debug('JAVAB: VM={0} {1} ? {2} = {3}'.format(java_vm, java_ver, java_vm_min_ver, supported))
+        self.log_debug('JAVAA: {0}', ua_dict)
+        self.log_debug('JAVAB: VM={0} {1} ? {2} = {3}', java_vm, java_ver, java_vm_min_ver, supported)
+        return supported
+
+    def set_rules(self, app_rules=None, vm_rules=None, os_rules=None, browser_rules=None):
+        # Replace some of the verdict rules, as loaded from JSON for instance, and compile them.
+        app_rules = self.app_rules if app_rules is None else app_rules
+        vm_rules = self.vm_rules if vm_rules is None else vm_rules
+        os_rules = self.os_rules if os_rules is None else os_rules
+        browser_rules = self.browser_rules if browser_rules is None else browser_rules
+        # Nothing changes if any of the rules are invalid.
+        dispatch = [self.compile_rules(kind, rules) for kind, rules in
+                    (('app', app_rules), ('vm', vm_rules), ('os', os_rules), ('browser', browser_rules))]
+        self.app_rules, self.vm_rules, self.os_rules, self.browser_rules = app_rules, vm_rules, os_rules, browser_rules
+        self.dispatch_app, self.dispatch_vm, self.dispatch_os, self.dispatch_browser = dispatch
+        # Results of the previous rules are in the cache, and in the persistent cache under another fingerprint.
+        self.ua_cache.clear()
+        if getattr(self, 'persistent_cache', None) is not None:
+            self.persistent_fingerprint = self.get_fingerprint()
+
+    def compile_rules(self, kind, rules):
+        # Return a dict of each family to its (rule method, threshold). Lists in thresholds are only used for
+        # membership tests and become frozensets, version thresholds are parsed here once.
+        dispatch = dict()
+        for families, rule, threshold in rules:
+            rule_method = getattr(self, '{0}_rule_{1}'.format(kind, rule), None)
+            if rule_method is None:
+                raise ValueError('Unknown {0} rule: {1}'.format(kind, rule))
+            if isinstance(threshold, dict):
+                threshold = dict((key, frozenset(value) if isinstance(value, list) else value)
+                                 for key, value in threshold.iteritems())
+            for version in threshold.itervalues() if isinstance(threshold, dict) else [threshold]:
+                if isinstance(version, basestring):
+                    self.version_thresholds[version] = self.parse_version(version)
+            for family in families:
+                dispatch.setdefault(family, (rule_method, threshold))
+        return dispatch
+
+    def app_rule_java(self, ua_regex, ua_dict, threshold):
+        # Process aws-sdk-java version including those using Java/Hotspot/Dalvik VMs
+        java_vm, java_ver = self.extract_javavm_namever(ua_dict, ua_regex)
+        vm_rule = self.dispatch_vm.get(java_vm)
+        if java_vm == '' or java_ver == '' or vm_rule is None:
+            # If we don't know the version we can't know if it is supported
+            return self.ua_support_unknown
+        return self.java_version_get(java_vm, java_ver, ua_dict, vm_rule[1])
+
+    def app_rule_dalvik(self, ua_regex, ua_dict, threshold):
+        # Process aws-sdk-android Dalvik version
+        java_vm, java_ver = self.extract_javavm_namever(ua_dict, ua_regex)
+        if java_vm == '' or java_ver == '':
+            # If we don't know the version we can't know if it is supported
+            return self.ua_support_unknown
+        return self.java_version_get(java_vm, java_ver, ua_dict, threshold)
+
+    def app_rule_os_version(self, ua_regex, ua_dict, os_thresholds):
+        os_name = self.get_ev(ua_regex, ua_dict, 'os')
+        os_ver = self.get_ev(ua_regex, ua_dict, 'os_ver')
+        if os_name is not None and os_ver is not None and os_name in os_thresholds:
+            return self.test_version(os_ver, os_thresholds[os_name])
+        return self.ua_support_unknown
+
+    def app_rule_support(self, ua_regex, ua_dict, supported):
+        return supported
+
+    def os_rule_major_version(self, os_ver, os_major_ver, majors):
+        if os_major_ver in majors['unsupported']:
+            return self.ua_support_false
+        if os_major_ver in majors['supported']:
+            return self.ua_support_true
+        return self.ua_support_unknown
+
+    def os_rule_version(self, os_ver, os_major_ver, min_version):
+        return self.test_version(os_ver, min_version)
+
+    def os_rule_support(self, os_ver, os_major_ver, supported):
         return supported
 
+    # Browser rules return the (supported, supported_browser) pair. A supported of None means the browser and
+    # its OS are supported as a package, and is_supported decides.
+
+    def browser_rule_os(self, browser_ver, os_name, os_ver, supported_os, threshold):
+        # Depends on OS
+        return self.ua_support_unknown, supported_os
+
+    def browser_rule_support(self, browser_ver, os_name, os_ver, supported_os, supported):
+        return supported, supported
+
+    def browser_rule_version(self, browser_ver, os_name, os_ver, supported_os, min_version):
+        supported = self.test_version(browser_ver, min_version)
+        return supported, supported
+
+    def browser_rule_same_as_os(self, browser_ver, os_name, os_ver, supported_os, threshold):
+        return supported_os, supported_os
+
+    def browser_rule_blackberry(self, browser_ver, os_name, os_ver, supported_os, models):
+        if os_name == 'BlackBerry WebKit':
+            return supported_os, supported_os
+        supported_browser = self.ua_support_unknown
+        if browser_ver in models['unsupported']:
+            supported_browser = self.ua_support_false
+        elif browser_ver in models['supported']:
+            supported_browser = self.ua_support_true
+        return None, supported_browser
+
+    def browser_rule_os_version_with_os(self, browser_ver, os_name, os_ver, supported_os, min_version):
+        return None, self.test_version(os_ver, min_version)
+
+    def browser_rule_version_with_os(self, browser_ver, os_name, os_ver, supported_os, min_version):
+        return None, self.test_version(browser_ver, min_version)
+
+    def browser_rule_chrome(self, browser_ver, os_name, os_ver, supported_os, min_version):
+        # Chrome versions before min_version depend on the OS
+        supported_browser = self.test_version(browser_ver, min_version)
+        if supported_browser == self.ua_support_false:
+            supported_browser = self.ua_support_unknown
+        return None, supported_browser
+
+    def parse_user_agent(self, ua_s):
+        return load_user_agents().parse(ua_s)
+
     def get_ua_supported_status_string(self, mytuple):
+        return self.output_result(self.get_ua_supported_status(mytuple))
+
+    def get_ua_supported_status(self, mytuple):
         ua_name, ua_regex, ua_dict, ua_s = mytuple
         supported = self.ua_support_unknown
         supported_os = self.ua_support_unknown
         supported_browser = self.ua_support_unknown
 
         # Let's filter previously matched regex's before we check for a browser.
-        self.logger.debug('REGEX UA_NAME: {0}'.format(ua_name))
+        self.log_debug('REGEX UA_NAME: {0}', ua_name)
         if ua_name is not None:
-            if ua_name == 'aws-sdk-java':
-                # Process aws-sdk-java version including those using Java/Hotspot/Dalvik VMs
-                java_vm, java_ver = self.extract_javavm_namever(ua_dict, ua_regex)
-                if java_vm == '' or java_ver == '':
-                    # If we don't know the version we can't know if it is supported
-                    # support defaults to unknown
-                    pass
-                elif java_vm in self.vms_java:
-                    supported = self.java_version_get(java_vm, java_ver, ua_dict, self.vm_mvr_java)
-                elif java_vm in self.vms_hotspot:
-                    # Hotspot 20 = Java 1.6.0 Update 25 / Update 29 is needed for SHA2
-                    # Hotspot 21 = Java 1.7.0
-                    supported = self.java_version_get(java_vm, java_ver, ua_dict, self.vm_mvr_hotspot)
-                elif java_vm in self.vms_dalvik:
-                    supported = self.java_version_get(java_vm, java_ver, ua_dict, self.vm_mvr_dalvik)
-                else:
-                    pass
-            elif ua_name == 'aws-sdk-android':
-                # Process aws-sdk-android Dalvik version
-                java_vm, java_ver = self.extract_javavm_namever(ua_dict, ua_regex)
-                if java_vm == '' or java_ver == '':
-                    # If we don't know the version we can't know if it is supported
-                    # support defaults to unknown
-                    pass
-                else:
-                    supported = self.java_version_get(java_vm, java_ver, ua_dict, self.vm_mvr_dalvik)
-            elif ua_name == 'aws-sdk-iOS':
-                apple_ios = ['iPhone-OS']
+            app_rule = self.dispatch_app.get(ua_name)
+            if app_rule is not None:
+                supported = app_rule[0](ua_regex, ua_dict, app_rule[1])
+
+            # Return the status for these known user agents here
+            if ua_regex is not None:
                 os_name = self.get_ev(ua_regex, ua_dict, 'os')
                 os_ver = self.get_ev(ua_regex, ua_dict, 'os_ver')
-                if os_name is not None and os_ver is not None:
-                    if os_name in apple_ios:
-                        supported = self.test_version(os_ver, '3')
-            elif ua_name in self.useragents_support_supported:
-                supported = self.ua_support_true
-            elif ua_name in self.useragents_support_unsupported:
-                supported = self.ua_support_false
+                app_ver = self.get_ev(ua_regex, ua_dict, 'aws_sdk_ver') or self.get_ev(ua_regex, ua_dict, 'version')
             else:
-                supported = self.ua_support_unknown
-
-            # Return the status for these known user agents here
-            return self.output_status_ua(supported, True, ua_name, ua_s)
+                os_name = os_ver = app_ver = None
+            return UAresult(supported, ua_name.replace(' ', '_'), True, os_name, os_ver, ua_name, app_ver, ua_s)
         else:
-            self.logger.debug("NO_REGEX NAME: {0}".format(ua_name))
-            self.logger.debug("NO_REGEX UA: {0}".format(ua_s))
+            self.log_debug("NO_REGEX NAME: {0}", ua_name)
+            self.log_debug("NO_REGEX UA: {0}", ua_s)
 
         # Filter out any blank or empty user agents, they are unknown.
         if not ua_s.strip():
-            return self.output_status_ua(supported, True, 'Empty_UserAgent', ua_s)
+            return UAresult(supported, 'Empty_UserAgent', True, None, None, None, None, ua_s)
 
         # Filter out any user agents containing only null, they are unknown.
         null_agent = self.nullstring_cleanup(ua_s)
         if null_agent in self.nullagents:
-            return self.output_status_ua(supported, True, 'Null_UserAgent', ua_s)
+            return UAresult(supported, 'Null_UserAgent', True, None, None, None, None, ua_s)
 
-        ua_browser = user_agents.parse(ua_s)
+        ua_browser = self.parse_user_agent(ua_s)
         browser_name = ua_browser.browser.family
         browser_ver = ua_browser.browser.version_string
         os_name = ua_browser.os.family
@@ -760,168 +1225,31 @@ class UAscanner(object):
             pass
         os_major_ver = self.get_major_ver(os_ver)
 
-        agent_os_identified = True
-
         # Validate OS Support
-        if os_name == 'Windows':
-            # XP is unknown without the SP info
-            win_support_major_true = ['7', '8', 'RT', 'Vista', '10']
-            win_support_major_false = ['3', '95', '98', 'CE', 'ME', 'NT' '2000']
-            if len(os_major_ver) >= 1:
-                if os_major_ver in win_support_major_true:
-                    supported_os = self.ua_support_true
-                if os_major_ver in win_support_major_false:
-                    supported_os = self.ua_support_false
-
-        elif os_name == 'Windows Phone':
-            supported_os = self.test_version(os_ver, self.os_mvr_windowsphone)
-
-        elif os_name == 'Mac OS X':
-            supported_os = self.test_version(os_ver, self.os_mvr_macosx)
-
-        elif os_name == 'iOS':
-            supported_os = self.test_version(os_ver, self.os_mvr_ios)
-
-        elif os_name == 'Android':
-            supported_os = self.test_version(os_ver, self.os_mvr_android)
-
-        elif os_name == 'BlackBerry OS':
-            supported_os = self.test_version(os_ver, self.os_mvr_blackberryos)
-
-        elif os_name == 'BlackBerry Tablet OS':
-            supported_os = self.test_version(os_ver, self.os_mvr_blackberrytabletos)
-
-        elif os_name == 'Chrome OS':
-            supported_os = self.ua_support_true
-
-        elif os_name == 'webOS' or os_name == 'Symbian':
-            supported_os = self.ua_support_false
-
-        elif os_name == 'Linux':
-            # We can not identify if Linux is truly supported due to it's reliance on OpenSSL,
-            # and the ability to update the kernel independantly of the rest of the distribution.
-            supported_os = self.ua_support_unknown
-        else:
-            agent_os_identified = False
-
-        agent_browser_identified = True
-        # We do not know about these, they will be created as Unknown.
-        # This is only to maintain this list. We are not explicitly using it.
-        # browsers_unknown = ['Lunascape', 'Lynx']
-
-        # We'll start with application that are independent of the OS for support, or where
-        # the version of the application depends on a specific version of the OS.
-        if browser_name in self.browser_depends_on_os:
-            # Depends on OS
-            supported_browser = supported_os
-
-        elif browser_name in self.useragents_support_supported_bots:
-            # We'll assume various major Web Bots will be supported.
-            supported = supported_browser = self.ua_support_true
-
-        elif browser_name == 'SeaMonkey':
-            # Seamonkey uses Mozilla NSS for SSL. Seamonkey's first version was in 2006.
-            # NSS 3.8+ is SHA256 Certificate Compatible was released in 2003.
-            supported = supported_browser = self.ua_support_true
-
-        elif browser_name == 'Netscape':
-            # 7.1 or higher supports SHA256, relies on NSS
-            supported = supported_browser = self.test_version(browser_ver, '7.1')
-
-        elif browser_name == 'Edge':
-            # This is used by Apps running on an and using Apple OS's built in Web calls
-            supported = supported_browser = supported_os
-
-        elif browser_name == 'CFNetwork':
-            # This is used by Apps running on an and using Apple OS's built in Web calls
-            supported = supported_browser = supported_os
-
-        elif browser_name in self.firefox_browsers:
-            # Firefox and Mozilla use Mozilla NSS for SSL, Firefox 1.0+ uses NSS 3.8+
-            # NSS 3.8+ is SHA256 Certificate Compatible
-            supported = supported_browser = self.test_version(browser_ver, '1.5')
-
-        elif browser_name == 'Thunderbird':
-            # Firefox and Mozilla use Mozilla NSS for SSL, Firefox 1.0+ uses NSS 3.8+
-            # NSS 3.8+ is SHA256 Certificate Compatible
-            supported = supported_browser = self.test_version(browser_ver, '5')
-
-        elif browser_name == 'BlackBerry':
-            if os_name == 'BlackBerry WebKit':
-                supported = supported_browser = supported_os
-            else:
-                blackberry_support_true = ['8520', '8530', '8900', '8910', '8980', '9000', '9700', '9650', '9630',
-                                           '9520', '9550', '9500', '9530', '9780', '9788', '9100', '9105', '9670',
-                                           '9300', '9330', '9800', '9320', '9220', '9350', '9360', '9370', '9380',
-                                           '9850', '9860', '9810', '9981', '9720', '9900', '9930', '9790']
-                blackberry_support_false = ['7100', '7250', '8100', '8310', '8320', '8800', '8820', '8830', '8100',
-                                            '8110', '8120', '8130', '8220', '8230', '8300', '8310', '8320', '8330',
-                                            '8350', '7200', '7500', '7700', '5000', '6000', '850', '857', '950',
-                                            '957']
-                if browser_ver in blackberry_support_true:
-                    supported_browser = self.ua_support_true
-                if browser_ver in blackberry_support_false:
-                    supported_browser = self.ua_support_false
-                supported = self.is_supported(supported_os, supported_browser)
-
+        os_rule = self.dispatch_os.get(os_name)
+        agent_os_identified = os_rule is not None
+        if agent_os_identified:
+            supported_os = os_rule[0](os_ver, os_major_ver, os_rule[1])
+
+        # Validate Browser Support, browsers we have no rule for are unidentified and we will assume they use OS
+        # support.
+        browser_rule = self.dispatch_browser.get(browser_name)
+        agent_browser_identified = browser_rule is not None
+        if agent_browser_identified:
+            supported, supported_browser = browser_rule[0](browser_ver, os_name, os_ver, supported_os, browser_rule[1])
         else:
-            # Here's we'll process browsers that have a dependency on OS support for their support.
-            if browser_name == 'Android':
-                supported_browser = self.test_version(os_ver, '2.3')
-
-            elif browser_name == 'Outlook':
-                supported_browser = self.test_version(os_ver, '2003')
-
-            elif browser_name == 'Opera':
-                supported_browser = self.test_version(browser_ver, '6')
-
-            elif browser_name == 'Konqueror':
-                # 3.5.6 or higher supports SHA256, relies on OpenSSL
-                supported_browser = self.test_version(browser_ver, '3.5.6')
-
-            elif browser_name == 'Safari' or browser_name == 'Mobile Safari':
-                supported_browser = self.test_version(browser_ver, '3')
-
-            elif browser_name == 'IE' or browser_name == 'IE Mobile':
-                supported_browser = self.test_version(browser_ver, '6')
-
-            elif browser_name in self.chrome_browsers:
-                # Chrome 0-37 depends on OS, 38+ is independent of OS
-                supported_browser = self.test_version(browser_ver, '38')
-                if supported_browser == self.ua_support_false:
-                    supported_browser = self.ua_support_unknown
-
-                if supported_browser == self.ua_support_unknown and supported_os == self.ua_support_true:
-                    supported = self.ua_support_true
-                elif supported_browser == self.ua_support_unknown and supported_os == self.ua_support_unknown:
-                    supported = self.ua_support_unknown
-                elif supported_browser == self.ua_support_true:
-                    supported = self.ua_support_true
-                else:
-                    supported = self.ua_support_false
-
-            # Anything that has unknown support will be '1'
-            elif browser_name not in self.browsers_nonstandard and browser_name != 'Other':
-                # Unless handled in an Application's check above, at this point we will assume
-                # that the application may depend on the OS for support.
-                #
-                # We'll deal with Chrome/OS in it's section above, as it is previously reliant
-                # on the OS, but the newer versions are not.
-                agent_browser_identified = False
-            else:
-                # This browser agent was unidentified we will assume it uses OS support.
-                agent_browser_identified = False
-
+            supported = None
+        if supported is None:
             # Finally we'll see if the application coupled with the OS are supported as a package
             supported = self.is_supported(supported_os, supported_browser)
 
-        self.logger.debug('ALL: {0}/{1}/{2} {3}/{4} {5}/{6} [{7}]'.format(
-            supported, supported_os, supported_browser, os_name, os_ver, browser_name, browser_ver, ua_browser))
-        self.logger.debug('DICT: {0}'.format(ua_dict))
-        self.logger.debug('BROWSER: {0} {1}/{2}'.format(supported_browser, browser_name, browser_ver))
-        self.logger.debug('OS: {0} {1}/{2}'.format(supported_os, os_name, os_ver))
-        self.logger.debug('BOTH: {0}/{1}/{2} {3}/{4} {5}/{6}'.format(
-            supported, supported_os, supported_browser, os_name, os_ver, browser_name, browser_ver))
+        self.log_debug('ALL: {0}/{1}/{2} {3}/{4} {5}/{6} [{7}]', supported, supported_os, supported_browser,
+                       os_name, os_ver, browser_name, browser_ver, ua_browser)
+        self.log_debug('DICT: {0}', ua_dict)
+        self.log_debug('BROWSER: {0} {1}/{2}', supported_browser, browser_name, browser_ver)
+        self.log_debug('OS: {0} {1}/{2}', supported_os, os_name, os_ver)
+        self.log_debug('BOTH: {0}/{1}/{2} {3}/{4} {5}/{6}',
+                       supported, supported_os, supported_browser, os_name, os_ver, browser_name, browser_ver)
 
         # If we were unable to identify the browser or the OS then we will mention that in debug here.
         if agent_os_identified is True:
@@ -938,19 +1266,610 @@ class UAscanner(object):
         else:
             agent_unknown = False
 
-        self.logger.debug('UA STRING IS_ID ({0}) ({1}): {2}'.format(agent_identified, ua_name, ua_s))
+        self.log_debug('UA STRING IS_ID ({0}) ({1}): {2}', agent_identified, ua_name, ua_s)
+
+        return UAresult(supported, ua_name.replace(' ', '_'), agent_unknown, os_name, os_ver, browser_name, browser_ver,
+                        ua_s)
+
+    def log_debug(self, message, *args):
+        if self.debug_logging:
+            self.logger.debug(message.format(*args))
+
+    def stats_wrap(self, stage, method, count_result=None):
+        # Return method wrapped to add its calls and time to the stage, and pass its result to count_result.
+        stage_stats = self.stats_stages[stage] = [0, 0.0]
+        timer = time.time
+
+        def stats_method(*args):
+            start = timer()
+            result = method(*args)
+            stage_stats[1] += timer() - start
+            stage_stats[0] += 1
+            if count_result is not None:
+                count_result(result)
+            return result
+        return stats_method
+
+    def stats_remember_rule(self, mytuple):
+        # Remember the stats_rules key of a test_ua result for its UserAgent: 'name#index' of the regex that matched,
+        # several of our regexs share a name, or 'Oversized_UserAgent' or 'no_match'.
+        if mytuple[1] is not None:
+            rule = self.stats_regex_rules[id(mytuple[1])]
+        else:
+            rule = mytuple[0] if mytuple[0] is not None else 'no_match'
+        if len(self.stats_ua_rules) >= self.stats_ua_rules_size:
+            self.stats_ua_rules.clear()
+        self.stats_ua_rules[mytuple[3]] = rule
+        return rule
+
+    def stats_count(self, results):
+        # Count the verdict and the rule of each result returned. Most results come from the cache, their rule was
+        # remembered when test_ua made them. Results made for another UserAgent with the same normalized key, or
+        # read from the persistent cache, are tested again, untimed.
+        for result in results:
+            self.stats_verdicts[result.supported] = self.stats_verdicts.get(result.supported, 0) + 1
+            rule = self.stats_ua_rules.get(result.ua_string)
+            if rule is None:
+                rule = self.stats_remember_rule(self.stats_test_ua(result.ua_string))
+            self.stats_rules[rule] = self.stats_rules.get(rule, 0) + 1
+
+    def stats_enable(self):
+        # Stage times include the stages they call: classify includes ua_parse and test_version.
+        if 'test_ua' in self.stats_stages:
+            return
+        self.stats_regex_rules = dict()
+        for index, ua_regex in enumerate(self.ua_regexs):
+            rule = self.stats_regex_rules[id(ua_regex)] = '{0}#{1}'.format(ua_regex['name'], index)
+            self.stats_rules[rule] = 0
+        self.stats_test_ua = self.test_ua_decoded
+        self.test_ua_decoded = self.stats_wrap('test_ua', self.test_ua_decoded, self.stats_remember_rule)
+        self.parse_user_agent = self.stats_wrap('ua_parse', self.parse_user_agent)
+        self.test_version = self.stats_wrap('test_version', self.test_version)
+        self.get_ua_supported_status = self.stats_wrap('classify', self.get_ua_supported_status)
+        self.output_result = self.stats_wrap('format', self.output_result)
+        self.stats = True
+
+    def stats_clear(self):
+        for stage_stats in self.stats_stages.itervalues():
+            stage_stats[:] = [0, 0.0]
+        for rule in self.stats_rules:
+            self.stats_rules[rule] = 0
+        self.stats_verdicts.clear()
+
+    def stats_dict(self):
+        return {'stages': OrderedDict((stage, {'calls': calls, 'seconds': seconds})
+                                      for stage, (calls, seconds) in self.stats_stages.iteritems()),
+                'rules': OrderedDict(self.stats_rules),
+                'verdicts': dict(self.stats_verdicts),
+                'cache': self.cache_stats()}
+
+    def stats_prometheus(self, prefix='uascan'):
+        # The stats in the Prometheus text exposition format.
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = ['# HELP {0}_stage_calls_total Calls of each scanning stage.'.format(prefix),
+                 '# TYPE {0}_stage_calls_total counter'.format(prefix)]
+        lines.extend('{0}_stage_calls_total{{stage="{1}"}} {2}'.format(prefix, label(stage), calls)
+                     for stage, (calls, seconds) in self.stats_stages.iteritems())
+        lines.extend(['# HELP {0}_stage_seconds_total Time spent in each scanning stage.'.format(prefix),
+                      '# TYPE {0}_stage_seconds_total counter'.format(prefix)])
+        lines.extend('{0}_stage_seconds_total{{stage="{1}"}} {2!r}'.format(prefix, label(stage), seconds)
+                     for stage, (calls, seconds) in self.stats_stages.iteritems())
+        lines.extend(['# HELP {0}_rule_hits_total UserAgents identified by each of our regexs.'.format(prefix),
+                      '# TYPE {0}_rule_hits_total counter'.format(prefix)])
+        lines.extend('{0}_rule_hits_total{{rule="{1}"}} {2}'.format(prefix, label(rule), hits)
+                     for rule, hits in self.stats_rules.iteritems())
+        lines.extend(['# HELP {0}_verdicts_total UserAgents classified with each support code.'.format(prefix),
+                      '# TYPE {0}_verdicts_total counter'.format(prefix)])
+        lines.extend('{0}_verdicts_total{{supported="{1}"}} {2}'.format(prefix, supported, count)
+                     for supported, count in sorted(self.stats_verdicts.iteritems()))
+        for name, value in sorted(self.cache_stats().iteritems()):
+            if name != 'capacity':
+                metric_type = 'gauge' if name == 'size' else 'counter'
+                metric_name = '{0}_cache_{1}{2}'.format(prefix, name, '_total' if metric_type == 'counter' else '')
+                lines.extend(['# TYPE {0} {1}'.format(metric_name, metric_type),
+                              '{0} {1}'.format(metric_name, value)])
+        return ''.join('{0}\n'.format(line) for line in lines)
+
+    def cache_stats(self):
+        return {'size': len(self.ua_cache), 'capacity': self.cache_size, 'hits': self.cache_hits,
+                'misses': self.cache_misses, 'evictions': self.cache_evictions,
+                'normalized_hits': self.normalized_hits, 'normalized_misses': self.normalized_misses,
+                'persistent_hits': self.persistent_hits, 'persistent_misses': self.persistent_misses}
+
+    def cache_clear(self):
+        self.ua_cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.normalized_hits = 0
+        self.normalized_misses = 0
+
+    def cache_lookup(self, my_useragent):
+        try:
+            # Popping and re-inserting the entry moves it to the most recently used end.
+            result = self.ua_cache.pop(my_useragent)
+        except KeyError:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        self.ua_cache[my_useragent] = result
+        return result
+
+    def cache_store(self, my_useragent, result):
+        if len(self.ua_cache) >= self.cache_size:
+            # Drop the least recently used entry
+            self.ua_cache.popitem(last=False)
+            self.cache_evictions += 1
+        self.ua_cache[my_useragent] = result
 
-        return self.output_status_ua(supported, agent_unknown, ua_name, ua_s)
+    @staticmethod
+    def get_ua_parser_files():
+        # The installed ua-parser's package metadata, its __init__ holding its VERSION and its regexes, found without
+        # importing it: the import compiles every one of its regexes, and a persistent cache hit needs none of them.
+        import imp
+        import glob
+        try:
+            package_dir = imp.find_module('ua_parser')[1]
+        except ImportError:
+            return []
+        site_dir = os.path.dirname(package_dir)
+        file_names = sorted(glob.glob(os.path.join(site_dir, 'ua_parser-*.dist-info', 'METADATA')) +
+                            glob.glob(os.path.join(site_dir, 'ua_parser-*.egg-info', 'PKG-INFO')))
+        file_names.extend(os.path.join(package_dir, file_name)
+                          for file_name in ('__init__.py', '_regexes.py', 'regexes.yaml', 'regexes.json'))
+        if os.environ.get('UA_PARSER_YAML'):
+            # Older ua-parser versions load the regexes.yaml named by this variable instead of their own.
+            file_names.append(os.environ['UA_PARSER_YAML'])
+        return [file_name for file_name in file_names if os.path.isfile(file_name)]
+
+    def get_fingerprint(self):
+        # A digest of everything our results depend on: our regexs, the minimum versions, the support lists and
+        # verdict rules, the UserAgent length limits, and ua-parser's regexes. Those are the tables of the regex
+        # bundle installed by uascan_regexes, already loaded, or else the files of the installed ua-parser. Either
+        # way the digest does not depend on whether ua-parser was imported yet, as in UAscannerPool workers.
+        fingerprint = hashlib.sha256()
+        for ua_regex in self.ua_regexs:
+            fingerprint.update(repr((ua_regex['name'], ua_regex['regex'].pattern, ua_regex['format'])))
+        for attr_name in sorted(vars(self)):
+            if '_mvr_' in attr_name or attr_name.startswith(('useragents_', 'vms_', 'browser')) or \
+                    attr_name.endswith('_rules'):
+                fingerprint.update(repr((attr_name, getattr(self, attr_name))))
+        fingerprint.update(repr((self.max_ua_length, self.truncate_ua)))
+        uascan_regexes = sys.modules.get('uascan_regexes')
+        if uascan_regexes is not None and uascan_regexes.installed_version is not None:
+            from ua_parser import user_agent_parser
+            fingerprint.update(repr(uascan_regexes.installed_version))
+            for parser in itertools.chain(user_agent_parser.USER_AGENT_PARSERS, user_agent_parser.OS_PARSERS):
+                fingerprint.update(parser.pattern)
+        else:
+            for file_name in self.get_ua_parser_files():
+                with open(file_name, 'rb') as ua_parser_filein:
+                    fingerprint.update(os.path.basename(file_name))
+                    fingerprint.update(ua_parser_filein.read())
+        return fingerprint.hexdigest()
+
+    def persistent_cache_open(self, cache_file):
+        # Results stored under any other fingerprint are stale, they are deleted when the cache is opened.
+        import sqlite3
+        self.persistent_fingerprint = self.get_fingerprint()
+        self.persistent_cache = sqlite3.connect(cache_file, timeout=60)
+        # UserAgents are byte strings that may not be valid UTF-8, store them as they are.
+        self.persistent_cache.text_factory = str
+        with self.persistent_cache:
+            self.persistent_cache.execute('CREATE TABLE IF NOT EXISTS ua_results '
+                                          '(fingerprint TEXT, ua TEXT, result BLOB, PRIMARY KEY (fingerprint, ua))')
+            self.persistent_cache.execute('DELETE FROM ua_results WHERE fingerprint != ?',
+                                          (self.persistent_fingerprint,))
+
+    def persistent_cache_close(self):
+        if self.persistent_cache is not None:
+            self.persistent_cache.close()
+            self.persistent_cache = None
+
+    def persistent_lookup(self, my_useragents):
+        # Return a dict of the stored UAresult for each of my_useragents found in the persistent cache.
+        # The UserAgents are fetched in batches, within SQLite's limit on query parameters.
+        results = dict()
+        my_useragents = list(my_useragents)
+        for batch_start in xrange(0, len(my_useragents), 500):
+            batch = my_useragents[batch_start:batch_start + 500]
+            rows = self.persistent_cache.execute(
+                'SELECT ua, result FROM ua_results WHERE fingerprint = ? AND ua IN ({0})'.format(
+                    ', '.join('?' * len(batch))), [self.persistent_fingerprint] + batch)
+            for my_useragent, result in rows:
+                results[my_useragent] = UAresult(*cPickle.loads(str(result)))
+        self.persistent_hits += len(results)
+        self.persistent_misses += len(my_useragents) - len(results)
+        return results
+
+    def persistent_store(self, results):
+        # Store (UserAgent, UAresult) pairs in the persistent cache, in a single transaction.
+        with self.persistent_cache:
+            self.persistent_cache.executemany(
+                'INSERT OR REPLACE INTO ua_results (fingerprint, ua, result) VALUES (?, ?, ?)',
+                [(self.persistent_fingerprint, my_useragent, buffer(cPickle.dumps(tuple(result), 2)))
+                 for my_useragent, result in results])
+
+    def classify_decoded(self, ua_s):
+        # Classify the URL decoded UserAgent ua_s once its raw UserAgent missed the cache. Returns its result, and
+        # whether it has a normalized key: the UserAgents sharing a key share its cache entry, and are mostly seen
+        # once, so they are not worth caching on their own.
+        ua_key = self.normalize_ua(ua_s) if self.cache_size and self.normalize_cache else None
+        if ua_key is not None:
+            result = self.ua_cache.pop(ua_key, None)
+            if result is not None:
+                self.normalized_hits += 1
+                self.ua_cache[ua_key] = result
+                return result._replace(ua_string=ua_s), True
+            self.normalized_misses += 1
+        result = self.get_ua_supported_status(self.test_ua_decoded(ua_s))
+        if ua_key is not None:
+            self.cache_store(ua_key, result)
+        return result, ua_key is not None
+
+    def classify(self, my_useragent):
+        if not self.cache_size and self.persistent_cache is None:
+            result = self.get_ua_supported_status(self.test_ua(my_useragent))
+        else:
+            result = self.cache_lookup(my_useragent) if self.cache_size else None
+            if result is None:
+                normalized = False
+                if self.persistent_cache is not None:
+                    result = self.persistent_lookup([my_useragent]).get(my_useragent)
+                if result is None:
+                    result, normalized = self.classify_decoded(unquote_plus(my_useragent))
+                    if self.persistent_cache is not None:
+                        self.persistent_store([(my_useragent, result)])
+                if self.cache_size and not normalized:
+                    self.cache_store(my_useragent, result)
+        if self.stats:
+            self.stats_count((result,))
+        return result
+
+    def classify_chunk(self, my_useragents):
+        # Each distinct UserAgent in the chunk is looked up in the cache once, and each distinct URL decoded
+        # UserAgent that missed is classified once, no matter how many times or encodings it appears in.
+        results = dict()
+        decoded_useragents = OrderedDict()
+        for my_useragent in my_useragents:
+            if my_useragent in results or my_useragent in decoded_useragents:
+                continue
+            result = self.cache_lookup(my_useragent) if self.cache_size else None
+            if result is None:
+                decoded_useragents[my_useragent] = unquote_plus(my_useragent)
+            else:
+                results[my_useragent] = result
+
+        if self.persistent_cache is not None and decoded_useragents:
+            # Prefetch every UserAgent that missed the LRU cache from the persistent cache in one pass.
+            for my_useragent, result in self.persistent_lookup(decoded_useragents).iteritems():
+                del decoded_useragents[my_useragent]
+                results[my_useragent] = result
+                if self.cache_size:
+                    self.cache_store(my_useragent, result)
+
+        decoded_results = dict()
+        for my_useragent, ua_s in decoded_useragents.iteritems():
+            decoded_result = decoded_results.get(ua_s)
+            if decoded_result is None:
+                decoded_result = decoded_results[ua_s] = self.classify_decoded(ua_s)
+            result, normalized = decoded_result
+            results[my_useragent] = result
+            if self.cache_size and not normalized:
+                self.cache_store(my_useragent, result)
+        if self.persistent_cache is not None and decoded_useragents:
+            self.persistent_store((my_useragent, results[my_useragent]) for my_useragent in decoded_useragents)
+
+        chunk_results = [results[my_useragent] for my_useragent in my_useragents]
+        if self.stats:
+            self.stats_count(chunk_results)
+        return chunk_results
+
+    def classify_many(self, my_useragents, chunk_size=1000):
+        # Generator yielding a UAresult for each UserAgent in my_useragents, in input order.
+        # UserAgents are read and classified chunk_size at a time, see classify_chunk.
+        my_useragents = iter(my_useragents)
+        while True:
+            chunk = list(itertools.islice(my_useragents, chunk_size))
+            if not chunk:
+                break
+            for result in self.classify_chunk(chunk):
+                yield result
 
     def uacheck_string(self, my_useragent):
-        return self.get_ua_supported_status_string(self.test_ua(my_useragent))
+        return self.output_result(self.classify(my_useragent))
+
+    def uacheck_many(self, my_useragents, chunk_size=1000):
+        # Generator yielding the uacheck_string output for each UserAgent in my_useragents, in input order.
+        for result in self.classify_many(my_useragents, chunk_size):
+            yield self.output_result(result)
 
     def uacheck_args(self, my_useragent):
-        my_string = self.get_ua_supported_status_string(self.test_ua(my_useragent))
-        my_string = my_string.split(' ')
-        if len(my_string) >= 2:
-            # We're only outputting the Supported flag, and a 1 word descriptor of the browser
-            return my_string[0], my_string[1]
+        result = self.classify(my_useragent)
+        if self.identify_unknown is True:
+            # The identified flag is output right after the Supported flag
+            return str(result.supported), 'T' if result.identified else 'F'
+        # We're only outputting the Supported flag, and a 1 word descriptor of the browser
+        return str(result.supported), result.name
+
+
+def intern_values(values, value_ids, value_list):
+    # Return the id of each of values, its index in value_list, appending the values not seen before to value_list.
+    # value_ids maps each value of value_list to its id. Most values were seen before and are looked up in one pass.
+    ids = map(value_ids.get, values)
+    if None in ids:
+        for index, value_id in enumerate(ids):
+            if value_id is None:
+                value = values[index]
+                value_id = value_ids.get(value)
+                if value_id is None:
+                    value_id = value_ids[value] = len(value_list)
+                    value_list.append(value)
+                ids[index] = value_id
+    return ids
+
+
+class UAresultStore(object):
+    # Per-request results held in compact columns, for reporting on many millions of requests. Each distinct bucket,
+    # source IP and UAresult (and with it the UserAgent string and short name) is interned once. Each row holds its
+    # support code as an unsigned byte and the ids of its bucket, source IP and result as unsigned 32 bit integers,
+    # 13 bytes a row. count_by aggregates the columns with NumPy when it is installed, in Python otherwise.
+
+    row_columns = ('bucket', 'ip', 'result')
+
+    def __init__(self):
+        self.supported = array.array('B')
+        self.ids = dict((column, array.array('I')) for column in self.row_columns)
+        self.value_ids = dict((column, dict()) for column in self.row_columns)
+        self.values = dict((column, []) for column in self.row_columns)
+
+    def __len__(self):
+        return len(self.supported)
+
+    def add(self, bucket, ip, result):
+        self.add_many(((bucket, ip, result),))
+
+    def add_many(self, entries, chunk_size=65536):
+        # entries are (bucket, source ip, UAresult), as yielded by uascan_logs.classify_s3log. Results of
+        # UserAgents without a bucket or source IP, as in app 2, can be added with None for them.
+        entries = iter(entries)
+        while True:
+            chunk = list(itertools.islice(entries, chunk_size))
+            if not chunk:
+                break
+            for index, column in enumerate(self.row_columns):
+                values = map(operator.itemgetter(index), chunk)
+                self.ids[column].fromlist(intern_values(values, self.value_ids[column], self.values[column]))
+            # The last row column holds the results, their support codes are also stored a byte each.
+            self.supported.fromlist(map(operator.itemgetter(UAresult._fields.index('supported')), values))
+
+    def rows(self):
+        # Generator yielding the (bucket, source ip, UAresult) of each row, in the order they were added.
+        buckets, ips, results = [self.values[column] for column in self.row_columns]
+        for bucket_id, ip_id, result_id in itertools.izip(*[self.ids[column] for column in self.row_columns]):
+            yield buckets[bucket_id], ips[ip_id], results[result_id]
+
+    def get_key(self, key):
+        # Return the row column holding key, the id of key for each id of the column (None when they are the same)
+        # and the value of key for each of its ids.
+        if key in ('bucket', 'ip'):
+            return key, None, self.values[key]
+        if key not in UAresult._fields:
+            raise ValueError('Unknown key {0}, the keys are: {1}'.format(
+                key, ', '.join(('bucket', 'ip') + UAresult._fields)))
+        field_index = UAresult._fields.index(key)
+        field_values = []
+        field_ids = intern_values([result[field_index] for result in self.values['result']], dict(), field_values)
+        return 'result', field_ids, field_values
+
+    def count_by(self, keys, supported=None):
+        # Return the number of rows of each distinct combination of keys, most rows first, as a list of
+        # (key values, count). keys are 'bucket', 'ip' and UAresult fields, as in ('bucket', 'name'). With
+        # supported, a sequence of support codes, only the rows with one of them are counted, so
+        # count_by(('bucket',), supported=(2,)) counts the requests from unsupported UserAgents per bucket.
+        if not keys:
+            raise ValueError('count_by needs at least one key')
+        key_columns = [self.get_key(key) for key in keys]
+        if not len(self):
+            return []
+        numpy = load_numpy()
+        combinations = reduce(lambda size, key_column: size * len(key_column[2]), key_columns, 1)
+        if numpy is not None and combinations < 1 << 62:
+            counts = self.count_numpy(numpy, key_columns, combinations, supported)
         else:
-            # Something went wrong, we should have a minimum of 2 arguments.
-            return None, None
+            counts = self.count_python(key_columns, supported)
+        return sorted(counts, key=lambda item: (-item[1], item[0]))
+
+    def count_numpy(self, numpy, key_columns, combinations, supported):
+        # Each row's key ids are combined into a single integer, which is counted with bincount when the number of
+        # combinations is small enough, and sorted and counted with unique otherwise.
+        selected = None
+        if supported is not None:
+            supported_codes = numpy.zeros(256, dtype=numpy.bool_)
+            supported_codes[list(supported)] = True
+            selected = supported_codes[numpy.frombuffer(self.supported, dtype=numpy.uint8)]
+        combined = None
+        for column, column_key_ids, key_values in key_columns:
+            key_ids = numpy.frombuffer(self.ids[column], dtype=numpy.uint32)
+            if selected is not None:
+                key_ids = key_ids[selected]
+            if column_key_ids is not None:
+                key_ids = numpy.array(column_key_ids, dtype=numpy.uint32)[key_ids]
+            if combined is None:
+                combined = key_ids.astype(numpy.int64)
+            else:
+                combined *= len(key_values)
+                combined += key_ids
+        if combinations <= max(len(combined), 1 << 16):
+            counts = numpy.bincount(combined, minlength=combinations)
+            combined = numpy.flatnonzero(counts)
+            counts = counts[combined]
+        else:
+            combined, counts = numpy.unique(combined, return_counts=True)
+        keys = []
+        for column, column_key_ids, key_values in reversed(key_columns):
+            combined, key_ids = numpy.divmod(combined, len(key_values))
+            keys.insert(0, [key_values[key_id] for key_id in key_ids.tolist()])
+        return zip(zip(*keys), counts.tolist())
+
+    def count_python(self, key_columns, supported):
+        # Rows are counted by the ids of their row columns, then by the values of keys.
+        rows = itertools.izip(*[self.ids[column] for column, column_key_ids, key_values in key_columns])
+        if supported is not None:
+            supported = frozenset(supported)
+            rows = (row for row_supported, row in itertools.izip(self.supported, rows) if row_supported in supported)
+        row_counts = dict()
+        for row in rows:
+            row_counts[row] = row_counts.get(row, 0) + 1
+        counts = dict()
+        for row, count in row_counts.iteritems():
+            key = tuple(key_values[row_id if column_key_ids is None else column_key_ids[row_id]]
+                        for row_id, (column, column_key_ids, key_values) in zip(row, key_columns))
+            counts[key] = counts.get(key, 0) + count
+        return counts.items()
+
+
+# Each UAscannerPool worker process builds its own UAscanner once, in _pool_init.
+_pool_scanner = None
+
+
+def _pool_init(scanner_args):
+    global _pool_scanner
+    _pool_scanner = UAscanner(**scanner_args)
+
+
+def _pool_classify(chunk_id, my_useragents, formatted):
+    # Exceptions are returned rather than raised, so the parent is never left waiting on a chunk.
+    try:
+        results = _pool_scanner.classify_chunk(my_useragents)
+        if formatted:
+            results = [_pool_scanner.output_result(result) for result in results]
+        return chunk_id, results, None
+    except Exception:
+        return chunk_id, None, traceback.format_exc()
+
+
+def _pool_call(func_item):
+    func, item = func_item
+    return func(_pool_scanner, item)
+
+
+class UAscannerPool(object):
+    # Classify UserAgents on multiple processes. The parent feeds chunks of entries to the workers, keeping at
+    # most max_pending chunks in flight, and yields (entry, result) pairs either in input order (ordered=True) or
+    # as each chunk completes. Any other keyword arguments are passed on to each worker's UAscanner.
+
+    # Seconds between checks on the workers while waiting for a chunk
+    poll_interval = 1.0
+
+    def __init__(self, jobs=None, chunk_size=1000, ordered=True, max_pending=None, **scanner_args):
+        import multiprocessing
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.max_pending = max_pending or self.jobs * 4
+        # Large batches will need user_agents, import it once here rather than in every worker.
+        if scanner_args.get('ua_regex_bundle') is not None:
+            import uascan_regexes
+            uascan_regexes.install_bundle_file(scanner_args['ua_regex_bundle'])
+        load_user_agents()
+        self.pool = multiprocessing.Pool(self.jobs, _pool_init, (scanner_args,))
+        self.worker_pids = set(process.pid for process in self.pool._pool)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+        return False
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def check_workers(self):
+        # A worker that dies takes its chunk with it, and multiprocessing starts another in its place. Workers only
+        # end when the pool does, so a worker process we did not start means a chunk will never come back.
+        if set(process.pid for process in self.pool._pool) != self.worker_pids:
+            raise RuntimeError('UAscannerPool worker died, its UserAgents were not classified')
+
+    def wait_chunk(self, chunks_pending, chunks_ready):
+        # Return the id of a finished chunk: the first one sent when ordered, any one otherwise. chunks_ready is
+        # woken by each chunk that succeeds, a chunk that raised is only seen by polling. Waits are bounded, so
+        # they stay interruptible by CTRL+C and a dead worker is noticed even when no chunk comes back.
+        while True:
+            for chunk_id, (chunk, async_result) in chunks_pending.iteritems():
+                if async_result.ready():
+                    return chunk_id
+                if self.ordered:
+                    break
+            try:
+                chunks_ready.get(True, self.poll_interval)
+            except Queue.Empty:
+                pass
+            self.check_workers()
+
+    @staticmethod
+    def get_useragents(chunk, ua_index):
+        return chunk if ua_index is None else [entry[ua_index] for entry in chunk]
+
+    def run_tasks(self, tasks):
+        # Generator running each (context, func, args) of tasks on the workers, with at most max_pending of them
+        # in flight, and yielding (context, async_result) pairs as they finish, see wait_chunk. The contexts stay
+        # here, only func and args are sent to the workers.
+        tasks = iter(tasks)
+        chunks_ready = Queue.Queue()
+        chunks_pending = OrderedDict()
+        chunk_next = 0
+        exhausted = False
+        while True:
+            while not exhausted and len(chunks_pending) < self.max_pending:
+                try:
+                    context, func, args = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                chunks_pending[chunk_next] = (context, self.pool.apply_async(func, args, callback=chunks_ready.put))
+                chunk_next += 1
+            if not chunks_pending:
+                break
+            yield chunks_pending.pop(self.wait_chunk(chunks_pending, chunks_ready))
+
+    def scan(self, entries, ua_index=None, formatted=False):
+        # entries are UserAgent strings, or sequences holding the UserAgent at ua_index. Only the UserAgents
+        # are sent to the workers, the entries stay here until their chunk comes back.
+        entries = iter(entries)
+        chunks = iter(lambda: list(itertools.islice(entries, self.chunk_size)), [])
+        tasks = ((chunk, _pool_classify, (chunk_id, self.get_useragents(chunk, ua_index), formatted))
+                 for chunk_id, chunk in enumerate(chunks))
+        for chunk, async_result in self.run_tasks(tasks):
+            # Exceptions raised outside of _pool_classify, like results that can not be pickled, are raised here.
+            chunk_id, results, error = async_result.get()
+            if error is not None:
+                raise RuntimeError('UAscannerPool worker failed:\n{0}'.format(error))
+            for pair in itertools.izip(chunk, results):
+                yield pair
+
+    def map_scanner(self, func, items):
+        # Generator yielding func(scanner, item) for each item, run in the workers with their UAscanner.
+        # func must be a module level function so it can be sent to the workers. An exception raised by func is
+        # raised here, and a worker that dies raises a RuntimeError, as in scan.
+        for item, async_result in self.run_tasks((item, _pool_call, ((func, item),)) for item in items):
+            yield async_result.get()
+
+    def classify_many(self, entries, ua_index=None):
+        # Generator yielding (entry, UAresult) pairs.
+        return self.scan(entries, ua_index, formatted=False)
+
+    def uacheck_many(self, entries, ua_index=None):
+        # Generator yielding (entry, uacheck_string output) pairs.
+        return self.scan(entries, ua_index, formatted=True)
@@ -0,0 +1,877 @@
+#!/usr/bin/env python
+#
+#   Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import io
+import os
+import re
+import bz2
+import glob
+import json
+import math
+import time
+import zlib
+import mmap
+import errno
+import bisect
+import random
+import logging
+import urlparse
+import itertools
+from collections import OrderedDict
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # xz input is only supported when the lzma module (backports.lzma on Python 2) is installed.
+        lzma = None
+
+""" Read log files and extract the User Agent of each entry for the UAscanner applications.
+
+Large files are read through mmap, and can be split into byte ranges aligned to line boundaries so that each
+range can be scanned by a separate worker process. Files compressed with gzip, bzip2 or xz are detected by their
+magic bytes and decompressed while they are read, without writing an uncompressed copy to disk.
+
+Log sets too large to classify whole can be sampled instead, by entry or by file, to estimate the share of entries
+of each support code with a confidence interval.
+"""
+
+# Size of each read from a compressed or non seekable log file
+read_buffer_size = 1 << 20
+
+# Magic bytes at the start of each supported compressed file format
+compression_magic = (('gzip', '\x1f\x8b'),
+                     ('bzip2', 'BZh'),
+                     ('xz', '\xfd7zXZ\x00'))
+compression_magic_length = max(len(magic) for compression, magic in compression_magic)
+
+# Warnings about log files that are read only in part
+logs_logger = logging.getLogger('UAScannerLogs')
+logs_logger.addHandler(logging.NullHandler())
+
+# S3 Log Format Regex
+s3log_regex = re.compile(r'^(.*?) (.*?) \[(.*?)\] (.*?) (.*?) (.*?) (.*?) (.*?) "(.*?)" (.*?) (.*?) (.*?) (.*?) (.*?) (.*?) "(.*?)" "(.*?)" (.*)$')
+
+# S3 Server Log Access Format: http://docs.aws.amazon.com/AmazonS3/latest/dev/LogFormat.html
+#     0: Canonical user ID of bucket owner
+#     1: Bucket Processed (or object copied too)
+#     2: Date/Time %d/%b/%Y:%H:%M:%S %z
+#     3: Remote IP
+#     4: Canonical user ID of requester, or "Anonymous"
+#     5: Request ID
+#     6: Operation
+#     7: Object Key
+#     8: Request-URI
+#     9: HTTP status
+#    10: Error Code
+#    11: Bytes Sent
+#    12: Object Size
+#    13: Total Time
+#    14: Turn-Around Time
+#    15: Referrer
+#    16: User-Agent
+#    17: Version Id
+
+
+def mmap_lines(file_name, start=0, end=None):
+    # Yield each line between the byte offsets start and end of the file, without its trailing newline.
+    with open(file_name, 'rb') as log_filein:
+        size = os.fstat(log_filein.fileno()).st_size
+        if end is None or end > size:
+            end = size
+        if start >= end:
+            # mmap can not map an empty file
+            return
+        log_map = mmap.mmap(log_filein.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = start
+            while position < end:
+                line_end = log_map.find('\n', position, end)
+                if line_end < 0:
+                    # The last line may not have a newline
+                    line_end = end
+                yield log_map[position:line_end]
+                position = line_end + 1
+        finally:
+            log_map.close()
+
+
+def get_compression(data):
+    # Return the compression format named in compression_magic that data starts with, or None.
+    for compression, magic in compression_magic:
+        if data.startswith(magic):
+            return compression
+    return None
+
+
+def get_file_compression(file_name):
+    # Return the compression format of the file, or None if it is not compressed.
+    with open(file_name, 'rb') as log_filein:
+        return get_compression(log_filein.read(compression_magic_length))
+
+
+def get_decompressor(compression):
+    # Return a factory for decompressor objects of the compression format, one object is used per stream.
+    if compression == 'gzip':
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'bzip2':
+        return bz2.BZ2Decompressor
+    if compression == 'xz':
+        if lzma is None:
+            raise ValueError('xz compressed logs require the lzma module, on Python 2 install backports.lzma')
+        return lzma.LZMADecompressor
+    raise ValueError('Unsupported compression: {0}'.format(compression))
+
+
+def read_log_chunks(log_filein, buffer_size=read_buffer_size):
+    # Yield the content of the log file in chunks of about buffer_size bytes, decompressed if its first bytes
+    # match one of compression_magic.
+    data = log_filein.read(max(buffer_size, compression_magic_length))
+    compression = get_compression(data)
+    if compression is None:
+        while data:
+            yield data
+            data = log_filein.read(buffer_size)
+        return
+
+    new_decompressor = get_decompressor(compression)
+    decompressor = new_decompressor()
+    stream_ended = False
+    while data:
+        if stream_ended:
+            # Concatenated files (as written by 'cat a.gz b.gz' or pbzip2) hold several streams, anything after the
+            # end of one stream should be the start of the next. Anything else, such as the NUL bytes some writers
+            # pad their files with, is not log content: ignore it rather than fail the whole file.
+            if len(data) < compression_magic_length:
+                data += log_filein.read(compression_magic_length - len(data))
+            if not data.strip('\0') or get_compression(data) != compression:
+                logs_logger.warning('Ignoring trailing data after the last {0} stream of {1}'.format(
+                    compression, getattr(log_filein, 'name', 'the log file')))
+                return
+            decompressor = new_decompressor()
+            stream_ended = False
+        try:
+            decompressed = decompressor.decompress(data)
+        except EOFError:
+            # The previous stream ended exactly at the end of the last read.
+            stream_ended = True
+            continue
+        if decompressed:
+            yield decompressed
+        data = decompressor.unused_data
+        if data:
+            stream_ended = True
+        else:
+            data = log_filein.read(buffer_size)
+
+
+def test_trailing_data_test(lines=('first line', 'second line')):
+    # Check that streams concatenated in one file are all read, and that NUL padding or other bytes after the last
+    # stream are ignored, for each compression format that is available.
+    content = '\n'.join(lines) + '\n'
+    for compression, magic in compression_magic:
+        if compression == 'gzip':
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            stream = compressor.compress(content) + compressor.flush()
+        elif compression == 'bzip2':
+            stream = bz2.compress(content)
+        elif lzma is not None:
+            stream = lzma.compress(content)
+        else:
+            continue
+        for trailer in ('', stream, '\0' * 1024, 'garbage', magic[:1]):
+            for buffer_size in (3, read_buffer_size):
+                chunks = read_log_chunks(io.BytesIO(stream + trailer), buffer_size)
+                if ''.join(chunks) != content * (2 if trailer == stream else 1):
+                    return False
+    return True
+
+
+def stream_lines(file_name, buffer_size=read_buffer_size):
+    # Yield each line of the file, without its trailing newline, reading and decompressing buffer_size bytes at a
+    # time. Unlike mmap_lines this works on compressed files and pipes.
+    with open(file_name, 'rb') as log_filein:
+        partial_line = ''
+        for chunk in read_log_chunks(log_filein, buffer_size):
+            lines = chunk.split('\n')
+            lines[0] = partial_line + lines[0]
+            partial_line = lines.pop()
+            for line_in in lines:
+                yield line_in
+        if partial_line:
+            # The last line may not have a newline
+            yield partial_line
+
+
+def log_lines(file_name):
+    # Yield each line of the file, plain files are read through mmap and everything else is streamed.
+    if os.path.isfile(file_name) and get_file_compression(file_name) is None:
+        return mmap_lines(file_name)
+    return stream_lines(file_name)
+
+
+def follow_log(file_name, inode=None, offset=0, follow=True, poll_interval=1.0, buffer_size=read_buffer_size):
+    # Yield (inode, offset, lines) for the complete lines of the file after offset, where offset is the byte position
+    # just after the yielded lines. If the file no longer has the given inode, or is shorter than offset, it was
+    # rotated or truncated and is read from the start. With follow the file is tailed like 'tail -F': once at the
+    # end, it waits for lines to be appended, reopens the path when it is rotated and starts over when it is
+    # truncated. Without follow it stops at the end of the file. When following, a last line without a newline may
+    # still be being written, so it is only yielded once the file is rotated. Without follow it is yielded at the
+    # end of the file, like any other line.
+    log_filein = None
+    partial_line = ''
+    try:
+        while True:
+            if log_filein is None:
+                try:
+                    log_filein = open(file_name, 'rb')
+                except IOError as err:
+                    if err.errno != errno.ENOENT or not follow:
+                        raise
+                    # Between the rename and the creation of the new file during a rotation
+                    time.sleep(poll_interval)
+                    continue
+                file_stat = os.fstat(log_filein.fileno())
+                if file_stat.st_ino != inode or file_stat.st_size < offset:
+                    inode, offset = file_stat.st_ino, 0
+                if offset == 0 and get_compression(log_filein.read(compression_magic_length)) is not None:
+                    raise ValueError('{0} is compressed, it can not be followed'.format(file_name))
+                log_filein.seek(offset)
+                partial_line = ''
+
+            data = log_filein.read(buffer_size)
+            if data:
+                lines = (partial_line + data).split('\n')
+                partial_line = lines.pop()
+                offset = log_filein.tell() - len(partial_line)
+                if lines:
+                    yield inode, offset, lines
+                continue
+
+            if not follow:
+                if partial_line:
+                    # Nothing more is waited for, the last line is complete as it is.
+                    yield inode, log_filein.tell(), [partial_line]
+                break
+            try:
+                path_inode = os.stat(file_name).st_ino
+            except OSError:
+                path_inode = inode
+            if path_inode != inode:
+                # Rotated: read what was appended before the rename. The writer has moved on to the new file, so
+                # the partial line is complete.
+                lines = (partial_line + log_filein.read()).split('\n')
+                if not lines[-1]:
+                    lines.pop()
+                if lines:
+                    yield inode, log_filein.tell(), lines
+                log_filein.close()
+                log_filein = None
+                inode, offset = None, 0
+            elif os.fstat(log_filein.fileno()).st_size < log_filein.tell():
+                # Truncated in place, start over from the beginning.
+                log_filein.seek(0)
+                offset = 0
+                partial_line = ''
+            else:
+                time.sleep(poll_interval)
+    finally:
+        if log_filein is not None:
+            log_filein.close()
+
+
+class LogCheckpoint(object):
+    # Durable (inode, offset) of each log file, stored as JSON, so a restarted run only reads appended lines.
+    # The file is replaced atomically on every save, a crash leaves either the old or the new checkpoint.
+
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+        try:
+            with open(checkpoint_file, 'r') as checkpoint_filein:
+                self.positions = json.load(checkpoint_filein)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            self.positions = {}
+
+    def get(self, file_name):
+        # Return the (inode, offset) stored for the file, or (None, 0) if it has not been read yet.
+        inode, offset = self.positions.get(os.path.abspath(file_name), (None, 0))
+        return inode, offset
+
+    def save(self, file_name, inode, offset):
+        self.positions[os.path.abspath(file_name)] = (inode, offset)
+        checkpoint_temp = '{0}.tmp'.format(self.checkpoint_file)
+        with open(checkpoint_temp, 'w') as checkpoint_fileout:
+            json.dump(self.positions, checkpoint_fileout)
+            checkpoint_fileout.flush()
+            os.fsync(checkpoint_fileout.fileno())
+        os.rename(checkpoint_temp, self.checkpoint_file)
+
+
+def get_byte_ranges(file_name, parts):
+    # Split the file into at most parts (start, end) byte ranges. Each range ends just after a newline, or at the
+    # end of the file, so every line belongs to exactly one range.
+    size = os.path.getsize(file_name)
+    if size == 0:
+        return []
+    byte_ranges = []
+    start = 0
+    with open(file_name, 'rb') as log_filein:
+        log_map = mmap.mmap(log_filein.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for part in xrange(1, parts):
+                line_end = log_map.find('\n', max(size * part // parts, start))
+                if line_end < 0:
+                    break
+                byte_ranges.append((start, line_end + 1))
+                start = line_end + 1
+        finally:
+            log_map.close()
+    if start < size:
+        byte_ranges.append((start, size))
+    return byte_ranges
+
+
+# Delimiters between the Remote IP and the User-Agent fields, in the order the lazy groups of s3log_regex find them:
+# the end of fields 3 to 6, the opening quote of 8, the end of 8 to 13, the opening quote of 15 and the end of 15.
+s3log_delimiters = tuple((delimiter, len(delimiter)) for delimiter in
+                         (' ', ' ', ' ', ' "', '" ', ' ', ' ', ' ', ' ', ' ', ' "', '" "'))
+
+
+def split_s3log(line_in):
+    # Return the (bucket, remote ip, user agent) fields of an S3 access log line, or None if it does not match.
+    # Each delimiter is found with str.find at the position where the first attempt of s3log_regex places it, and
+    # only the three fields we need are sliced. Taking the first occurrence of each delimiter is the only way the
+    # regex can match, so a missing delimiter means it would not match either; trying it anyway on such a line
+    # backtracks through all 18 lazy groups. The regex is still used for lines holding a newline, which its groups
+    # do not cross.
+    if '\n' in line_in:
+        line_regexed = s3log_regex.match(line_in)
+        # If line_regexed is None then our regex did not match.
+        if line_regexed is None:
+            return None
+        return line_regexed.group(2, 4, 17)
+
+    find = line_in.find
+    bucket_start = find(' ') + 1
+    bucket_end = find(' [', bucket_start)
+    ip_start = find('] ', bucket_end + 2) + 2
+    ip_end = find(' ', ip_start)
+    if bucket_end < 0 or ip_start < 2 or ip_end < 0:
+        return None
+    start = ip_end + 1
+    for delimiter, delimiter_len in s3log_delimiters:
+        field_end = find(delimiter, start)
+        if field_end < 0:
+            return None
+        start = field_end + delimiter_len
+    ua_end = find('" ', start)
+    if ua_end < 0:
+        return None
+    return line_in[bucket_start:bucket_end], line_in[ip_start:ip_end], line_in[start:ua_end]
+
+
+def split_quoted_ua(line_in, fields, resource_index, client_index):
+    # Return the (resource, client ip, user agent) of a line of space separated fields followed by a quoted request
+    # and a quoted user agent, as ELB and ALB write them, or None if it does not have them. Only the first fields
+    # fields are split, the port is removed from the client:port field.
+    parts = line_in.split(' ', fields)
+    if len(parts) <= fields or not parts[fields].startswith('"'):
+        return None
+    quoted = parts[fields]
+    ua_start = quoted.find('" "') + 3
+    if ua_start < 3:
+        return None
+    ua_end = quoted.find('" ', ua_start)
+    if ua_end < 0:
+        # The user agent may be the last field
+        quoted = quoted.rstrip('\r')
+        if not quoted.endswith('"') or len(quoted) <= ua_start:
+            return None
+        ua_end = len(quoted) - 1
+    client = parts[client_index]
+    client_ip, separator, client_port = client.rpartition(':')
+    return parts[resource_index], client_ip if separator else client, quoted[ua_start:ua_end]
+
+
+def split_alblog(line_in):
+    # Application Load Balancer: type time elb client:port target:port request_processing_time
+    # target_processing_time response_processing_time elb_status_code target_status_code received_bytes sent_bytes
+    # "request" "user_agent" ssl_cipher ...
+    return split_quoted_ua(line_in, 12, 2, 3)
+
+
+def split_elblog(line_in):
+    # Classic Load Balancer: time elb client:port backend:port request_processing_time backend_processing_time
+    # response_processing_time elb_status_code backend_status_code received_bytes sent_bytes "request" "user_agent"
+    # ssl_cipher ssl_protocol
+    return split_quoted_ua(line_in, 11, 1, 2)
+
+
+def split_apachelog(line_in):
+    # Apache combined log format: host ident user [time] "request" status bytes "referer" "user_agent"
+    # It names no resource, '-' is returned in its place. The user agent ends at the first quote followed by a
+    # space that is not escaped, so quoted fields after it (such as an X-Forwarded-For) are left out, or else at the
+    # last quote of the line.
+    line_in = line_in.rstrip('\r')
+    find = line_in.find
+    ip_end = find(' ')
+    if ip_end < 0:
+        return None
+    request_start = find('] "', ip_end)
+    if request_start < 0:
+        return None
+    request_end = find('" ', request_start + 3)
+    if request_end < 0:
+        return None
+    referer_start = find(' "', request_end + 2)
+    if referer_start < 0:
+        return None
+    ua_start = find('" "', referer_start + 2)
+    if ua_start < 0:
+        return None
+    ua_start += 3
+    ua_end = find('" ', ua_start)
+    while ua_end > ua_start and line_in[ua_end - 1] == '\\':
+        ua_end = find('" ', ua_end + 1)
+    if ua_end < 0:
+        if not line_in.endswith('"') or len(line_in) - 1 < ua_start:
+            return None
+        ua_end = len(line_in) - 1
+    return '-', line_in[:ip_end], line_in[ua_start:ua_end]
+
+
+class CloudFrontSplitter(object):
+    # CloudFront standard logs are tab separated, with '#Version' and '#Fields' header lines at the start of each
+    # file. The fields are found by their name in '#Fields', the documented order is used until one is read. The
+    # user agent is URL encoded twice, as in 'Mozilla/5.0%2520(Windows%2520NT%25206.0)', it is decoded once here
+    # and UAscanner decodes it again like any other. The resource is the distribution's domain.
+
+    header_prefix = '#'
+    default_fields = ('date time x-edge-location sc-bytes c-ip cs-method cs(Host) cs-uri-stem sc-status cs(Referer) '
+                      'cs(User-Agent) cs-uri-query cs(Cookie) x-edge-result-type x-edge-request-id x-host-header '
+                      'cs-protocol cs-bytes time-taken').split()
+    entry_fields = ('cs(Host)', 'c-ip', 'cs(User-Agent)')
+
+    def __init__(self):
+        self.set_fields(self.default_fields)
+
+    def set_fields(self, field_names):
+        missing = [field_name for field_name in self.entry_fields if field_name not in field_names]
+        if missing:
+            raise ValueError('CloudFront log fields without {0}'.format(', '.join(missing)))
+        self.field_indexes = [field_names.index(field_name) for field_name in self.entry_fields]
+        self.split_count = max(self.field_indexes) + 1
+
+    def __call__(self, line_in):
+        # Return the (distribution domain, client ip, user agent) of a log line, or None for header lines and lines
+        # without them.
+        if line_in.startswith('#'):
+            if line_in.startswith('#Fields:'):
+                self.set_fields(line_in[len('#Fields:'):].split())
+            return None
+        parts = line_in.split('\t', self.split_count)
+        if len(parts) < self.split_count:
+            return None
+        resource_index, ip_index, ua_index = self.field_indexes
+        return parts[resource_index], parts[ip_index], urlparse.unquote(parts[ua_index].rstrip('\r'))
+
+
+# Each log format's function splitting a line into its (resource, client ip, user agent), or None. A class is
+# instantiated for each log read, for formats whose header lines describe the lines after them.
+#     s3         : S3 server access logs, the resource is the bucket
+#     alb        : Application Load Balancer access logs, the resource is the load balancer
+#     elb        : Classic Load Balancer access logs, the resource is the load balancer
+#     cloudfront : CloudFront standard logs, the resource is the distribution's domain
+#     apache     : Apache combined logs, which name no resource
+log_formats = OrderedDict([('s3', split_s3log),
+                           ('alb', split_alblog),
+                           ('elb', split_elblog),
+                           ('cloudfront', CloudFrontSplitter),
+                           ('apache', split_apachelog)])
+
+
+def get_log_splitter(log_format):
+    # Return a function splitting the lines of one log, given its format name or a function already returned.
+    if callable(log_format):
+        return log_format
+    splitter = log_formats.get(log_format)
+    if splitter is None:
+        raise ValueError('Unknown log format {0}, the formats are: {1}'.format(log_format, ', '.join(log_formats)))
+    return splitter() if isinstance(splitter, type) else splitter
+
+
+# A line of each log format, as written by the service, and the (resource, client ip, user agent) it holds once the
+# user agent is URL decoded by UAscanner.
+log_format_samples = [
+    ('s3', '79a59df900b949e55d96a1e698fbacedfd6e09d98eacf8f8d5218e7cd47ef2be awsexamplebucket1 '
+           '[06/Feb/2019:00:00:38 +0000] 192.0.2.3 79a59df900b949e55d96a1e698fbacedfd6e09d98eacf8f8d5218e7cd47ef2be '
+           '3E57427F3EXAMPLE REST.GET.VERSIONING - "GET /awsexamplebucket1?versioning HTTP/1.1" 200 - 113 - 7 - "-" '
+           '"S3Console/0.4" - s9lzHYrFp76ZVxRcpX9+5cjAnEH2ROuNkd2BHfIa6UkFVdtjf5mKR3/eTPFvsiP/XV/VLi31234= SigV4 '
+           'ECDHE-RSA-AES128-GCM-SHA256 AuthHeader awsexamplebucket1.s3.us-west-1.amazonaws.com TLSV1.1',
+     ('awsexamplebucket1', '192.0.2.3', 'S3Console/0.4')),
+    ('alb', 'https 2018-07-02T22:23:00.186641Z app/my-loadbalancer/50dc6c495c0c9188 192.168.131.39:2817 '
+            '10.0.0.1:80 0.086 0.048 0.037 200 200 0 57 "GET https://www.example.com:443/ HTTP/1.1" '
+            '"curl/7.46.0" ECDHE-RSA-AES128-GCM-SHA256 TLSv1.2 '
+            'arn:aws:elasticloadbalancing:us-east-2:123456789012:targetgroup/my-targets/73e2d6bc24d8a067 '
+            '"Root=1-58337281-1d84f3d73c47ec4e58577259" "www.example.com" '
+            '"arn:aws:acm:us-east-2:123456789012:certificate/12345678-1234-1234-1234-123456789012" 1 '
+            '2018-07-02T22:22:48.364000Z "authenticate,forward" "-" "-" "10.0.0.1:80" "200" "-" "-"',
+     ('app/my-loadbalancer/50dc6c495c0c9188', '192.168.131.39', 'curl/7.46.0')),
+    ('elb', '2015-05-13T23:39:43.945958Z my-loadbalancer 192.168.131.39:2817 10.0.0.1:80 0.000086 0.001048 '
+            '0.001337 200 200 0 57 "GET https://www.example.com:443/ HTTP/1.1" "curl/7.38.0" DHE-RSA-AES128-SHA '
+            'TLSv1.2',
+     ('my-loadbalancer', '192.168.131.39', 'curl/7.38.0')),
+    ('cloudfront', '2014-05-23\t01:13:11\tFRA2\t182\t192.0.2.10\tGET\td111111abcdef8.cloudfront.net\t'
+                   '/view/my/file.html\t200\twww.displaymyfiles.com\tMozilla/4.0%2520(compatible;%2520MSIE%25205.0b1;'
+                   '%2520Mac_PowerPC)\t-\tzip=98101\tRefreshHit\tMRVMF7KydIvxMWfJIglgwHQwZsbG2IhRJ07sn9AkKUFLoDexample'
+                   '==\td111111abcdef8.cloudfront.net\thttp\t-\t0.001\t-\t-\t-\tRefreshHit\tHTTP/1.1\tProcessed\t1',
+     ('d111111abcdef8.cloudfront.net', '192.0.2.10', 'Mozilla/4.0 (compatible; MSIE 5.0b1; Mac_PowerPC)')),
+    ('apache', '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 '
+               '"http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"',
+     ('-', '127.0.0.1', 'Mozilla/4.08 [en] (Win98; I ;Nav)')),
+    ('apache', '10.0.0.2 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.1" 200 512 "-" "Mozilla/5.0 (X11; Linux '
+               'x86_64)" "203.0.113.7"',
+     ('-', '10.0.0.2', 'Mozilla/5.0 (X11; Linux x86_64)')),
+    ('apache', '10.0.0.2 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.1" 200 512 "-" "Java \\"x\\" 1.8" 1024',
+     ('-', '10.0.0.2', 'Java \\"x\\" 1.8')),
+]
+
+
+def test_log_formats_test():
+    # Check that each sample line of log_format_samples is split into its entry, with the user agent decoded as
+    # UAscanner decodes it.
+    for log_format, line_in, log_entry in log_format_samples:
+        split_entry = get_log_splitter(log_format)(line_in)
+        if split_entry is None or split_entry[:2] != log_entry[:2] or \
+                urlparse.unquote(split_entry[2].replace('+', ' ')) != log_entry[2]:
+            return False
+    return True
+
+
+def header_lines(file_name, end, log_format='s3'):
+    # Yield the header lines at the start of a plain log file, before the byte offset end, for formats that have
+    # them.
+    header_prefix = getattr(log_formats.get(log_format), 'header_prefix', None)
+    if end > 0 and header_prefix is not None:
+        for line_in in mmap_lines(file_name, 0, end):
+            if not line_in.startswith(header_prefix):
+                break
+            yield line_in
+
+
+def range_lines(file_name, start, end, log_format='s3'):
+    # Yield the lines of a (start, end) byte range of the file, see get_byte_ranges. A range after the start of a log
+    # with header lines begins with the header lines of the file, so its fields are known.
+    for line_in in itertools.chain(header_lines(file_name, start, log_format), mmap_lines(file_name, start, end)):
+        yield line_in
+
+
+def expand_log_paths(paths):
+    # Return the log files named by paths, in order. Each path is a file, a directory whose files are all
+    # included (recursively), or a glob pattern.
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, dir_file_names in os.walk(path):
+                dir_names.sort()
+                file_names.extend(os.path.join(dir_path, file_name) for file_name in sorted(dir_file_names))
+        elif os.path.exists(path):
+            file_names.append(path)
+        else:
+            file_names.extend(sorted(glob.glob(path)))
+    return file_names
+
+
+def read_s3log(lines, logger=None, log_format='s3'):
+    # Yield the (bucket, remote ip, user agent) of each S3 access log entry, lines that do not match are skipped.
+    # Logs of the other log_formats yield their (resource, client ip, user agent) the same way.
+    split_line = get_log_splitter(log_format)
+    for line_in in lines:
+        log_entry = split_line(line_in)
+        if log_entry is not None:
+            if logger is not None:
+                logger.debug('DEBUG UA String: {0}'.format(log_entry[2]))
+            yield log_entry
+
+
+def classify_s3log(ua_scanner, lines, logger=None, chunk_size=1000, log_format='s3'):
+    # Yield the (bucket, remote ip, UAresult) of each S3 access log entry.
+    log_entries = read_s3log(lines, logger, log_format)
+    while True:
+        # Classify the User Agents a chunk at a time, so repeated User Agents within a chunk are scanned once.
+        log_chunk = list(itertools.islice(log_entries, chunk_size))
+        if not log_chunk:
+            break
+        ua_results = ua_scanner.classify_many([log_ua for log_bucket, log_ip, log_ua in log_chunk],
+                                              chunk_size=len(log_chunk))
+        for (log_bucket, log_ip, log_ua), ua_result in itertools.izip(log_chunk, ua_results):
+            yield log_bucket, log_ip, ua_result
+
+
+def check_s3log(ua_scanner, lines, logger=None, chunk_size=1000, log_format='s3'):
+    # Yield the (bucket, remote ip, 'Supported UA_ShortName') of each S3 access log entry.
+    for log_bucket, log_ip, ua_result in classify_s3log(ua_scanner, lines, logger, chunk_size, log_format):
+        yield log_bucket, log_ip, ua_scanner.output_result(ua_result)
+
+
+def scan_s3log(ua_scanner, lines, logger=None, chunk_size=1000, log_format='s3'):
+    # Yield the 'Bucket SourceIP Supported UA_ShortName' output for each S3 access log entry.
+    for log_bucket, log_ip, ua_status in check_s3log(ua_scanner, lines, logger, chunk_size, log_format):
+        yield '{0} {1} {2}'.format(log_bucket, log_ip, ua_status)
+
+
+# The worker functions take the log format as a keyword, bind it with functools.partial for map_scanner.
+
+def scan_s3log_range(ua_scanner, file_range, log_format='s3'):
+    # Worker side of a sharded scan: returns the output for one (file_name, start, end) range as a single string.
+    lines = range_lines(*file_range, log_format=log_format)
+    return ''.join('{0}\n'.format(output) for output in scan_s3log(ua_scanner, lines, log_format=log_format))
+
+
+def scan_s3log_file(ua_scanner, file_name, log_format='s3'):
+    # Worker side of a directory scan: returns the output for one log file as a single string, each line prefixed
+    # with the file name.
+    return ''.join('{0} {1}\n'.format(file_name, output) for output in scan_s3log(ua_scanner, log_lines(file_name),
+                                                                                log_format=log_format))
+
+
+def classify_s3log_range(ua_scanner, file_range, log_format='s3'):
+    # Worker side of a sharded record scan: returns the (bucket, remote ip, UAresult) entries of one
+    # (file_name, start, end) range.
+    return list(classify_s3log(ua_scanner, range_lines(*file_range, log_format=log_format), log_format=log_format))
+
+
+def classify_s3log_file(ua_scanner, file_name, log_format='s3'):
+    # Worker side of a directory record scan: returns the (file name, bucket, remote ip, UAresult) entries of one
+    # log file.
+    return [(file_name,) + log_entry for log_entry in classify_s3log(ua_scanner, log_lines(file_name),
+                                                                     log_format=log_format)]
+
+
+class S3logSummary(object):
+    # Request counts of S3 access log entries by (bucket, supported, UA short name), and by source IP when by_ip.
+    # At most max_keys distinct keys are counted, entries for keys seen after the table is full are only added to
+    # other_count, so memory stays bounded however many source IPs a log holds.
+
+    def __init__(self, by_ip=False, max_keys=100000):
+        self.by_ip = by_ip
+        self.max_keys = max_keys
+        self.counts = {}
+        self.other_count = 0
+
+    def copy(self):
+        # Return an empty summary with the same settings, for a worker process to fill.
+        return S3logSummary(by_ip=self.by_ip, max_keys=self.max_keys)
+
+    def add(self, log_bucket, log_ip, ua_status, count=1):
+        key = (log_bucket, log_ip if self.by_ip else None, ua_status)
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.max_keys:
+            self.counts[key] = count
+        else:
+            self.other_count += count
+
+    def add_entries(self, log_entries):
+        # Count each (bucket, remote ip, 'Supported UA_ShortName') entry, as yielded by check_s3log.
+        for log_bucket, log_ip, ua_status in log_entries:
+            self.add(log_bucket, log_ip, ua_status)
+        return self
+
+    def update(self, other):
+        # Merge the counts of another summary, such as one returned by a worker process.
+        for (log_bucket, log_ip, ua_status), count in other.counts.iteritems():
+            self.add(log_bucket, log_ip, ua_status, count)
+        self.other_count += other.other_count
+        return self
+
+    def report(self):
+        # Yield the 'Requests Bucket [SourceIP] Supported UA_ShortName' report lines, most requests first.
+        for (log_bucket, log_ip, ua_status), count in sorted(self.counts.iteritems(), key=lambda item: (-item[1],
+                                                                                                        item[0])):
+            if self.by_ip:
+                yield '{0} {1} {2} {3}'.format(count, log_bucket, log_ip, ua_status)
+            else:
+                yield '{0} {1} {2}'.format(count, log_bucket, ua_status)
+        if self.other_count:
+            yield '{0} (other keys beyond max_keys={1})'.format(self.other_count, self.max_keys)
+
+
+def summarize_s3log_range(ua_scanner, summary_range, log_format='s3'):
+    # Worker side of a sharded summary: counts one (file_name, start, end) range into the given empty summary.
+    summary, file_range = summary_range
+    lines = range_lines(*file_range, log_format=log_format)
+    return summary.add_entries(check_s3log(ua_scanner, lines, log_format=log_format))
+
+
+def summarize_s3log_file(ua_scanner, summary_file, log_format='s3'):
+    # Worker side of a directory summary: counts one log file into the given empty summary.
+    summary, file_name = summary_file
+    return summary.add_entries(check_s3log(ua_scanner, log_lines(file_name), log_format=log_format))
+
+
+def reservoir_sample(items, count, rng):
+    # Return a list of count items drawn uniformly without replacement from the iterable, in one pass, and the
+    # number of items it held. Algorithm L draws the number of items to skip before the next replacement, so few
+    # random numbers are needed however long the iterable is.
+    items = iter(items)
+    reservoir = list(itertools.islice(items, count))
+    seen = len(reservoir)
+    if seen < count or count == 0:
+        return reservoir, seen
+    weight = math.exp(math.log(1.0 - rng.random()) / count)
+    while True:
+        skip = int(math.log(1.0 - rng.random()) / math.log(1.0 - weight))
+        skipped = sum(1 for item in itertools.islice(items, skip))
+        seen += skipped
+        item = next(items, reservoir) if skipped == skip else reservoir
+        if item is reservoir:
+            return reservoir, seen
+        seen += 1
+        reservoir[rng.randrange(count)] = item
+        weight *= math.exp(math.log(1.0 - rng.random()) / count)
+
+
+def seek_sample_s3log(file_names, count, rng, log_format='s3'):
+    # Yield the (weight, bucket, remote ip, user agent) of the entries on count lines drawn with replacement from
+    # the plain log files, only reading the pages around each drawn line. A byte is drawn uniformly over all the
+    # files and the line holding it is taken, so each line is drawn in proportion to its length, and is weighted
+    # by the inverse of it. Drawn lines that are not entries are skipped.
+    file_ends = []
+    total_size = 0
+    for file_name in file_names:
+        total_size += os.path.getsize(file_name)
+        file_ends.append(total_size)
+    if total_size == 0:
+        return
+    # Sorted offsets read each file once, front to back.
+    offsets = sorted(rng.randrange(total_size) for sample in xrange(count))
+    for file_index, file_offsets in itertools.groupby(offsets, lambda offset: bisect.bisect_right(file_ends, offset)):
+        file_name = file_names[file_index]
+        file_start = file_ends[file_index - 1] if file_index > 0 else 0
+        split_line = get_log_splitter(log_format)
+        for line_in in header_lines(file_name, file_ends[file_index] - file_start, log_format):
+            split_line(line_in)
+        with open(file_name, 'rb') as log_filein:
+            log_map = mmap.mmap(log_filein.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in file_offsets:
+                    offset -= file_start
+                    line_start = log_map.rfind('\n', 0, offset) + 1
+                    line_end = log_map.find('\n', offset) + 1 or len(log_map)
+                    log_entry = split_line(log_map[line_start:line_end].rstrip('\n'))
+                    if log_entry is not None:
+                        yield (1.0 / (line_end - line_start),) + log_entry
+            finally:
+                log_map.close()
+
+
+def sample_s3log(file_names, count, seed=0, log_format='s3'):
+    # Return the (weight, bucket, remote ip, user agent) of about count entries sampled uniformly from the log
+    # files, and the number of entries sampled from, None when sampled with replacement. Plain files are sampled by
+    # seeking to the drawn lines, see seek_sample_s3log. Compressed files and pipes can only be read through, their
+    # entries are reservoir sampled, each with a weight of 1. The same seed draws the same sample.
+    rng = random.Random(seed)
+    if all(os.path.isfile(file_name) and get_file_compression(file_name) is None for file_name in file_names):
+        return list(seek_sample_s3log(file_names, count, rng, log_format)), None
+    log_entries = itertools.chain.from_iterable(read_s3log(log_lines(file_name), log_format=log_format)
+                                                for file_name in file_names)
+    sampled_entries, population = reservoir_sample(log_entries, count, rng)
+    return [(1.0,) + log_entry for log_entry in sampled_entries], population
+
+
+def sample_log_files(file_names, count, seed=0):
+    # Return count of the log files drawn uniformly without replacement, in their order, and the number of files.
+    sampled_files, population = reservoir_sample(enumerate(file_names), count, random.Random(seed))
+    return [file_name for file_index, file_name in sorted(sampled_files)], population
+
+
+def count_s3log_file(ua_scanner, file_name, log_format='s3'):
+    # Worker side of a file sample: returns the number of entries of one log file of each support code.
+    supported_counts = [0, 0, 0]
+    for log_bucket, log_ip, ua_result in classify_s3log(ua_scanner, log_lines(file_name), log_format=log_format):
+        supported_counts[ua_result.supported] += 1
+    return supported_counts
+
+
+def normal_quantile(confidence):
+    # The z of a two sided normal interval holding confidence of the distribution, found by bisection of math.erf.
+    low, high = 0.0, 10.0
+    for step in xrange(60):
+        middle = (low + high) / 2
+        if math.erf(middle / math.sqrt(2)) < confidence:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+class LogSampleEstimate(object):
+    # Estimates the share of the entries of a log set of each support code from sampled units: entries, weighted
+    # as drawn by sample_s3log, or whole files. Each unit adds its size, its weight or number of entries, and the
+    # size of it with each support code. A share is the ratio of the two sums, its variance the linearized
+    # variance of a ratio estimator, with the finite population correction when population units were sampled
+    # without replacement, and its interval the normal one at confidence, within [0, 1].
+
+    def __init__(self, confidence=0.95, population=None):
+        if not 0 < confidence < 1:
+            raise ValueError('The confidence must be between 0 and 1, not {0}'.format(confidence))
+        self.confidence = confidence
+        self.population = population
+        self.entries = 0
+        self.units = []
+
+    def add(self, size, supported_counts, entries=1):
+        self.units.append((size, supported_counts))
+        self.entries += entries
+
+    def add_entry(self, weight, supported):
+        supported_counts = [0.0, 0.0, 0.0]
+        supported_counts[supported] = weight
+        self.add(weight, supported_counts)
+
+    def estimates(self):
+        # Return the (supported, share, low, high) of each support code, in code order, or an empty list without
+        # any sampled entry.
+        total_size = float(sum(size for size, supported_counts in self.units))
+        if not total_size:
+            return []
+        unit_count = len(self.units)
+        correction = 1.0 - float(unit_count) / self.population if self.population else 1.0
+        z = normal_quantile(self.confidence)
+        code_estimates = []
+        for supported in xrange(3):
+            share = sum(supported_counts[supported] for size, supported_counts in self.units) / total_size
+            deviations = sum((supported_counts[supported] - share * size) ** 2
+                             for size, supported_counts in self.units)
+            if unit_count > 1:
+                margin = z * math.sqrt(max(correction * deviations / total_size ** 2 * unit_count / (unit_count - 1),
+                                           0.0))
+            else:
+                # A single unit tells nothing of the variance, unless it is the whole population.
+                margin = 1.0 if correction > 0 else 0.0
+            code_estimates.append((supported, share, max(share - margin, 0.0), min(share + margin, 1.0)))
+        return code_estimates
+
+    def report(self):
+        # Yield the 'Supported Share Low High' report lines, as percentages, and the number of sampled entries.
+        for supported, share, low, high in self.estimates():
+            yield '{0} {1:.2%} {2:.2%} {3:.2%}'.format(supported, share, low, high)
+        yield '({0} entries sampled, {1:.0%} confidence intervals)'.format(self.entries, self.confidence)
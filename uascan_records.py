@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+#   Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import sys
+import zlib
+import itertools
+import array
+import struct
+import getopt
+import marshal
+from collections import OrderedDict, namedtuple
+from uascan_lib import UAresult
+
+""" Write and read scan results as compact binary records.
+
+A record file holds the results of a scan in batches of records. Each batch stores its records column by column:
+the values of the log columns (source file, bucket, source IP) and the UAresult of each record are dictionary
+encoded, each distinct value being stored once in the file, the first time it appears, and each record holding
+only its integer code. The support code of each record is also stored as a byte, to filter on without decoding.
+Batches are compressed with zlib and prefixed with their length, so files can be written and read as a stream.
+
+Record files are written with marshal, only read files written by this module.
+"""
+
+records_magic = 'UASR'
+records_format = 1
+
+# The log columns a record file may hold, in the order they are stored, before the result
+record_columns = ('source_file', 'bucket', 'ip')
+
+# Each record read back holds the log columns of its file, None for the others, and its UAresult.
+ScanRecord = namedtuple('ScanRecord', record_columns + ('result',))
+
+record_length = struct.Struct('<I')
+
+
+def get_code_typecode(max_code):
+    # The smallest array typecode holding codes up to max_code
+    for typecode in ('B', 'H', 'I', 'L'):
+        if max_code < 1 << (8 * array.array(typecode).itemsize):
+            return typecode
+    raise ValueError('Too many distinct values: {0}'.format(max_code + 1))
+
+
+class RecordWriter(object):
+    # Writes records, tuples of the values of columns followed by a UAresult, to fileout. Records are written a
+    # batch of batch_size at a time, and when flush is called.
+
+    def __init__(self, fileout, columns=(), batch_size=65536, compress_level=1):
+        for column in columns:
+            if column not in record_columns:
+                raise ValueError('Unknown record column {0}, the columns are: {1}'.format(
+                    column, ', '.join(record_columns)))
+        self.fileout = fileout
+        self.columns = tuple(columns)
+        self.batch_size = batch_size
+        self.compress_level = compress_level
+        # The code of each value seen so far, for each log column and the result.
+        self.dictionaries = [dict() for column in self.columns + ('result',)]
+        self.batch = []
+        self.records = 0
+        header = marshal.dumps({'format': records_format, 'columns': self.columns, 'byteorder': sys.byteorder,
+                                'compressed': compress_level > 0})
+        self.fileout.write(records_magic + record_length.pack(len(header)) + header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def write(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, records):
+        records = iter(records)
+        while True:
+            batch_length = len(self.batch)
+            self.batch.extend(itertools.islice(records, self.batch_size - batch_length))
+            if len(self.batch) == batch_length:
+                break
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def encode_column(self, values, dictionary):
+        # Return the codes of values, and the values that are new to the dictionary, in code order.
+        # Most values of a batch were seen before and are looked up in one pass, new values are then coded in order.
+        new_values = []
+        codes = map(dictionary.get, values)
+        if None in codes:
+            for index, code in enumerate(codes):
+                if code is None:
+                    value = values[index]
+                    code = dictionary.get(value)
+                    if code is None:
+                        code = dictionary[value] = len(dictionary)
+                        new_values.append(value)
+                    codes[index] = code
+        typecode = get_code_typecode(len(dictionary) - 1)
+        return new_values, typecode, array.array(typecode, codes).tostring()
+
+    def flush(self):
+        if self.batch:
+            columns = zip(*self.batch)
+            encoded = [self.encode_column(values, dictionary) for values, dictionary
+                       in zip(columns, self.dictionaries)]
+            # The results are stored as plain tuples, marshal does not take named tuples.
+            encoded[-1] = ([tuple(result) for result in encoded[-1][0]],) + encoded[-1][1:]
+            supported = array.array('b', [result[0] for result in columns[-1]]).tostring()
+            batch = marshal.dumps((len(self.batch), encoded, supported))
+            if self.compress_level > 0:
+                batch = zlib.compress(batch, self.compress_level)
+            self.fileout.write(record_length.pack(len(batch)) + batch)
+            self.records += len(self.batch)
+            self.batch = []
+        self.fileout.flush()
+
+    def close(self):
+        self.flush()
+
+
+def read_exactly(filein, length):
+    data = filein.read(length)
+    while len(data) < length:
+        more = filein.read(length - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def read_header(filein):
+    # Return the header of the record file being read, a dict holding its 'columns'.
+    magic = read_exactly(filein, len(records_magic) + record_length.size)
+    if magic[:len(records_magic)] != records_magic:
+        raise ValueError('Not a UAscanner record file')
+    header = marshal.loads(read_exactly(filein, record_length.unpack(magic[len(records_magic):])[0]))
+    if header.get('format') != records_format:
+        raise ValueError('Unsupported record file format {0}'.format(header.get('format')))
+    return header
+
+
+def read_batches(filein, header):
+    # Generator yielding the columns of each batch of records: a (dictionary, codes) pair for each log column of
+    # the header and the result, followed by the array of support codes. A dictionary is the list of every value
+    # seen so far in the file, extended in place as batches are read, codes are arrays of indexes into it.
+    dictionaries = [[] for column in header['columns'] + ('result',)]
+    swap = header['byteorder'] != sys.byteorder
+    while True:
+        length = read_exactly(filein, record_length.size)
+        if not length:
+            break
+        batch = read_exactly(filein, record_length.unpack(length)[0])
+        if header['compressed']:
+            batch = zlib.decompress(batch)
+        count, encoded, supported = marshal.loads(batch)
+        columns = []
+        for dictionary, (new_values, typecode, code_data) in zip(dictionaries, encoded):
+            dictionary.extend(new_values)
+            codes = array.array(typecode)
+            codes.fromstring(code_data)
+            if swap:
+                codes.byteswap()
+            columns.append((dictionary, codes))
+        columns.append(array.array('b', supported))
+        yield columns
+
+
+def read_columns(filein):
+    # Return an OrderedDict of each log column of the file and 'result' to its (dictionary, codes) pair, and of
+    # 'supported' to the array of support codes. Counting codes is much faster than reading each record.
+    # Results in the dictionary are plain tuples in UAresult order.
+    header = read_header(filein)
+    names = header['columns'] + ('result',)
+    columns = OrderedDict((name, ([], array.array('B'))) for name in names)
+    columns['supported'] = array.array('b')
+    for batch_columns in read_batches(filein, header):
+        for name, (dictionary, codes) in zip(names, batch_columns):
+            all_codes = columns[name][1]
+            if all_codes.itemsize < codes.itemsize:
+                all_codes = array.array(codes.typecode, all_codes)
+            all_codes.extend(array.array(all_codes.typecode, codes) if all_codes.typecode != codes.typecode
+                             else codes)
+            columns[name] = (dictionary, all_codes)
+        columns['supported'].extend(batch_columns[-1])
+    return columns
+
+
+def read_records(filein):
+    # Generator yielding a ScanRecord for each record of the file.
+    header = read_header(filein)
+    column_indexes = [header['columns'].index(column) if column in header['columns'] else None
+                      for column in record_columns]
+    results = []
+    for batch_columns in read_batches(filein, header):
+        result_values, result_codes = batch_columns[-2]
+        results.extend(UAresult(*result) for result in result_values[len(results):])
+        log_values = [[dictionary[code] for code in codes] for dictionary, codes in batch_columns[:-2]]
+        for record_index, result_code in enumerate(result_codes):
+            yield ScanRecord(*[log_values[index][record_index] if index is not None else None
+                               for index in column_indexes] + [results[result_code]])
+
+
+def count_results(columns):
+    # Return the number of records of each (supported, name), from read_columns, most records first.
+    results, result_codes = columns['result']
+    code_counts = dict()
+    for code in result_codes:
+        code_counts[code] = code_counts.get(code, 0) + 1
+    counts = dict()
+    for code, count in code_counts.iteritems():
+        key = results[code][:2]
+        counts[key] = counts.get(key, 0) + count
+    return sorted(counts.iteritems(), key=lambda item: (-item[1], item[0]))
+
+
+if __name__ == '__main__':
+    try:
+        # -n / --counts : Print the number of records of each Supported and UA_ShortName instead of each record.
+        opts, args = getopt.getopt(sys.argv[1:], 'n', ['counts'])
+        counts = False
+        for opt, val in opts:
+            if opt in ('-n', '--counts'):
+                counts = True
+
+        if len(args) > 1 or (not args and sys.stdin.isatty()):
+            sys.stderr.write('UserAgent SHA256 Compatibility Scanner - Record Reader\n'
+                             '======================================================\n'
+                             'Print the binary records written by the applications with --records,\n'
+                             'read from a file or STDIN, in their text output format.\n\n'
+                             '    Example: {0} s3_access.rec\n'
+                             '             uascan_app3.py --records s3_access.log | {0} --counts\n\n'
+                             'Options:\n'
+                             '    -n, --counts    Print the number of records of each Supported and\n'
+                             '                    UA_ShortName instead of each record\n\n'.format(sys.argv[0]))
+            exit(1)
+
+        records_filein = open(args[0], 'rb') if args else sys.stdin
+        if counts:
+            for (supported, name), count in count_results(read_columns(records_filein)):
+                sys.stdout.write('{0} {1} {2}\n'.format(count, supported, name))
+        else:
+            for record in read_records(records_filein):
+                log_values = ''.join('{0} '.format(value) for value in record[:-1] if value is not None)
+                sys.stdout.write('{0}{1} {2}\n'.format(log_values, record.result.supported, record.result.name))
+    except (getopt.GetoptError, ValueError) as err:
+        sys.stderr.write('{0}\n'.format(err))
+        exit(1)
+    except IOError:
+        # Output cut short, as in: uascan_records.py s3_access.rec | head -n 2
+        exit(0)
+    except KeyboardInterrupt:
+        exit(0)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+#
+#   Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+import sys
+import _sre
+import time
+import types
+import getopt
+import marshal
+import hashlib
+import sre_parse
+import sre_compile
+
+""" Build and load precompiled ua-parser regex bundles.
+
+A bundle holds the browser, OS and device parse tables of a uap-core regexes.yaml as plain marshal data, tagged
+with a version, along with the compiled form of each regex for the Python version that built it. Loading one takes
+a few milliseconds, where importing ua-parser parses or compiles every one of its regexes. Once installed,
+ua-parser (and through it user_agents) uses the bundle's tables, each regex being created from its compiled form
+the first time it is tried (or compiled then, on another Python version), so the scanner is pinned to the bundle's
+regex version.
+"""
+
+bundle_format = 1
+
+# The parse tables of a bundle, and the ua_parser.user_agent_parser list and class each one replaces
+bundle_tables = (('user_agent_parsers', 'USER_AGENT_PARSERS', 'UserAgentParser'),
+                 ('os_parsers', 'OS_PARSERS', 'OSParser'),
+                 ('device_parsers', 'DEVICE_PARSERS', 'DeviceParser'))
+
+# We never use the device, by default bundles replace its 600 regexes, tried on every UserAgent, with one that never
+# matches, so every device is 'Other'. ua-parser expects at least one device parser.
+no_device_parsers = [{'pattern': '(?!)'}]
+
+# The file and version of the bundle installed in this process, ua-parser's tables are global
+installed_file = None
+installed_version = None
+
+
+def get_sre_code(pattern, flags=0):
+    # Return the arguments _sre.compile takes for the pattern, as computed by sre_compile.compile. They are only
+    # valid for the Python version and sre_compile.MAGIC that computed them.
+    parsed = sre_parse.parse(pattern, flags)
+    indexgroup = [None] * parsed.pattern.groups
+    for group_name, group_index in parsed.pattern.groupdict.iteritems():
+        indexgroup[group_index] = group_name
+    return (flags | parsed.pattern.flags, sre_compile._code(parsed, flags), parsed.pattern.groups - 1,
+            parsed.pattern.groupdict, indexgroup)
+
+
+def add_sre_code(bundle):
+    # Precompile each regex of the bundle for this Python version.
+    bundle['python'] = tuple(sys.version_info[:2])
+    bundle['sre_magic'] = sre_compile.MAGIC
+    for table, module_list, parser_class in bundle_tables:
+        for entry in bundle[table]:
+            entry['sre_code'] = get_sre_code(entry['pattern'], re.IGNORECASE if entry.get('regex_flag') == 'i' else 0)
+    return bundle
+
+
+def get_table_entries(yaml_parsers):
+    # Turn the entries of one regexes.yaml table into the attributes ua-parser's parser objects hold.
+    entries = []
+    for yaml_parser in yaml_parsers:
+        entry = dict((key, value) for key, value in yaml_parser.iteritems() if key != 'regex')
+        entry['pattern'] = yaml_parser['regex']
+        entries.append(entry)
+    return entries
+
+
+def build_bundle(yaml_file, version=None, devices=False):
+    # Return the bundle of a uap-core regexes.yaml, pyyaml is only needed here.
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError('Building a bundle from YAML requires pyyaml, install it with: pip install pyyaml')
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
+    with open(yaml_file, 'rb') as yaml_filein:
+        yaml_data = yaml_filein.read()
+    regexes = yaml.load(yaml_data, Loader=SafeLoader)
+    bundle = {'format': bundle_format,
+              'version': version or hashlib.sha256(yaml_data).hexdigest()[:12],
+              'source': yaml_file,
+              'built': int(time.time())}
+    for table, module_list, parser_class in bundle_tables:
+        bundle[table] = get_table_entries(regexes[table])
+    if not devices:
+        bundle['device_parsers'] = [dict(entry) for entry in no_device_parsers]
+    return add_sre_code(bundle)
+
+
+def build_installed_bundle(version=None, devices=False):
+    # Return a bundle of the tables the installed ua-parser would use, to pin them for later runs.
+    import ua_parser
+    from ua_parser import user_agent_parser
+    bundle = {'format': bundle_format,
+              'version': version or 'ua-parser-{0}'.format('.'.join(str(part) for part in ua_parser.VERSION)),
+              'source': user_agent_parser.__file__,
+              'built': int(time.time())}
+    for table, module_list, parser_class in bundle_tables:
+        bundle[table] = []
+        for parser in getattr(user_agent_parser, module_list):
+            entry = dict((key, value) for key, value in vars(parser).iteritems() if key != 'user_agent_re')
+            if parser.user_agent_re.flags & re.IGNORECASE:
+                entry['regex_flag'] = 'i'
+            bundle[table].append(entry)
+    if not devices:
+        bundle['device_parsers'] = [dict(entry) for entry in no_device_parsers]
+    return add_sre_code(bundle)
+
+
+def write_bundle(bundle, bundle_file):
+    with open(bundle_file, 'wb') as bundle_fileout:
+        marshal.dump(bundle, bundle_fileout, 2)
+
+
+def load_bundle(bundle_file):
+    with open(bundle_file, 'rb') as bundle_filein:
+        bundle = marshal.load(bundle_filein)
+    if not isinstance(bundle, dict) or bundle.get('format') != bundle_format:
+        raise ValueError('{0} is not a version {1} ua-parser regex bundle'.format(bundle_file, bundle_format))
+    return bundle
+
+
+class LazyRegex(object):
+    # Compiles the parser's pattern the first time it is used and stores it on the parser, where later lookups
+    # find it without coming back here.
+
+    def __get__(self, parser, parser_type=None):
+        if parser is None:
+            return self
+        if parser.sre_code is not None:
+            user_agent_re = _sre.compile(parser.pattern, *parser.sre_code)
+        else:
+            user_agent_re = re.compile(parser.pattern, re.IGNORECASE if parser.regex_flag == 'i' else 0)
+        parser.__dict__['user_agent_re'] = user_agent_re
+        return user_agent_re
+
+
+def get_lazy_parser(parser_base):
+    # Return a subclass of one of ua-parser's parser classes, built from a bundle entry without compiling it.
+
+    class LazyParser(parser_base):
+        user_agent_re = LazyRegex()
+
+        def __init__(self, entry):
+            self.__dict__.update(entry)
+
+        def __getattr__(self, name):
+            # A bundle entry only holds the replacements set in regexes.yaml, the others are None in ua-parser.
+            if name.endswith('_replacement') or name in ('regex_flag', 'sre_code'):
+                return None
+            raise AttributeError(name)
+
+    LazyParser.__name__ = 'Lazy{0}'.format(parser_base.__name__)
+    return LazyParser
+
+
+def install_bundle(bundle):
+    # Make ua-parser use the bundle's tables in this process. If ua-parser has not been imported yet, its own
+    # tables are never loaded: a placeholder module takes the place of ua_parser._regexes while it is imported.
+    global installed_version
+    if 'ua_parser.user_agent_parser' not in sys.modules and 'ua_parser._regexes' not in sys.modules:
+        regexes_module = types.ModuleType('ua_parser._regexes')
+        for table, module_list, parser_class in bundle_tables:
+            setattr(regexes_module, module_list, [])
+        sys.modules['ua_parser._regexes'] = regexes_module
+    from ua_parser import user_agent_parser
+
+    # The compiled regexes can only be used by the Python version that built them.
+    precompiled = bundle.get('python') == tuple(sys.version_info[:2]) and bundle.get('sre_magic') == sre_compile.MAGIC
+    for table, module_list, parser_class in bundle_tables:
+        lazy_parser = get_lazy_parser(getattr(user_agent_parser, parser_class))
+        parsers = [lazy_parser(entry) for entry in bundle[table]]
+        if not precompiled:
+            for parser in parsers:
+                parser.__dict__.pop('sre_code', None)
+        setattr(user_agent_parser, module_list, parsers)
+        regexes_module = sys.modules.get('ua_parser._regexes')
+        if regexes_module is not None:
+            setattr(regexes_module, module_list, parsers)
+    # Results parsed with the previous tables
+    getattr(user_agent_parser, '_parse_cache', {}).clear()
+    installed_version = bundle['version']
+    return installed_version
+
+
+def install_bundle_file(bundle_file):
+    # Load and install the bundle, unless it is already installed, as in worker processes forked after it was.
+    global installed_file
+    if installed_file != bundle_file:
+        install_bundle(load_bundle(bundle_file))
+        installed_file = bundle_file
+    return installed_version
+
+
+if __name__ == '__main__':
+    try:
+        # -V V / --version V : Version to tag the bundle with, the default is derived from the source.
+        # -d / --devices     : Include the device table, which the scanner does not use.
+        # -i / --installed   : Bundle the tables of the installed ua-parser instead of a regexes.yaml.
+        opts, args = getopt.getopt(sys.argv[1:], 'V:di', ['version=', 'devices', 'installed'])
+        version = None
+        devices = False
+        installed = False
+        for opt, val in opts:
+            if opt in ('-V', '--version'):
+                version = val
+            elif opt in ('-d', '--devices'):
+                devices = True
+            elif opt in ('-i', '--installed'):
+                installed = True
+
+        if len(args) != (1 if installed else 2):
+            sys.stderr.write('UserAgent SHA256 Compatibility Scanner - ua-parser Regex Bundle Builder\n'
+                             '=======================================================================\n'
+                             'Turn a uap-core regexes.yaml into a precompiled bundle that UAscanner loads\n'
+                             'with UAscanner(ua_regex_bundle=...) instead of the regexes of the installed\n'
+                             'ua-parser.\n\n'
+                             '    Example: {0} regexes.yaml regexes.bundle\n'
+                             '             {0} --installed regexes.bundle\n\n'
+                             'Options:\n'
+                             '    -V V, --version V  Version to tag the bundle with\n'
+                             '    -d, --devices      Include the device table, unused by the scanner\n'
+                             '    -i, --installed    Bundle the regexes of the installed ua-parser\n\n'.format(
+                                 sys.argv[0]))
+            exit(1)
+
+        if installed:
+            ua_bundle = build_installed_bundle(version, devices)
+        else:
+            ua_bundle = build_bundle(args[0], version, devices)
+        write_bundle(ua_bundle, args[-1])
+        sys.stdout.write('{0} {1}: {2}\n'.format(args[-1], ua_bundle['version'], ', '.join(
+            '{0} {1}'.format(len(ua_bundle[table]), table) for table, module_list, parser_class in bundle_tables)))
+    except (getopt.GetoptError, ValueError) as err:
+        sys.stderr.write('{0}\n'.format(err))
+        exit(1)